@@ -0,0 +1,167 @@
+import asyncio
+import json
+import math
+import os
+import pathlib
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from datetime import date
+from typing import Any, Dict, Final
+
+import click
+
+from dateutil.relativedelta import relativedelta
+
+from .fake_fitbit_server import FakeFitbitServer
+
+_END_DATE: Final[date] = date(2024, 12, 31)
+
+
+def _write_authorization(cache_directory: pathlib.Path):
+    cache_directory.mkdir(parents=True, exist_ok=True)
+    authorization = {
+        "access_token": "access",
+        "refresh_token": "refresh",
+        "expires_in": 28800,
+        "ts": time.time(),
+    }
+    with (cache_directory / ".auth").open("w") as fw:
+        print(json.dumps(authorization), file=fw)
+
+
+# Runs the fake server in a separate thread, so that the exporter can be run and
+# measured as a child process from the main one.
+class _ServerThread(threading.Thread):
+    def __init__(self, server: FakeFitbitServer):
+        super().__init__(daemon=True)
+        self.server = server
+        self.base_url = ""
+        self._loop = asyncio.new_event_loop()
+        self._ready = threading.Event()
+
+    def run(self):
+        asyncio.set_event_loop(self._loop)
+        self.base_url = self._loop.run_until_complete(self.server.start())
+        self._ready.set()
+        self._loop.run_forever()
+        self._loop.run_until_complete(self.server.stop())
+
+    def __enter__(self) -> "_ServerThread":
+        self.start()
+        self._ready.wait()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self.join()
+
+
+def run_benchmark(
+    years: int,
+    latency: float,
+    rate_limit: int,
+    rate_interval: float,
+    workers: int,
+    args: tuple[str, ...],
+) -> Dict[str, Any]:
+    start_date = _END_DATE - relativedelta(years=years) + relativedelta(days=1)
+    server = FakeFitbitServer(
+        start_date,
+        _END_DATE,
+        latency=latency,
+        rate_limit=rate_limit,
+        rate_interval=rate_interval,
+    )
+    with tempfile.TemporaryDirectory() as directory, _ServerThread(
+        server
+    ) as server_thread:
+        cache_directory = pathlib.Path(directory) / "cache"
+        _write_authorization(cache_directory)
+        env = {**os.environ, "FITBIT2GARMIN_API_BASE_URL": server_thread.base_url}
+        command = [
+            sys.executable,
+            "-m",
+            "fitbit2garmin.cli",
+            "dump-all",
+            "-c",
+            str(cache_directory),
+            "-d",
+            str(pathlib.Path(directory) / "f2g"),
+            "-s",
+            str(start_date),
+            "-e",
+            str(_END_DATE),
+            "-w",
+            str(workers),
+            *args,
+        ]
+        log_file_path = pathlib.Path(directory) / "log.txt"
+        with log_file_path.open("w") as fw:
+            start_ts = time.time()
+            process = subprocess.Popen(command, env=env, stdout=fw, stderr=fw)
+            _, status, rusage = os.wait4(process.pid, 0)
+            wall_time = time.time() - start_ts
+        if os.waitstatus_to_exitcode(status) != 0:
+            sys.stderr.write(log_file_path.read_text())
+            raise click.ClickException(f"The exporter failed for {years} years.")
+    # Fraction of the requests allowed during the run that were actually used.
+    budget = rate_limit * math.ceil(wall_time / rate_interval)
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere.
+    peak_rss = rusage.ru_maxrss / (2**20 if sys.platform == "darwin" else 2**10)
+    return {
+        "years": years,
+        "requests": server.stats["served"],
+        "429s": server.stats["rate_limited"],
+        "utilization": f"{server.stats['served'] / budget:.0%}",
+        "wall time (s)": f"{wall_time:.1f}",
+        "peak rss (MiB)": f"{peak_rss:.1f}",
+    }
+
+
+@click.command(
+    help="Benchmark dump-all against a local fake Fitbit API.",
+    context_settings={"ignore_unknown_options": True},
+)
+@click.option("-y", "--years", type=int, multiple=True, default=[1, 5, 10])
+@click.option("--latency", type=float, default=0.02, help="Seconds per response.")
+@click.option("--rate-limit", type=int, default=150)
+@click.option(
+    "--rate-interval",
+    type=float,
+    default=5.0,
+    help="Seconds of a rate limit window, 3600 for the real API.",
+)
+@click.option("-w", "--workers", type=click.IntRange(min=1), default=4)
+@click.argument("args", nargs=-1, type=click.UNPROCESSED)
+def main(
+    years: tuple[int, ...],
+    latency: float,
+    rate_limit: int,
+    rate_interval: float,
+    workers: int,
+    args: tuple[str, ...],
+):
+    results = [
+        run_benchmark(num_years, latency, rate_limit, rate_interval, workers, args)
+        for num_years in years
+    ]
+    columns = list(results[0])
+    widths = [
+        max(len(column), *(len(str(r[column])) for r in results)) for column in columns
+    ]
+    print("  ".join(column.rjust(width) for column, width in zip(columns, widths)))
+    for result in results:
+        print(
+            "  ".join(
+                str(result[column]).rjust(width)
+                for column, width in zip(columns, widths)
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,277 @@
+import asyncio
+import collections
+import hashlib
+import random
+import time
+
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, Final, Optional
+
+import aiohttp.web
+
+_DATE_FORMAT: Final[str] = "%Y-%m-%d"
+_PAGE_SIZE: Final[int] = 100
+# Seconds between two trackpoints of a synthetic tcx.
+_TRACKPOINT_INTERVAL: Final[int] = 5
+_LOG_TYPES: Final[Dict[str, float]] = {
+    "tracker": 0.4,
+    "mobile_run": 0.2,
+    "auto_detected": 0.3,
+    "manual": 0.1,
+}
+_ACTIVITY_RESOURCES: Final[list[str]] = [
+    "activityCalories",
+    "calories",
+    "distance",
+    "floors",
+    "minutesSedentary",
+    "minutesLightlyActive",
+    "minutesFairlyActive",
+    "minutesVeryActive",
+    "steps",
+]
+
+
+def _generate_activities(
+    rng: random.Random, start_date: date, end_date: date
+) -> list[Dict[str, Any]]:
+    activities = []
+    day = start_date
+    while day <= end_date:
+        for i in range(rng.choice([0, 0, 1, 1, 2])):
+            log_type = rng.choices(list(_LOG_TYPES), list(_LOG_TYPES.values()))[0]
+            start_time = datetime(day.year, day.month, day.day, 7 + 5 * i)
+            activity = {
+                "logId": day.toordinal() * 10 + i,
+                "logType": log_type,
+                "activityName": rng.choice(["Run", "Walk", "Bike", "Swim"]),
+                "originalStartTime": f"{start_time.isoformat()}.000+01:00",
+                "startTime": f"{start_time.isoformat()}.000+01:00",
+                "duration": rng.randrange(10, 120) * 60 * 1000,
+                "hasGps": log_type in ("mobile_run", "tracker") and rng.random() < 0.7,
+            }
+            if log_type != "manual":
+                activity["source"] = {"type": "tracker", "name": "Charge 5"}
+                activity["averageHeartRate"] = rng.randrange(90, 170)
+                activity["heartRateLink"] = "https://api.fitbit.com/heartrate"
+            activities.append(activity)
+        day += timedelta(days=1)
+    return activities
+
+
+def _get_tcx(activity: Optional[Dict[str, Any]]) -> str:
+    trackpoints = []
+    distance = 0.0
+    # Auto detected and manual activities have no samples.
+    if activity and activity["logType"] in ("tracker", "mobile_run"):
+        start_time = datetime.fromisoformat(activity["startTime"][:19])
+        for i in range(activity["duration"] // 1000 // _TRACKPOINT_INTERVAL):
+            time_ = start_time + timedelta(seconds=i * _TRACKPOINT_INTERVAL)
+            position = ""
+            if activity["hasGps"]:
+                distance = i * _TRACKPOINT_INTERVAL * 2.5
+                position = (
+                    f"<Position><LatitudeDegrees>{45 + i / 1e5:.15f}</LatitudeDegrees>"
+                    f"<LongitudeDegrees>{9 + i / 1e5:.15f}</LongitudeDegrees>"
+                    f"</Position><AltitudeMeters>{100 + i % 20:.1f}</AltitudeMeters>"
+                    f"<DistanceMeters>{distance:.15f}</DistanceMeters>"
+                )
+            trackpoints.append(
+                f"<Trackpoint><Time>{time_.isoformat()}.000+00:00</Time>{position}"
+                f"<HeartRateBpm><Value>{120 + i % 40}</Value></HeartRateBpm>"
+                "</Trackpoint>\n"
+            )
+    start_time_str = activity["startTime"][:19] if activity else ""
+    total_time = activity["duration"] / 1000 if activity else 0
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<TrainingCenterDatabase xmlns="http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2">\n'
+        "<Activities>\n"
+        '<Activity Sport="Running">\n'
+        f"<Id>{start_time_str}.000+00:00</Id>\n"
+        f'<Lap StartTime="{start_time_str}.000+00:00">\n'
+        f"<TotalTimeSeconds>{total_time:.1f}</TotalTimeSeconds>\n"
+        f"<DistanceMeters>{distance:.2f}</DistanceMeters>\n"
+        f"<Calories>{round(total_time / 6)}</Calories>\n"
+        "<Intensity>Active</Intensity>\n"
+        "<TriggerMethod>Manual</TriggerMethod>\n"
+        f"<Track>\n{''.join(trackpoints)}</Track>\n"
+        "</Lap>\n"
+        "</Activity>\n"
+        "</Activities>\n"
+        "</TrainingCenterDatabase>\n"
+    )
+
+
+# Stand-in for the endpoints of the Fitbit Web API used by fitbit2garmin, serving
+# synthetic data between start_date and end_date. It enforces a rate limit of
+# rate_limit requests every rate_interval seconds, sending the same rate limit
+# headers and 429 responses of the real API, and it adds latency seconds to
+# every response. Responses have an ETag and are revalidated with If-None-Match.
+class FakeFitbitServer:
+    def __init__(
+        self,
+        start_date: date,
+        end_date: date,
+        latency: float = 0.0,
+        rate_limit: int = 150,
+        rate_interval: float = 3600,
+        seed: int = 0,
+    ):
+        self.start_date = start_date
+        self.end_date = end_date
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.rate_interval = rate_interval
+        self.stats: collections.Counter = collections.Counter()
+        self._seed = seed
+        self._activities = _generate_activities(
+            random.Random(seed), start_date, end_date
+        )
+        self._activities_by_log_id = {a["logId"]: a for a in self._activities}
+        self._window_reset_ts = 0.0
+        self._window_requests = 0
+        self._runner: Optional[aiohttp.web.AppRunner] = None
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        app = aiohttp.web.Application(middlewares=[self._rate_limit])
+        app.add_routes(
+            [
+                aiohttp.web.post("/oauth2/token", self._token),
+                aiohttp.web.get(
+                    "/1/user/-/activities/list.json", self._activities_list
+                ),
+                aiohttp.web.get(r"/1/user/-/activities/{log_id:\d+}.tcx", self._tcx),
+                aiohttp.web.get(
+                    "/1/user/-/body/log/weight/date/{start}/{end}.json", self._weight
+                ),
+                aiohttp.web.get(
+                    "/1/user/-/body/{resource}/date/{start}/{end}.json",
+                    self._body_timeseries,
+                ),
+                aiohttp.web.get(
+                    "/1/user/-/activities/{resource}/date/{start}/{end}.json",
+                    self._activity_timeseries,
+                ),
+            ]
+        )
+        self._runner = aiohttp.web.AppRunner(app)
+        await self._runner.setup()
+        site = aiohttp.web.TCPSite(self._runner, host, port)
+        await site.start()
+        _, port = self._runner.addresses[0][:2]
+        return f"http://{host}:{port}"
+
+    async def stop(self) -> None:
+        if self._runner:
+            await self._runner.cleanup()
+
+    @aiohttp.web.middleware
+    async def _rate_limit(self, request: aiohttp.web.Request, handler):
+        self.stats["requests"] += 1
+        now = time.time()
+        if now >= self._window_reset_ts:
+            self._window_reset_ts = now + self.rate_interval
+            self._window_requests = 0
+        headers = {
+            "Fitbit-Rate-Limit-Limit": str(self.rate_limit),
+            "Fitbit-Rate-Limit-Remaining": str(
+                max(self.rate_limit - self._window_requests - 1, 0)
+            ),
+            "Fitbit-Rate-Limit-Reset": str(round(self._window_reset_ts - now + 0.5)),
+        }
+        if self._window_requests >= self.rate_limit:
+            self.stats["rate_limited"] += 1
+            return aiohttp.web.Response(status=429, headers=headers)
+        self._window_requests += 1
+        self.stats["served"] += 1
+        self.stats[request.path] += 1
+        await asyncio.sleep(self.latency)
+        response = await handler(request)
+        # Responses are revalidated with their ETag like the ones of a CDN.
+        etag = f'"{hashlib.sha256(response.body).hexdigest()[:16]}"'
+        if request.headers.get("If-None-Match") == etag:
+            self.stats["not_modified"] += 1
+            response = aiohttp.web.Response(status=304)
+        response.headers.update(headers)
+        response.headers["ETag"] = etag
+        return response
+
+    def _get_rng(self, day: date, name: str) -> random.Random:
+        return random.Random(f"{self._seed}-{name}-{day}")
+
+    def _get_days(self, request: aiohttp.web.Request) -> list[date]:
+        start_date = datetime.strptime(request.match_info["start"], _DATE_FORMAT)
+        end_date = datetime.strptime(request.match_info["end"], _DATE_FORMAT)
+        day, days = max(start_date.date(), self.start_date), []
+        while day <= min(end_date.date(), self.end_date):
+            days.append(day)
+            day += timedelta(days=1)
+        return days
+
+    async def _token(self, request: aiohttp.web.Request):
+        return aiohttp.web.json_response(
+            {"access_token": "access", "refresh_token": "refresh", "expires_in": 28800}
+        )
+
+    async def _activities_list(self, request: aiohttp.web.Request):
+        # Only the afterDate with ascending sort is supported.
+        after_date = request.query["afterDate"][:10]
+        offset = int(request.query.get("offset", 0))
+        limit = min(int(request.query.get("limit", _PAGE_SIZE)), _PAGE_SIZE)
+        activities = [
+            a for a in self._activities if a["originalStartTime"][:10] > after_date
+        ]
+        page = activities[offset : offset + limit]
+        next_url = ""
+        if offset + limit < len(activities):
+            next_url = str(request.url.update_query(offset=offset + limit))
+        return aiohttp.web.json_response(
+            {"activities": page, "pagination": {"next": next_url}}
+        )
+
+    async def _tcx(self, request: aiohttp.web.Request):
+        activity = self._activities_by_log_id.get(int(request.match_info["log_id"]))
+        return aiohttp.web.Response(
+            text=_get_tcx(activity), content_type="application/vnd.garmin.tcx+xml"
+        )
+
+    def _get_weight(self, day: date) -> Optional[Dict[str, Any]]:
+        rng = self._get_rng(day, "weight")
+        if rng.random() > 0.3:
+            return None
+        weight = round(70 + 5 * rng.random(), 1)
+        return {
+            "date": str(day),
+            "weight": weight,
+            "bmi": round(weight / 1.8**2, 2),
+            "fat": round(15 + 5 * rng.random(), 1),
+            "logId": day.toordinal(),
+            "source": "Aria",
+        }
+
+    async def _weight(self, request: aiohttp.web.Request):
+        weights = [self._get_weight(day) for day in self._get_days(request)]
+        return aiohttp.web.json_response(
+            {"weight": [weight for weight in weights if weight]}
+        )
+
+    async def _body_timeseries(self, request: aiohttp.web.Request):
+        resource = request.match_info["resource"]
+        values = []
+        for day in self._get_days(request):
+            weight = self._get_weight(day)
+            values.append(
+                {"dateTime": str(day), "value": str(weight[resource] if weight else 0)}
+            )
+        return aiohttp.web.json_response({f"body-{resource}": values})
+
+    async def _activity_timeseries(self, request: aiohttp.web.Request):
+        resource = request.match_info["resource"]
+        if resource not in _ACTIVITY_RESOURCES:
+            raise aiohttp.web.HTTPNotFound()
+        values = []
+        for day in self._get_days(request):
+            rng = self._get_rng(day, resource)
+            values.append({"dateTime": str(day), "value": str(rng.randrange(0, 2000))})
+        return aiohttp.web.json_response({f"activities-{resource}": values})
@@ -0,0 +1,102 @@
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+from typing import Final, Tuple
+
+import click
+
+# Seconds the CLI can take to print its help, including the start of the
+# interpreter, which alone takes a few tens of milliseconds.
+_BUDGET: Final[float] = 0.25
+# Modules only needed by the commands sending requests or converting data,
+# which must not be imported to print the help.
+_LAZY_MODULES: Final[tuple[str, ...]] = (
+    "aiohttp",
+    "asyncio",
+    "dateutil",
+    "fitbit2garmin.commands",
+    "fitbit2garmin.client",
+    "fitbit2garmin.fit_export",
+)
+# e.g. "import time:       543 |     287824 | aiohttp"
+_IMPORT_TIME_PATTERN: Final[re.Pattern] = re.compile(
+    r"^import time:\s*\d+ \|\s*(\d+) \|( *)(\S+)$"
+)
+
+
+def _run_cli(*args: str) -> float:
+    start_ts = time.perf_counter()
+    subprocess.run(
+        [sys.executable, "-m", "fitbit2garmin.cli", *args],
+        check=True,
+        stdout=subprocess.DEVNULL,
+    )
+    return time.perf_counter() - start_ts
+
+
+# Cumulative import time in seconds of the modules imported by the CLI, as
+# reported by python -X importtime, and in total.
+def _get_import_times(*args: str) -> Tuple[dict[str, float], float]:
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-m", "fitbit2garmin.cli", *args],
+        check=True,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    import_times, total = {}, 0.0
+    for line in process.stderr.splitlines():
+        match = _IMPORT_TIME_PATTERN.match(line)
+        if match:
+            import_times[match.group(3)] = int(match.group(1)) / 1e6
+            # The modules imported by other modules are more indented.
+            if len(match.group(2)) == 1:
+                total += import_times[match.group(3)]
+    return import_times, total
+
+
+@click.command(
+    help=(
+        "Check that the CLI prints its help within a startup budget. Other "
+        "arguments can be passed after --, e.g. -- render --help."
+    )
+)
+@click.option("-n", "--runs", type=click.IntRange(min=1), default=10)
+@click.option(
+    "--budget",
+    type=float,
+    default=_BUDGET,
+    help="Maximum median number of seconds to print the help.",
+)
+@click.argument("args", nargs=-1)
+def main(runs: int, budget: float, args: tuple[str, ...]):
+    args = args or ("--help",)
+    _run_cli(*args)  # Warm up the file system caches.
+    wall_time = statistics.median(_run_cli(*args) for _ in range(runs))
+    import_times, total_import_time = _get_import_times(*args)
+    print(f"fitbit2garmin {' '.join(args)}")
+    print(f"  median wall time (s): {wall_time:.3f} (budget {budget:.3f})")
+    print(f"  import time (s): {total_import_time:.3f}")
+    imported = [
+        lazy_module
+        for lazy_module in _LAZY_MODULES
+        if any(
+            module == lazy_module or module.startswith(f"{lazy_module}.")
+            for module in import_times
+        )
+    ]
+    if imported:
+        raise click.ClickException(
+            f"Modules that should be imported lazily were imported: {imported}."
+        )
+    if wall_time > budget:
+        raise click.ClickException(
+            f"The startup took {wall_time:.3f}s, over the {budget:.3f}s budget."
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,31 +1,133 @@
 import asyncio
 import collections
 import contextlib
+import json
+import pathlib
 import socket
+import time
 
 import urllib.parse
 
-from datetime import date, datetime
-from typing import Any, Dict, Final, Optional
+from datetime import date, datetime, timedelta
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    Dict,
+    Final,
+    Iterator,
+    Mapping,
+    NamedTuple,
+    Optional,
+    Tuple,
+)
 
 import aiohttp
-import aiohttp.web
-import asyncio_throttle
-from dateutil.parser import isoparse
 
-from . import fitbit_api
+from . import fitbit_api, garmin_export, metrics
+from .rate_limiter import RateLimiter
+from .response_cache import ResponseCache, iter_blob
 
-_API_RATE_LIMITER: Final[asyncio_throttle.Throttler] = asyncio_throttle.Throttler(
-    rate_limit=1,
-    period=fitbit_api.API_RATE_INTERVAL / fitbit_api.API_RATE_LIMIT,
-    retry_interval=1,
-)
+_API_RATE_LIMITER: Final[RateLimiter] = RateLimiter()
 _FITBIT_CLIENT_ID: Final[str] = "23RBKP"
 _FITBIT_REDIRECT_URI: Final[str] = "http://localhost:8080"
+_CHUNK_SIZE: Final[int] = 64 * 1024
+
+
+# Value of a resource of a timeseries for a given date, both as returned by the
+# API (e.g. "2020-01-01" and "1234").
+class TimeseriesValue(NamedTuple):
+    resource: str
+    date: str
+    value: str
+
+
+def _split_date_range(
+    start_date: date, end_date: date, max_days: int
+) -> Iterator[Tuple[date, date]]:
+    while start_date <= end_date:
+        chunk_end_date = min(start_date + timedelta(days=max_days), end_date)
+        yield start_date, chunk_end_date
+        start_date = chunk_end_date + timedelta(days=1)
+
+
+@contextlib.asynccontextmanager
+async def _request(
+    session: aiohttp.ClientSession,
+    rate_limiter: RateLimiter,
+    method: str,
+    url: str,
+    **kwargs,
+) -> AsyncIterator[aiohttp.ClientResponse]:
+    # Records the time spent waiting for the rate limiter and the latency of the
+    # request, until its response has been read, by endpoint.
+    registry = metrics.get()
+    endpoint = metrics.get_endpoint(url)
+    wait_start = time.perf_counter()
+    async with rate_limiter:
+        registry.record("rate_limiter_wait_seconds", wait_start, endpoint=endpoint)
+        start = time.perf_counter()
+        status = "error"
+        try:
+            async with session.request(method, url, **kwargs) as res:
+                rate_limiter.update(res.status, res.headers)
+                status = str(res.status)
+                try:
+                    yield res
+                finally:
+                    registry.increment(
+                        "response_bytes", res.content.total_bytes, endpoint=endpoint
+                    )
+        except aiohttp.ClientResponseError as err:
+            status = str(err.status)
+            if err.headers is not None:
+                rate_limiter.update(err.status, err.headers)
+            raise
+        finally:
+            registry.record("request_seconds", start, endpoint=endpoint, status=status)
+
+
+async def _get(
+    session: aiohttp.ClientSession,
+    rate_limiter: RateLimiter,
+    url: str,
+    headers: Mapping[str, str],
+    response_cache: Optional[ResponseCache],
+) -> bytes:
+    # Goes through the response cache when given: cached responses are
+    # revalidated with conditional headers, or served without any request in
+    # offline mode.
+    if response_cache is None:
+        async with _request(session, rate_limiter, "GET", url, headers=headers) as res:
+            return await res.read()
+    if response_cache.offline:
+        return response_cache.load(url)
+    headers = {**headers, **response_cache.get_conditional_headers(url)}
+    async with _request(session, rate_limiter, "GET", url, headers=headers) as res:
+        if res.status == 304:
+            return response_cache.load(url)
+        content = await res.read()
+    response_cache.store(url, content, res.headers)
+    return content
+
+
+async def _get_json(
+    session: aiohttp.ClientSession,
+    rate_limiter: RateLimiter,
+    url: str,
+    headers: Mapping[str, str],
+    response_cache: Optional[ResponseCache],
+) -> Any:
+    content = await _get(session, rate_limiter, url, headers, response_cache)
+    with metrics.get().timer("json_parse_seconds", endpoint=metrics.get_endpoint(url)):
+        return json.loads(content)
 
 
 @contextlib.asynccontextmanager
 async def _oauth2_redirect_capture_code(redirect_uri: str):
+    # The server stack is only needed the first time an account is authorized.
+    import aiohttp.web
+
     redirect_uri_parsed = urllib.parse.urlparse(redirect_uri)
     assert redirect_uri_parsed.hostname
     assert redirect_uri_parsed.scheme == "http"
@@ -64,6 +166,7 @@ async def _oauth2_authorize(
     client_id: str,
     redirect_uri: str,
     scope: str,
+    rate_limiter: RateLimiter = _API_RATE_LIMITER,
 ) -> Dict[str, Any]:
     # Generate PKCE code verifier and challenge
     code_verifier = fitbit_api.get_oauth2_authorization_code_verifier()
@@ -90,7 +193,7 @@ async def _oauth2_authorize(
         code=code,
         code_verifier=code_verifier,
     )
-    async with _API_RATE_LIMITER, session.post(url, data=payload) as req:
+    async with _request(session, rate_limiter, "POST", url, data=payload) as req:
         auth = await req.json()
         auth["ts"] = datetime.now().timestamp()
         return auth
@@ -100,6 +203,7 @@ async def _oauth2_refresh(
     session: aiohttp.ClientSession,
     authorization: Dict[str, Any],
     client_id: str,
+    rate_limiter: RateLimiter = _API_RATE_LIMITER,
 ) -> Dict[str, Any]:
     url = fitbit_api.get_oauth2_token_url()
     payload = {
@@ -107,14 +211,18 @@ async def _oauth2_refresh(
         "refresh_token": authorization["refresh_token"],
         "grant_type": "refresh_token",
     }
-    async with _API_RATE_LIMITER, session.post(url, data=payload) as res:
+    async with _request(session, rate_limiter, "POST", url, data=payload) as res:
         auth = await res.json()
         auth["ts"] = datetime.now().timestamp()
         return auth
 
 
 async def execute_oauth2_flow(
-    session: aiohttp.ClientSession, authorization: Optional[Dict[str, Any]]
+    session: aiohttp.ClientSession,
+    authorization: Optional[Dict[str, Any]],
+    rate_limiter: RateLimiter = _API_RATE_LIMITER,
+    expiry_margin: int = 0,
+    force_refresh: bool = False,
 ) -> Dict[str, Any]:
     if not authorization:
         authorization = await _oauth2_authorize(
@@ -123,52 +231,160 @@ async def execute_oauth2_flow(
             redirect_uri=_FITBIT_REDIRECT_URI,
             # https://dev.fitbit.com/build/reference/web-api/developer-guide/application-design/#Scopes
             scope="activity heartrate location weight",
+            rate_limiter=rate_limiter,
         )
-    elif datetime.now() > datetime.fromtimestamp(
-        authorization["ts"] + authorization["expires_in"]
+    elif force_refresh or datetime.now() > datetime.fromtimestamp(
+        authorization["ts"] + authorization["expires_in"] - expiry_margin
     ):
         authorization = await _oauth2_refresh(
-            session, authorization, client_id=_FITBIT_CLIENT_ID
+            session,
+            authorization,
+            client_id=_FITBIT_CLIENT_ID,
+            rate_limiter=rate_limiter,
         )
 
     return authorization
 
 
-async def get_activity_log_list(
+async def get_activity_log_list_page(
+    session: aiohttp.ClientSession,
+    bearer_token: str,
+    url: str,
+    rate_limiter: RateLimiter = _API_RATE_LIMITER,
+    response_cache: Optional[ResponseCache] = None,
+) -> Dict[str, Any]:
+    headers = fitbit_api.get_authorization_headers(bearer_token)
+    return await _get_json(session, rate_limiter, url, headers, response_cache)
+
+
+async def iter_activity_log_list(
     session: aiohttp.ClientSession,
     bearer_token: str,
     start_date: date,
     end_date: date,
-) -> list[Dict[str, Any]]:
-    headers = fitbit_api.get_authorization_headers(bearer_token)
-    url = fitbit_api.get_activity_log_list_url(start_date)
-    activities = []
+    rate_limiter: RateLimiter = _API_RATE_LIMITER,
+    response_cache: Optional[ResponseCache] = None,
+) -> AsyncIterator[Dict[str, Any]]:
+    # The after date is exclusive.
+    url = fitbit_api.get_activity_log_list_url(start_date - timedelta(days=1))
     while url:
-        async with _API_RATE_LIMITER, session.get(url, headers=headers) as res:
-            data = await res.json()
+        data = await get_activity_log_list_page(
+            session,
+            bearer_token,
+            url,
+            rate_limiter=rate_limiter,
+            response_cache=response_cache,
+        )
+        for activity in data["activities"]:
+            activity_date = fitbit_api.get_activity_date(activity)
+            # Only the activities within the dates are kept, like the crawler of
+            # the commands does.
+            if activity_date < start_date:
+                continue
+            if activity_date > end_date:
+                return
+            yield activity
         if not data["activities"]:
             break
-        new_activities = [
-            a
-            for a in data["activities"]
-            if isoparse(a["originalStartTime"]).date() <= end_date
-        ]
-        if not new_activities:
-            break
-        activities.extend(new_activities)
         url = data.get("pagination", {}).get("next", None)
-    return activities
+
+
+async def get_activity_log_list(
+    session: aiohttp.ClientSession,
+    bearer_token: str,
+    start_date: date,
+    end_date: date,
+    rate_limiter: RateLimiter = _API_RATE_LIMITER,
+    response_cache: Optional[ResponseCache] = None,
+) -> list[Dict[str, Any]]:
+    return [
+        activity
+        async for activity in iter_activity_log_list(
+            session,
+            bearer_token,
+            start_date,
+            end_date,
+            rate_limiter=rate_limiter,
+            response_cache=response_cache,
+        )
+    ]
 
 
 async def get_activity_tcx(
     session: aiohttp.ClientSession,
     bearer_token: str,
     log_id: int,
+    rate_limiter: RateLimiter = _API_RATE_LIMITER,
+    response_cache: Optional[ResponseCache] = None,
 ) -> bytes:
     headers = fitbit_api.get_authorization_headers(bearer_token)
     url = fitbit_api.get_activity_tcx_url(log_id)
-    async with _API_RATE_LIMITER, session.get(url, headers=headers) as res:
-        return await res.read()
+    return await _get(session, rate_limiter, url, headers, response_cache)
+
+
+async def _write_cached_activity_tcx(
+    response_cache: ResponseCache, url: str, file_path: pathlib.Path
+) -> Optional[str]:
+    # The cached tcx is decompressed in chunks rather than loaded in memory.
+    blob_path = response_cache.load_blob_path(url)
+    return await asyncio.get_running_loop().run_in_executor(
+        None, garmin_export.write_tcx_chunks, iter_blob(blob_path), file_path
+    )
+
+
+async def download_activity_tcx(
+    session: aiohttp.ClientSession,
+    bearer_token: str,
+    log_id: int,
+    file_path: pathlib.Path,
+    rate_limiter: RateLimiter = _API_RATE_LIMITER,
+    response_cache: Optional[ResponseCache] = None,
+) -> Optional[str]:
+    # Streams the tcx to a temporary file which is moved to file_path once
+    # complete. Returns the sha256 of the tcx, or None if it has no trackpoints,
+    # in which case no file is created.
+    headers = fitbit_api.get_authorization_headers(bearer_token)
+    url = fitbit_api.get_activity_tcx_url(log_id)
+    loop = asyncio.get_running_loop()
+    if response_cache is not None:
+        if response_cache.offline:
+            return await _write_cached_activity_tcx(response_cache, url, file_path)
+        headers = {**headers, **response_cache.get_conditional_headers(url)}
+    with contextlib.ExitStack() as stack:
+        async with _request(session, rate_limiter, "GET", url, headers=headers) as res:
+            if res.status == 304:
+                assert response_cache
+                return await _write_cached_activity_tcx(response_cache, url, file_path)
+            writer = stack.enter_context(garmin_export.TcxWriter(file_path))
+            async for chunk in res.content.iter_chunked(_CHUNK_SIZE):
+                await loop.run_in_executor(None, writer.write, chunk)
+        await loop.run_in_executor(None, writer.close)
+        # Empty tcxs are cached as well, so that they are known to be empty
+        # offline.
+        if response_cache is not None:
+            await loop.run_in_executor(
+                None,
+                response_cache.write_blob,
+                writer.content_hash,
+                writer.temp_file_path,
+            )
+            response_cache.add(url, writer.content_hash, res.headers)
+        return writer.commit()
+
+
+async def iter_weight_timeseries(
+    session: aiohttp.ClientSession,
+    bearer_token: str,
+    start_date: date,
+    end_date: date,
+    rate_limiter: RateLimiter = _API_RATE_LIMITER,
+    response_cache: Optional[ResponseCache] = None,
+) -> AsyncIterator[Dict[str, Any]]:
+    headers = fitbit_api.get_authorization_headers(bearer_token)
+    url = fitbit_api.get_weight_timeseries_url(start_date, end_date)
+    data = await _get_json(session, rate_limiter, url, headers, response_cache)
+    for weight in data["weight"]:
+        yield weight
 
 
 async def get_weight_timeseries(
@@ -176,12 +392,124 @@ async def get_weight_timeseries(
     bearer_token: str,
     start_date: date,
     end_date: date,
+    rate_limiter: RateLimiter = _API_RATE_LIMITER,
+    response_cache: Optional[ResponseCache] = None,
 ) -> list[Dict[str, Any]]:
+    return [
+        weight
+        async for weight in iter_weight_timeseries(
+            session,
+            bearer_token,
+            start_date,
+            end_date,
+            rate_limiter=rate_limiter,
+            response_cache=response_cache,
+        )
+    ]
+
+
+async def _iter_timeseries(
+    session: aiohttp.ClientSession,
+    bearer_token: str,
+    start_date: date,
+    end_date: date,
+    resources: list[str],
+    get_max_days: Callable[[str], int],
+    get_url: Callable[[str, date, date], str],
+    prefix: str,
+    rate_limiter: RateLimiter,
+    response_cache: Optional[ResponseCache],
+) -> AsyncIterator[TimeseriesValue]:
     headers = fitbit_api.get_authorization_headers(bearer_token)
-    url = fitbit_api.get_weight_timeseries_url(start_date, end_date)
-    async with _API_RATE_LIMITER, session.get(url, headers=headers) as res:
-        data = await res.json()
-    return list(data["weight"])
+    for resource in resources:
+        # Fetch each resource using the widest date ranges the API accepts.
+        max_days = get_max_days(resource)
+        for chunk_start_date, chunk_end_date in _split_date_range(
+            start_date, end_date, max_days
+        ):
+            url = get_url(resource, chunk_start_date, chunk_end_date)
+            data = await _get_json(session, rate_limiter, url, headers, response_cache)
+            for value in data[f"{prefix}-{resource}"]:
+                yield TimeseriesValue(resource, value["dateTime"], value["value"])
+
+
+def _merge_timeseries_values(
+    values: list[TimeseriesValue],
+) -> list[Dict[str, Any]]:
+    # Merges the values of the resources into a record per date.
+    record_by_date: Dict[str, dict] = collections.defaultdict(dict)
+    for value in values:
+        record_by_date[value.date][value.resource] = value.value
+    for record_date, record in record_by_date.items():
+        record["date"] = record_date
+    return list(record_by_date.values())
+
+
+def iter_body_timeseries(
+    session: aiohttp.ClientSession,
+    bearer_token: str,
+    start_date: date,
+    end_date: date,
+    rate_limiter: RateLimiter = _API_RATE_LIMITER,
+    response_cache: Optional[ResponseCache] = None,
+) -> AsyncIterator[TimeseriesValue]:
+    return _iter_timeseries(
+        session,
+        bearer_token,
+        start_date,
+        end_date,
+        fitbit_api.get_body_timeseries_resources(),
+        fitbit_api.get_body_timeseries_max_days,
+        fitbit_api.get_body_timeseries_url,
+        "body",
+        rate_limiter,
+        response_cache,
+    )
+
+
+async def get_body_timeseries(
+    session: aiohttp.ClientSession,
+    bearer_token: str,
+    start_date: date,
+    end_date: date,
+    rate_limiter: RateLimiter = _API_RATE_LIMITER,
+    response_cache: Optional[ResponseCache] = None,
+) -> list[Dict[str, Any]]:
+    return _merge_timeseries_values(
+        [
+            value
+            async for value in iter_body_timeseries(
+                session,
+                bearer_token,
+                start_date,
+                end_date,
+                rate_limiter=rate_limiter,
+                response_cache=response_cache,
+            )
+        ]
+    )
+
+
+def iter_activity_timeseries(
+    session: aiohttp.ClientSession,
+    bearer_token: str,
+    start_date: date,
+    end_date: date,
+    rate_limiter: RateLimiter = _API_RATE_LIMITER,
+    response_cache: Optional[ResponseCache] = None,
+) -> AsyncIterator[TimeseriesValue]:
+    return _iter_timeseries(
+        session,
+        bearer_token,
+        start_date,
+        end_date,
+        fitbit_api.get_activity_timeseries_resources(),
+        fitbit_api.get_activity_timeseries_max_days,
+        fitbit_api.get_activity_timeseries_url,
+        "activities",
+        rate_limiter,
+        response_cache,
+    )
 
 
 async def get_activity_timeseries(
@@ -189,15 +517,19 @@ async def get_activity_timeseries(
     bearer_token: str,
     start_date: date,
     end_date: date,
+    rate_limiter: RateLimiter = _API_RATE_LIMITER,
+    response_cache: Optional[ResponseCache] = None,
 ) -> list[Dict[str, Any]]:
-    headers = fitbit_api.get_authorization_headers(bearer_token)
-    activity_by_date: Dict[str, dict] = collections.defaultdict(dict)
-    for resource in fitbit_api.get_activity_timeseries_resources():
-        url = fitbit_api.get_activity_timeseries_url(resource, start_date, end_date)
-        async with _API_RATE_LIMITER, session.get(url, headers=headers) as res:
-            data = await res.json()
-        for activity in data[f"activities-{resource}"]:
-            activity_by_date[activity["dateTime"]][resource] = activity["value"]
-    for activity_date, activity in activity_by_date.items():
-        activity["date"] = activity_date
-    return list(activity_by_date.values())
+    return _merge_timeseries_values(
+        [
+            value
+            async for value in iter_activity_timeseries(
+                session,
+                bearer_token,
+                start_date,
+                end_date,
+                rate_limiter=rate_limiter,
+                response_cache=response_cache,
+            )
+        ]
+    )
@@ -0,0 +1,126 @@
+import logging
+import pathlib
+import zipfile
+
+from datetime import date
+from typing import Final, Optional, Tuple
+
+from dateutil.relativedelta import relativedelta
+
+_BUNDLE_DIRECTORY_NAME: Final[str] = "bundles"
+_MAX_MONTHS: Final[int] = 12
+_MAX_SIZE: Final[int] = 25 * 1024 * 1024
+# Lines of the csv files before the entries, i.e. the title and the header.
+_CSV_HEADER_LINES: Final[int] = 2
+
+
+def _get_date_range(file_path: pathlib.Path, prefix: str) -> Tuple[date, date]:
+    # e.g. "weight.2020-01-01-2020-01-31.csv"
+    date_range = file_path.name[len(prefix) + 1 : -len(file_path.suffix)]
+    return date.fromisoformat(date_range[:10]), date.fromisoformat(date_range[11:])
+
+
+# Merges the files written by the dump commands into fewer, bigger files for
+# the Garmin Connect importer, stored in the "bundles" subdirectory:
+#  - the monthly csv files are merged into bundles of up to max_months months
+#    of the same period (e.g. a calendar year for 12) and up to max_size bytes;
+#  - the tcx files are packed into zip files of up to max_size bytes.
+# Bundles are updated as soon as the files they contain are written, hence the
+# export can be uploaded at any time.
+class Bundler:
+    def __init__(
+        self,
+        directory: pathlib.Path,
+        max_months: int = _MAX_MONTHS,
+        max_size: int = _MAX_SIZE,
+    ):
+        self._directory = directory
+        self._bundle_directory = directory / _BUNDLE_DIRECTORY_NAME
+        self._max_months = max_months
+        self._max_size = max_size
+        self._bundled_tcxs: Optional[set[str]] = None
+
+    def add_csv(self, kind: str, start_date_range: date) -> None:
+        # Rebuilds the bundles of the period containing the given month.
+        self._bundle_directory.mkdir(parents=True, exist_ok=True)
+        month = start_date_range.year * 12 + start_date_range.month - 1
+        month -= month % self._max_months
+        start_date_period = date(month // 12, month % 12 + 1, 1)
+        end_date_period = start_date_period + relativedelta(
+            months=self._max_months, days=-1
+        )
+
+        def in_period(file_path: pathlib.Path) -> bool:
+            start_date, _ = _get_date_range(file_path, kind)
+            return start_date_period <= start_date <= end_date_period
+
+        for bundle_path in filter(
+            in_period, self._bundle_directory.glob(f"{kind}.*.csv")
+        ):
+            bundle_path.unlink()
+        header: list[str] = []
+        lines: list[str] = []
+        start_date_bundle: Optional[date] = None
+        end_date_bundle: Optional[date] = None
+        size = 0
+        for file_path in sorted(
+            filter(in_period, self._directory.glob(f"{kind}.*.csv"))
+        ):
+            start_date, end_date = _get_date_range(file_path, kind)
+            with file_path.open("r") as fr:
+                file_lines = fr.readlines()
+            header = file_lines[:_CSV_HEADER_LINES]
+            file_size = sum(map(len, file_lines[_CSV_HEADER_LINES:]))
+            if lines and size + file_size > self._max_size:
+                assert start_date_bundle and end_date_bundle
+                self._write_csv_bundle(
+                    kind, start_date_bundle, end_date_bundle, header, lines
+                )
+                lines, size = [], 0
+            if not lines:
+                start_date_bundle = start_date
+                size = sum(map(len, header))
+            lines.extend(file_lines[_CSV_HEADER_LINES:])
+            end_date_bundle = end_date
+            size += file_size
+        if lines:
+            assert start_date_bundle and end_date_bundle
+            self._write_csv_bundle(
+                kind, start_date_bundle, end_date_bundle, header, lines
+            )
+
+    def add_tcx(self, file_path: pathlib.Path) -> None:
+        # Appends the tcx to the last zip file, or to a new one once full. Tcxs
+        # already packed are not added again.
+        self._bundle_directory.mkdir(parents=True, exist_ok=True)
+        zip_paths = sorted(self._bundle_directory.glob("exercises.*.zip"))
+        if self._bundled_tcxs is None:
+            self._bundled_tcxs = set()
+            for zip_path in zip_paths:
+                with zipfile.ZipFile(zip_path) as archive:
+                    self._bundled_tcxs.update(archive.namelist())
+        if file_path.name in self._bundled_tcxs:
+            return
+        if not zip_paths or (
+            zip_paths[-1].stat().st_size + file_path.stat().st_size > self._max_size
+        ):
+            zip_paths.append(
+                self._bundle_directory / f"exercises.{len(zip_paths) + 1:03d}.zip"
+            )
+            logging.info(f"Packing the tcxs into {zip_paths[-1].name}.")
+        with zipfile.ZipFile(zip_paths[-1], "a", zipfile.ZIP_DEFLATED) as archive:
+            archive.write(file_path, file_path.name)
+        self._bundled_tcxs.add(file_path.name)
+
+    def _write_csv_bundle(
+        self,
+        kind: str,
+        start_date: date,
+        end_date: date,
+        header: list[str],
+        lines: list[str],
+    ) -> None:
+        bundle_path = self._bundle_directory / f"{kind}.{start_date}-{end_date}.csv"
+        with bundle_path.open("w") as fw:
+            fw.writelines(header)
+            fw.writelines(lines)
@@ -1,13 +1,28 @@
-import asyncio
+import contextlib
 import functools
 import logging
 import pathlib
 
-from datetime import date
+from datetime import date, timedelta
+from typing import TYPE_CHECKING, Any, Dict, Final, Literal, Optional, Tuple
 
 import click
 
-from . import commands
+# The modules running the commands (and aiohttp with them) are only imported by
+# the commands using them, so that --help and the commands working from the
+# cache alone start quickly.
+if TYPE_CHECKING:
+    from .bundler import Bundler
+    from .client import FitbitClient
+    from .fit_export import FitConverter
+    from .journal import Journal
+    from .scheduler import Scheduler
+
+_PROFILE_FILE_NAME: Final[str] = ".profile.pstats"
+_TRACE_FILE_NAME: Final[str] = ".trace.json"
+# Added to the priorities of the backfill of serve, so that the requests of the
+# syncs are sent first.
+_BACKFILL_PRIORITY: Final[int] = 100
 
 
 class ClickDate(click.DateTime):
@@ -20,9 +35,44 @@ class ClickDate(click.DateTime):
         return "Date"
 
 
+# Writes the metrics of a run of the command into its cache directory (the
+# folder of the manifest for dump-many), along with a cProfile or trace event
+# file when profiling is enabled.
+def instrumented(func):
+    @functools.wraps(func)
+    def wrapper(**kwargs):
+        import cProfile
+
+        from . import metrics
+
+        directory = kwargs.get("cache_directory") or kwargs["manifest"].parent
+        profile = click.get_current_context().obj["profile"]
+        registry = metrics.get()
+        profiler = cProfile.Profile() if profile == "cprofile" else None
+        if profile == "trace":
+            registry.start_trace()
+        if profiler:
+            profiler.enable()
+        try:
+            func(**kwargs)
+        finally:
+            if profiler:
+                profiler.disable()
+                directory.mkdir(parents=True, exist_ok=True)
+                profiler.dump_stats(directory / _PROFILE_FILE_NAME)
+            if profile == "trace":
+                registry.write_trace(directory / _TRACE_FILE_NAME)
+            registry.write(directory)
+
+    return wrapper
+
+
 def async_main(func):
+    @instrumented
     @functools.wraps(func)
     def wrapper(**kwargs):
+        import asyncio
+
         loop = asyncio.new_event_loop()
         loop.run_until_complete(func(**kwargs))
 
@@ -30,8 +80,153 @@ def async_main(func):
 
 
 @click.group()
-def cli():
-    pass
+@click.option(
+    "--max-attempts",
+    type=click.IntRange(min=1),
+    default=8,
+    help="Number of attempts after which a request is given up.",
+)
+@click.option(
+    "--max-retry-delay",
+    type=click.FloatRange(min=0),
+    default=300,
+    help="Maximum number of seconds to wait before retrying a request.",
+)
+@click.option(
+    "--breaker-threshold",
+    type=click.IntRange(min=1),
+    default=5,
+    help="Number of consecutive failed requests after which requests are paused.",
+)
+@click.option(
+    "--breaker-cooldown",
+    type=click.FloatRange(min=0),
+    default=300,
+    help="Number of seconds requests are paused for.",
+)
+@click.option(
+    "--response-cache-size",
+    type=click.IntRange(min=0),
+    default=1024,
+    help="Maximum size in MiB of the cached API responses, 0 to disable the cache.",
+)
+@click.option(
+    "--offline",
+    is_flag=True,
+    help="Render the data from the cached API responses without any request.",
+)
+@click.option(
+    "--layout",
+    type=click.Choice(["monthly", "bundled"]),
+    default="monthly",
+    help="Also bundle the exported files into fewer files to upload.",
+)
+@click.option(
+    "--bundle-months",
+    type=click.IntRange(min=1),
+    default=12,
+    help="Maximum number of months of a bundled csv file.",
+)
+@click.option(
+    "--bundle-size",
+    type=click.IntRange(min=1),
+    default=25,
+    help="Maximum size in MiB of a bundled file.",
+)
+@click.option(
+    "--exercise-format",
+    type=click.Choice(["tcx", "fit"]),
+    default="tcx",
+    help="Format of the exercise files, fit files being several times smaller.",
+)
+@click.option(
+    "--verify-fit",
+    is_flag=True,
+    help="Check the trackpoints and totals of every fit file against its tcx.",
+)
+@click.option(
+    "--profile",
+    type=click.Choice(["cprofile", "trace"]),
+    default=None,
+    help=(
+        "Profile the run into the cache directory, with cProfile (.profile.pstats) "
+        "or as trace events (.trace.json, see chrome://tracing)."
+    ),
+)
+@click.pass_context
+def cli(
+    ctx: click.Context,
+    max_attempts: int,
+    max_retry_delay: float,
+    breaker_threshold: int,
+    breaker_cooldown: float,
+    response_cache_size: int,
+    offline: bool,
+    layout: Literal["monthly", "bundled"],
+    bundle_months: int,
+    bundle_size: int,
+    exercise_format: Literal["tcx", "fit"],
+    verify_fit: bool,
+    profile: Optional[Literal["cprofile", "trace"]],
+):
+    if offline and response_cache_size == 0:
+        raise click.UsageError("--offline requires the response cache.")
+    ctx.obj = {
+        "client": {
+            "response_cache_size": response_cache_size * 1024 * 1024,
+            "offline": offline,
+        },
+        "retry_policy": {
+            "max_attempts": max_attempts,
+            "max_delay": max_retry_delay,
+            "breaker_threshold": breaker_threshold,
+            "breaker_cooldown": breaker_cooldown,
+        },
+        "bundler": (
+            {"max_months": bundle_months, "max_size": bundle_size * 1024 * 1024}
+            if layout == "bundled"
+            else None
+        ),
+        "converter": {"verify": verify_fit} if exercise_format == "fit" else None,
+        "profile": profile,
+    }
+
+
+# The retry policy (and its circuit breaker) is shared by all the clients.
+def _get_client_options() -> Dict[str, Any]:
+    from .retry import RetryPolicy
+
+    options = click.get_current_context().obj["client"]
+    if "retry_policy" not in options:
+        retry_policy = click.get_current_context().obj["retry_policy"]
+        options["retry_policy"] = RetryPolicy(**retry_policy)
+    return options
+
+
+def _get_client(cache_directory: pathlib.Path) -> "FitbitClient":
+    from .client import FitbitClient
+
+    return FitbitClient(cache_directory, **_get_client_options())
+
+
+def _get_bundler(directory: pathlib.Path) -> Optional["Bundler"]:
+    from .bundler import Bundler
+
+    options = click.get_current_context().obj["bundler"]
+    return Bundler(directory, **options) if options is not None else None
+
+
+# The process pool converting the exercises is started by the first command
+# using it, and shut down when the CLI exits.
+def _get_converter() -> Optional["FitConverter"]:
+    from .fit_export import FitConverter
+
+    ctx = click.get_current_context().find_root()
+    options = ctx.obj["converter"]
+    if options is None or isinstance(options, FitConverter):
+        return options
+    ctx.obj["converter"] = ctx.with_resource(FitConverter(**options))
+    return ctx.obj["converter"]
 
 
 @cli.command(help="Dump activities' tcx")
@@ -54,14 +249,39 @@ def cli():
     type=ClickDate(formats=["%Y-%m-%d"]),
     default=str(date.today()),
 )
+@click.option("-w", "--workers", type=click.IntRange(min=1), default=4)
+@click.option(
+    "--verify-skips",
+    is_flag=True,
+    help="Download the tcxs predicted to be empty to check the predictions.",
+)
 @async_main
 async def dump_activity_tcx(
     cache_directory: pathlib.Path,
     directory: pathlib.Path,
     start_date: date,
     end_date: date,
+    workers: int,
+    verify_skips: bool,
 ):
-    await commands.dump_activity_tcx(cache_directory, directory, start_date, end_date)
+    from . import commands
+    from .journal import Journal
+
+    with Journal(cache_directory) as journal:
+        async with _get_client(cache_directory) as client:
+            await commands.dump_activity_tcx(
+                client,
+                journal,
+                cache_directory,
+                directory,
+                start_date,
+                end_date,
+                num_workers=workers,
+                verify_skips=verify_skips,
+                refresh=client.offline,
+                bundler=_get_bundler(directory),
+                converter=_get_converter(),
+            )
 
 
 @cli.command(help="Dump weight log")
@@ -84,14 +304,35 @@ async def dump_activity_tcx(
     type=ClickDate(formats=["%Y-%m-%d"]),
     default=str(date.today()),
 )
+@click.option(
+    "--weight-source",
+    type=click.Choice(["log", "timeseries"]),
+    default="log",
+)
 @async_main
 async def dump_weight(
     cache_directory: pathlib.Path,
     directory: pathlib.Path,
     start_date: date,
     end_date: date,
+    weight_source: Literal["log", "timeseries"],
 ):
-    await commands.dump_weight(cache_directory, directory, start_date, end_date)
+    from . import commands
+    from .journal import Journal
+
+    with Journal(cache_directory) as journal:
+        async with _get_client(cache_directory) as client:
+            await commands.dump_weight(
+                client,
+                journal,
+                cache_directory,
+                directory,
+                start_date,
+                end_date,
+                source=weight_source,
+                refresh=client.offline,
+                bundler=_get_bundler(directory),
+            )
 
 
 @cli.command(help="Dump activity log")
@@ -121,7 +362,21 @@ async def dump_activity(
     start_date: date,
     end_date: date,
 ):
-    await commands.dump_activity(cache_directory, directory, start_date, end_date)
+    from . import commands
+    from .journal import Journal
+
+    with Journal(cache_directory) as journal:
+        async with _get_client(cache_directory) as client:
+            await commands.dump_activity(
+                client,
+                journal,
+                cache_directory,
+                directory,
+                start_date,
+                end_date,
+                refresh=client.offline,
+                bundler=_get_bundler(directory),
+            )
 
 
 @cli.command(help="Dump all data")
@@ -144,21 +399,715 @@ async def dump_activity(
     type=ClickDate(formats=["%Y-%m-%d"]),
     default=str(date.today()),
 )
+@click.option(
+    "--weight-source",
+    type=click.Choice(["log", "timeseries"]),
+    default="log",
+)
+@click.option("-w", "--workers", type=click.IntRange(min=1), default=4)
+@click.option(
+    "--verify-skips",
+    is_flag=True,
+    help="Download the tcxs predicted to be empty to check the predictions.",
+)
+@click.option(
+    "-p",
+    "--priority",
+    "priorities",
+    type=(click.Choice(["weight", "activity", "tcx"]), int),
+    multiple=True,
+    help="Priority of a kind of data, lower values are fetched first.",
+)
 @async_main
 async def dump_all(
     cache_directory: pathlib.Path,
     directory: pathlib.Path,
     start_date: date,
     end_date: date,
+    weight_source: Literal["log", "timeseries"],
+    workers: int,
+    verify_skips: bool,
+    priorities: list[Tuple[str, int]],
+):
+    from .journal import Journal
+
+    with Journal(cache_directory) as journal:
+        async with _get_client(cache_directory) as client:
+            scheduler = _get_dump_all_scheduler(
+                client,
+                journal,
+                cache_directory,
+                directory,
+                start_date,
+                end_date,
+                weight_source,
+                workers,
+                verify_skips,
+                priorities,
+                _get_bundler(directory),
+            )
+            await scheduler.run()
+
+
+# Priority of each kind of data, lower values being fetched first.
+def _get_priority(priorities: list[Tuple[str, int]], offset: int = 0) -> Dict[str, int]:
+    priority = {"weight": 0, "activity": 0, "tcx": 1, **dict(priorities)}
+    return {kind: offset + value for kind, value in priority.items()}
+
+
+def _get_dump_all_scheduler(
+    client: "FitbitClient",
+    journal: "Journal",
+    cache_directory: pathlib.Path,
+    directory: pathlib.Path,
+    start_date: date,
+    end_date: date,
+    weight_source: Literal["log", "timeseries"],
+    workers: int,
+    verify_skips: bool,
+    priorities: list[Tuple[str, int]],
+    bundler: Optional["Bundler"],
+    priority_offset: int = 0,
+) -> "Scheduler":
+    from . import commands
+    from .scheduler import Scheduler
+
+    priority = _get_priority(priorities, priority_offset)
+    scheduler = Scheduler(client.rate_limiter)
+    scheduler.add(
+        "weight",
+        priority["weight"],
+        functools.partial(
+            commands.dump_weight,
+            client,
+            journal,
+            cache_directory,
+            directory,
+            start_date,
+            end_date,
+            source=weight_source,
+            refresh=client.offline,
+            bundler=bundler,
+        ),
+    )
+    scheduler.add(
+        "activity",
+        priority["activity"],
+        functools.partial(
+            commands.dump_activity,
+            client,
+            journal,
+            cache_directory,
+            directory,
+            start_date,
+            end_date,
+            refresh=client.offline,
+            bundler=bundler,
+        ),
+    )
+    scheduler.add(
+        "tcx",
+        priority["tcx"],
+        functools.partial(
+            commands.dump_activity_tcx,
+            client,
+            journal,
+            cache_directory,
+            directory,
+            start_date,
+            end_date,
+            num_workers=workers,
+            verify_skips=verify_skips,
+            refresh=client.offline,
+            bundler=bundler,
+            converter=_get_converter(),
+        ),
+    )
+    return scheduler
+
+
+@cli.command(help="Dump all data of several accounts")
+@click.option(
+    "-m",
+    "--manifest",
+    type=click.Path(exists=True, dir_okay=False, path_type=pathlib.Path),
+    required=True,
+    help='JSON list of the accounts, e.g. [{"name": "alice", "start_date": '
+    '"2020-01-01"}], with optional "cache_directory", "directory" and "end_date".',
+)
+@click.option(
+    "-s",
+    "--start-date",
+    type=ClickDate(formats=["%Y-%m-%d"]),
+    default=None,
+    help="Date to start from, for the accounts not setting their own.",
+)
+@click.option(
+    "-e",
+    "--end-date",
+    type=ClickDate(formats=["%Y-%m-%d"]),
+    default=str(date.today()),
+)
+@click.option(
+    "--weight-source",
+    type=click.Choice(["log", "timeseries"]),
+    default="log",
+)
+@click.option("-w", "--workers", type=click.IntRange(min=1), default=4)
+@click.option(
+    "--verify-skips",
+    is_flag=True,
+    help="Download the tcxs predicted to be empty to check the predictions.",
+)
+@click.option(
+    "-p",
+    "--priority",
+    "priorities",
+    type=(click.Choice(["weight", "activity", "tcx"]), int),
+    multiple=True,
+    help="Priority of a kind of data, lower values are fetched first.",
+)
+@click.option(
+    "--connections",
+    type=click.IntRange(min=1),
+    default=16,
+    help="Number of connections shared by all the accounts.",
+)
+@async_main
+async def dump_many(
+    manifest: pathlib.Path,
+    start_date: Optional[date],
+    end_date: date,
+    weight_source: Literal["log", "timeseries"],
+    workers: int,
+    verify_skips: bool,
+    priorities: list[Tuple[str, int]],
+    connections: int,
+):
+    from . import commands
+    from .client import FitbitClient, create_session
+    from .journal import Journal
+    from .rate_limiter import FairShare
+    from .scheduler import Scheduler, run_all
+
+    try:
+        accounts = commands.load_manifest(manifest)
+    except (KeyError, TypeError, ValueError) as err:
+        raise click.BadParameter(f"Invalid manifest: {err!r}", param_hint="-m")
+    if any(account.start_date is None for account in accounts) and not start_date:
+        raise click.UsageError("Accounts without a start date require -s.")
+    # Every account has its own rate limit, while the connections are shared
+    # fairly between all of them.
+    share = FairShare(connections)
+    async with contextlib.AsyncExitStack() as stack:
+        session = await stack.enter_async_context(create_session(connections))
+        schedulers: Dict[str, "Scheduler"] = {}
+        for account in accounts:
+            journal = stack.enter_context(Journal(account.cache_directory))
+            client = await stack.enter_async_context(
+                FitbitClient(
+                    account.cache_directory,
+                    session=session,
+                    share=share,
+                    **_get_client_options(),
+                )
+            )
+            if not client.offline:
+                # Log into the accounts one at a time before starting.
+                logging.info(f"Authorizing {account.name}.")
+                await client.get_bearer_token()
+            account_start_date = account.start_date or start_date
+            assert account_start_date
+            schedulers[account.name] = _get_dump_all_scheduler(
+                client,
+                journal,
+                account.cache_directory,
+                account.directory,
+                account_start_date,
+                account.end_date or end_date,
+                weight_source,
+                workers,
+                verify_skips,
+                priorities,
+                _get_bundler(account.directory),
+            )
+        await run_all(schedulers)
+
+
+@cli.command(help="Sync the data fetched since the last sync")
+@click.option(
+    "-c",
+    "--cache-directory",
+    type=click.Path(file_okay=True, path_type=pathlib.Path),
+    default=".cache",
+)
+@click.option(
+    "-d",
+    "--directory",
+    type=click.Path(file_okay=True, path_type=pathlib.Path),
+    default="f2g",
+)
+@click.option(
+    "-s",
+    "--start-date",
+    type=ClickDate(formats=["%Y-%m-%d"]),
+    default=None,
+    help="Date to start from, only used by the first sync.",
+)
+@click.option(
+    "-e",
+    "--end-date",
+    type=ClickDate(formats=["%Y-%m-%d"]),
+    default=str(date.today()),
+)
+@click.option(
+    "--recheck-days",
+    type=click.IntRange(min=0),
+    default=7,
+    help="Number of days before the last sync to fetch again.",
+)
+@click.option(
+    "--weight-source",
+    type=click.Choice(["log", "timeseries"]),
+    default="log",
+)
+@click.option("-w", "--workers", type=click.IntRange(min=1), default=4)
+@click.option(
+    "-p",
+    "--priority",
+    "priorities",
+    type=(click.Choice(["weight", "activity", "tcx"]), int),
+    multiple=True,
+    help="Priority of a kind of data, lower values are fetched first.",
+)
+@async_main
+async def sync(
+    cache_directory: pathlib.Path,
+    directory: pathlib.Path,
+    start_date: Optional[date],
+    end_date: date,
+    recheck_days: int,
+    weight_source: Literal["log", "timeseries"],
+    workers: int,
+    priorities: list[Tuple[str, int]],
+):
+    from .journal import Journal
+
+    if click.get_current_context().obj["client"]["offline"]:
+        raise click.UsageError("sync cannot run offline.")
+    with Journal(cache_directory) as journal:
+        start_dates = _get_sync_start_dates(journal, start_date, recheck_days)
+        async with _get_client(cache_directory) as client:
+            scheduler = _get_sync_scheduler(
+                client,
+                journal,
+                cache_directory,
+                directory,
+                start_dates,
+                end_date,
+                recheck_days,
+                weight_source,
+                workers,
+                priorities,
+                _get_bundler(directory),
+            )
+            await scheduler.run()
+
+
+def _get_sync_start_dates(
+    journal: "Journal", start_date: Optional[date], recheck_days: int
+) -> Dict[str, date]:
+    from . import commands
+
+    start_dates: Dict[str, date] = {}
+    for kind in ("weight", "activity", "tcx"):
+        sync_start_date = commands.get_sync_start_date(
+            journal, kind, start_date, recheck_days, align_to_month=kind != "tcx"
+        )
+        if sync_start_date is None:
+            raise click.UsageError("The first sync requires a start date.")
+        start_dates[kind] = sync_start_date
+    return start_dates
+
+
+def _get_sync_scheduler(
+    client: "FitbitClient",
+    journal: "Journal",
+    cache_directory: pathlib.Path,
+    directory: pathlib.Path,
+    start_dates: Dict[str, date],
+    end_date: date,
+    recheck_days: int,
+    weight_source: Literal["log", "timeseries"],
+    workers: int,
+    priorities: list[Tuple[str, int]],
+    bundler: Optional["Bundler"],
+) -> "Scheduler":
+    from . import commands
+    from .scheduler import Scheduler
+
+    recheck_start_dates = {
+        kind: commands.get_recheck_start_date(journal, kind, end_date, recheck_days)
+        for kind in start_dates
+    }
+    priority = _get_priority(priorities)
+    scheduler = Scheduler(client.rate_limiter)
+    scheduler.add(
+        "weight",
+        priority["weight"],
+        functools.partial(
+            commands.sync,
+            journal,
+            "weight",
+            end_date,
+            functools.partial(
+                commands.dump_weight,
+                client,
+                journal,
+                cache_directory,
+                directory,
+                start_dates["weight"],
+                end_date,
+                source=weight_source,
+                recheck_start_date=recheck_start_dates["weight"],
+                bundler=bundler,
+            ),
+        ),
+    )
+    scheduler.add(
+        "activity",
+        priority["activity"],
+        functools.partial(
+            commands.sync,
+            journal,
+            "activity",
+            end_date,
+            functools.partial(
+                commands.dump_activity,
+                client,
+                journal,
+                cache_directory,
+                directory,
+                start_dates["activity"],
+                end_date,
+                recheck_start_date=recheck_start_dates["activity"],
+                bundler=bundler,
+            ),
+        ),
+    )
+    scheduler.add(
+        "tcx",
+        priority["tcx"],
+        functools.partial(
+            commands.sync,
+            journal,
+            "tcx",
+            end_date,
+            functools.partial(
+                commands.dump_activity_tcx,
+                client,
+                journal,
+                cache_directory,
+                directory,
+                start_dates["tcx"],
+                end_date,
+                num_workers=workers,
+                recheck_start_date=recheck_start_dates["tcx"],
+                bundler=bundler,
+                converter=_get_converter(),
+            ),
+        ),
+    )
+    return scheduler
+
+
+@cli.command(help="Sync the data on a schedule, controlled over a local socket")
+@click.option(
+    "-c",
+    "--cache-directory",
+    type=click.Path(file_okay=True, path_type=pathlib.Path),
+    default=".cache",
+)
+@click.option(
+    "-d",
+    "--directory",
+    type=click.Path(file_okay=True, path_type=pathlib.Path),
+    default="f2g",
+)
+@click.option(
+    "-s",
+    "--start-date",
+    type=ClickDate(formats=["%Y-%m-%d"]),
+    default=None,
+    help="Date to start from, only used by the first sync.",
+)
+@click.option(
+    "-b",
+    "--backfill-start-date",
+    type=ClickDate(formats=["%Y-%m-%d"]),
+    default=None,
+    help="Also fetch the data from this date up to the start date, with the "
+    "requests left by the syncs.",
+)
+@click.option(
+    "--sync-interval",
+    type=click.FloatRange(min=0),
+    default=3600,
+    help="Number of seconds to wait after a sync before starting the next one.",
+)
+@click.option(
+    "--sync-reserve",
+    type=click.IntRange(min=0),
+    default=30,
+    help="Number of requests of each rate limit window left to the syncs by the "
+    "backfill.",
+)
+@click.option(
+    "--recheck-days",
+    type=click.IntRange(min=0),
+    default=7,
+    help="Number of days before the last sync to fetch again.",
+)
+@click.option(
+    "--weight-source",
+    type=click.Choice(["log", "timeseries"]),
+    default="log",
+)
+@click.option("-w", "--workers", type=click.IntRange(min=1), default=4)
+@click.option(
+    "-p",
+    "--priority",
+    "priorities",
+    type=(click.Choice(["weight", "activity", "tcx"]), int),
+    multiple=True,
+    help="Priority of a kind of data, lower values are fetched first.",
+)
+@click.option(
+    "--socket",
+    "socket_path",
+    type=click.Path(dir_okay=False, path_type=pathlib.Path),
+    default=None,
+    help="Path of the control socket, .serve.sock in the cache directory by default.",
+)
+@async_main
+async def serve(
+    cache_directory: pathlib.Path,
+    directory: pathlib.Path,
+    start_date: Optional[date],
+    backfill_start_date: Optional[date],
+    sync_interval: float,
+    sync_reserve: int,
+    recheck_days: int,
+    weight_source: Literal["log", "timeseries"],
+    workers: int,
+    priorities: list[Tuple[str, int]],
+    socket_path: Optional[pathlib.Path],
+):
+    from .daemon import Daemon
+    from .journal import Journal
+
+    if click.get_current_context().obj["client"]["offline"]:
+        raise click.UsageError("serve cannot run offline.")
+    if backfill_start_date and not (start_date and backfill_start_date < start_date):
+        raise click.UsageError("The backfill has to start before the start date.")
+    bundler = _get_bundler(directory)
+    with Journal(cache_directory) as journal:
+        # Fails before starting if the first sync has no start date.
+        _get_sync_start_dates(journal, start_date, recheck_days)
+        async with _get_client(cache_directory) as client:
+            logging.info("Authorizing.")
+            await client.get_bearer_token()
+
+            def get_sync_scheduler(end_date: date) -> "Scheduler":
+                return _get_sync_scheduler(
+                    client,
+                    journal,
+                    cache_directory,
+                    directory,
+                    _get_sync_start_dates(journal, start_date, recheck_days),
+                    end_date,
+                    recheck_days,
+                    weight_source,
+                    workers,
+                    priorities,
+                    bundler,
+                )
+
+            backfill_scheduler = None
+            if backfill_start_date and start_date:
+                backfill_scheduler = _get_dump_all_scheduler(
+                    client,
+                    journal,
+                    cache_directory,
+                    directory,
+                    backfill_start_date,
+                    start_date - timedelta(days=1),
+                    weight_source,
+                    workers,
+                    False,
+                    priorities,
+                    bundler,
+                    priority_offset=_BACKFILL_PRIORITY,
+                )
+            daemon = Daemon(
+                cache_directory,
+                journal,
+                client.rate_limiter,
+                get_sync_scheduler,
+                backfill_scheduler,
+                sync_interval=sync_interval,
+                sync_reserve=sync_reserve,
+            )
+            await daemon.run(socket_path)
+
+
+@cli.command(help="Estimate the requests and time needed to dump all data")
+@click.option(
+    "-c",
+    "--cache-directory",
+    type=click.Path(file_okay=True, path_type=pathlib.Path),
+    default=".cache",
+)
+@click.option("-s", "--start-date", type=ClickDate(formats=["%Y-%m-%d"]), required=True)
+@click.option(
+    "-e",
+    "--end-date",
+    type=ClickDate(formats=["%Y-%m-%d"]),
+    default=str(date.today()),
+)
+@click.option(
+    "--weight-source",
+    type=click.Choice(["log", "timeseries"]),
+    default="log",
+)
+def plan(
+    cache_directory: pathlib.Path,
+    start_date: date,
+    end_date: date,
+    weight_source: Literal["log", "timeseries"],
+):
+    from . import commands
+    from .client import FitbitClient
+    from .journal import Journal, journal_exists
+    from .scheduler import estimate_duration
+
+    # Nothing is written to the cache, the journal is only read if it exists.
+    if journal_exists(cache_directory):
+        with Journal(cache_directory) as journal:
+            entries = commands.plan(
+                journal, cache_directory, start_date, end_date, weight_source
+            )
+    else:
+        entries = commands.plan(
+            None, cache_directory, start_date, end_date, weight_source
+        )
+    rows = [("", "Data", "Strategy", "Requests")]
+    for entry in entries:
+        requests = str(entry.num_requests)
+        if entry.lower_bound:
+            requests = f">= {requests}" if entry.num_requests else "?"
+        rows.append(
+            ("*" if entry.selected else "", entry.kind, entry.strategy, requests)
+        )
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    for row in rows:
+        click.echo("  ".join(value.ljust(width) for value, width in zip(row, widths)))
+
+    num_requests = sum(entry.num_requests for entry in entries if entry.selected)
+    state = FitbitClient(cache_directory).rate_limiter.load()
+    eta = timedelta(seconds=round(estimate_duration(num_requests, state)))
+    click.echo(
+        f"\nThe strategies marked with * take {num_requests} requests, which with "
+        f"{state.remaining}/{state.limit} requests left in the current window take "
+        f"about {eta}."
+    )
+    if any(entry.lower_bound for entry in entries if entry.selected):
+        click.echo(
+            "The activities are not known until the activity log list is fetched, "
+            "run the plan again after that for an exact estimate."
+        )
+
+
+@cli.command(help="Render the dumped data again from the cache, without any request")
+@click.option(
+    "-c",
+    "--cache-directory",
+    type=click.Path(file_okay=True, path_type=pathlib.Path),
+    default=".cache",
+)
+@click.option(
+    "-d",
+    "--directory",
+    type=click.Path(file_okay=True, path_type=pathlib.Path),
+    default="f2g",
+)
+@click.option("-s", "--start-date", type=ClickDate(formats=["%Y-%m-%d"]), required=True)
+@click.option(
+    "-e",
+    "--end-date",
+    type=ClickDate(formats=["%Y-%m-%d"]),
+    default=str(date.today()),
+)
+@click.option("-j", "--processes", type=click.IntRange(min=1), default=None)
+@instrumented
+def render(
+    cache_directory: pathlib.Path,
+    directory: pathlib.Path,
+    start_date: date,
+    end_date: date,
+    processes: Optional[int],
 ):
-    await commands.dump_weight(cache_directory, directory, start_date, end_date)
-    await commands.dump_activity(cache_directory, directory, start_date, end_date)
-    await commands.dump_activity_tcx(cache_directory, directory, start_date, end_date)
+    from . import commands
+
+    commands.render(
+        cache_directory,
+        directory,
+        start_date,
+        end_date,
+        num_processes=processes,
+        bundler=_get_bundler(directory),
+        converter=_get_converter(),
+    )
+
+
+@cli.command(help="Import data from a Fitbit account archive")
+@click.option(
+    "-a",
+    "--archive",
+    type=click.Path(exists=True, dir_okay=False, path_type=pathlib.Path),
+    required=True,
+)
+@click.option(
+    "-d",
+    "--directory",
+    type=click.Path(file_okay=True, path_type=pathlib.Path),
+    default="f2g",
+)
+@click.option("-s", "--start-date", type=ClickDate(formats=["%Y-%m-%d"]), required=True)
+@click.option(
+    "-e",
+    "--end-date",
+    type=ClickDate(formats=["%Y-%m-%d"]),
+    default=str(date.today()),
+)
+@click.option("-j", "--processes", type=click.IntRange(min=1), default=None)
+def import_archive(
+    archive: pathlib.Path,
+    directory: pathlib.Path,
+    start_date: date,
+    end_date: date,
+    processes: Optional[int],
+):
+    from . import commands
+
+    commands.import_archive(
+        archive, directory, start_date, end_date, num_processes=processes
+    )
 
 
 def run() -> None:
     logging.basicConfig(level=logging.INFO)
-    cli()
+    cli()  # pylint: disable=no-value-for-parameter
 
 
 if __name__ == "__main__":
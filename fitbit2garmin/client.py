@@ -0,0 +1,139 @@
+import asyncio
+import json
+import logging
+import pathlib
+
+from typing import TYPE_CHECKING, Any, Dict, Final, Optional
+
+from .rate_limiter import FairShare, RateLimiter
+from .response_cache import ResponseCache
+from .retry import RetryPolicy
+
+# aiohttp is only imported once a session is created, so that the rate limiter
+# of a client can be read without it (e.g. by the plan command).
+if TYPE_CHECKING:
+    import aiohttp
+
+_AUTH_FILE_NAME: Final[str] = ".auth"
+_RATE_LIMIT_FILE_NAME: Final[str] = ".ratelimit"
+# Refresh the token a bit before it expires, so that in-flight requests never
+# use an expired token.
+_TOKEN_EXPIRY_MARGIN: Final[int] = 5 * 60
+_MAX_CONNECTIONS: Final[int] = 8
+_KEEPALIVE_TIMEOUT: Final[int] = 60
+_RESPONSE_CACHE_SIZE: Final[int] = 1024 * 1024 * 1024
+
+
+def create_session(max_connections: int = _MAX_CONNECTIONS) -> "aiohttp.ClientSession":
+    import aiohttp
+
+    connector = aiohttp.TCPConnector(
+        limit=max_connections, keepalive_timeout=_KEEPALIVE_TIMEOUT
+    )
+    return aiohttp.ClientSession(connector=connector, raise_for_status=True)
+
+
+# Long-lived client holding a pooled keep-alive session, the rate limiter, the
+# retry policy, the response cache and the authorization for the account whose
+# data is stored in cache_directory.
+# The response cache is disabled when response_cache_size is 0. In offline mode,
+# no request is sent and all the responses come from the response cache.
+# Clients of several accounts can share the same session, in which case it is
+# not closed by the client, and the concurrent requests of a fair share.
+class FitbitClient:
+    def __init__(
+        self,
+        cache_directory: pathlib.Path,
+        retry_policy: Optional[RetryPolicy] = None,
+        response_cache_size: int = _RESPONSE_CACHE_SIZE,
+        offline: bool = False,
+        session: Optional["aiohttp.ClientSession"] = None,
+        share: Optional[FairShare] = None,
+    ):
+        assert response_cache_size > 0 or not offline
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.offline = offline
+        self.response_cache: Optional[ResponseCache] = None
+        self._cache_directory = cache_directory
+        self._response_cache_size = response_cache_size
+        self.rate_limiter = RateLimiter(
+            ledger_path=cache_directory / _RATE_LIMIT_FILE_NAME, share=share
+        )
+        self._auth_file_path = cache_directory / _AUTH_FILE_NAME
+        self._authorization: Optional[Dict[str, Any]] = None
+        self._authorization_lock: Optional[asyncio.Lock] = None
+        self._session: Optional["aiohttp.ClientSession"] = None
+        self._shared_session = session
+
+    async def __aenter__(self) -> "FitbitClient":
+        self._session = self._shared_session or create_session()
+        self._authorization_lock = asyncio.Lock()
+        if self._response_cache_size > 0:
+            self.response_cache = ResponseCache(
+                self._cache_directory,
+                max_size=self._response_cache_size,
+                offline=self.offline,
+            )
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        assert self._session
+        if self._session is not self._shared_session:
+            await self._session.close()
+        self._session = None
+        if self.response_cache:
+            self.response_cache.close()
+            self.response_cache = None
+
+    @property
+    def session(self) -> "aiohttp.ClientSession":
+        assert self._session, "FitbitClient used outside of its context."
+        return self._session
+
+    async def get_bearer_token(self) -> str:
+        from . import aiohttp_fitbit_api
+
+        assert self._authorization_lock
+        # Only one task at a time can refresh the token, the others wait for it
+        # and then reuse the refreshed one.
+        async with self._authorization_lock:
+            if self._authorization is None and self._auth_file_path.exists():
+                with self._auth_file_path.open("r") as fr:
+                    self._authorization = json.loads(fr.read())
+            authorization = await aiohttp_fitbit_api.execute_oauth2_flow(
+                self.session,
+                self._authorization,
+                rate_limiter=self.rate_limiter,
+                expiry_margin=_TOKEN_EXPIRY_MARGIN,
+            )
+            self._store_authorization(authorization)
+            return authorization["access_token"]
+
+    async def refresh_bearer_token(self, bearer_token: str) -> None:
+        from . import aiohttp_fitbit_api
+
+        # Called when a request was rejected with the given token. The token is
+        # only refreshed if no other task refreshed it already.
+        assert self._authorization_lock
+        async with self._authorization_lock:
+            if (
+                self._authorization is None
+                or self._authorization["access_token"] != bearer_token
+            ):
+                return
+            authorization = await aiohttp_fitbit_api.execute_oauth2_flow(
+                self.session,
+                self._authorization,
+                rate_limiter=self.rate_limiter,
+                force_refresh=True,
+            )
+            self._store_authorization(authorization)
+
+    def _store_authorization(self, authorization: Dict[str, Any]) -> None:
+        if authorization is self._authorization:
+            return
+        logging.debug("Storing refreshed authorization.")
+        self._auth_file_path.parent.mkdir(parents=True, exist_ok=True)
+        with self._auth_file_path.open("w") as fw:
+            print(json.dumps(authorization), file=fw)
+        self._authorization = authorization
@@ -1,231 +1,1425 @@
 import asyncio
+import collections
+import concurrent.futures
 import functools
+import hashlib
+import io
 import json
 import logging
+import math
 import pathlib
+import zipfile
 
-from collections.abc import Callable, Coroutine
-from datetime import date, datetime
-from typing import Any
-
-import aiohttp
+from collections.abc import AsyncIterator, Callable, Coroutine, Iterator
+from datetime import date, datetime, timedelta
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Dict,
+    Final,
+    Literal,
+    NamedTuple,
+    Optional,
+    Tuple,
+)
 
 from dateutil.relativedelta import relativedelta
-from dateutil.rrule import MONTHLY, rrule
 
-from . import aiohttp_fitbit_api
+from . import fit_export, fitbit_api, fitbit_archive, garmin_export, metrics
+from .bundler import Bundler
+from .fit_export import FitConverter
+from .journal import Journal, journal_exists
+from .response_cache import CacheMissError, ResponseCache, read_blob
+from .retry import RetryError, classify_error
+from .scheduler import Progress
+
+# aiohttp is only imported by the commands sending requests, not by the ones
+# working from the cache alone (plan, render and import-archive).
+if TYPE_CHECKING:
+    from .client import FitbitClient
+
+# Number of days of the partitions of the activity log list crawled concurrently.
+_ACTIVITY_LOG_LIST_PARTITION_DAYS: Final[int] = 365
+# Directory of the cache where the entries fetched for each month are stored,
+# so that the csv files can be rendered again without the API.
+_RAW_DIRECTORY_NAME: Final[str] = ".raw"
+
+
+def _get_month_date_pairs(start_date: date, end_date: date) -> list[Tuple[date, date]]:
+    from dateutil.rrule import MONTHLY, rrule
+
+    return [
+        (start, min(start + relativedelta(months=1, days=-1), end_date))
+        for start in map(
+            datetime.date,
+            rrule(MONTHLY, dtstart=start_date, until=end_date, bymonthday=1),
+        )
+    ]
+
+
+def _merge_date_pairs(
+    date_pairs: list[Tuple[date, date]], max_days: int
+) -> list[list[Tuple[date, date]]]:
+    # Group consecutive date ranges so that each group spans at most max_days.
+    groups: list[list[Tuple[date, date]]] = []
+    for start_date, end_date in date_pairs:
+        if groups and end_date - relativedelta(days=max_days) <= groups[-1][0][0]:
+            groups[-1].append((start_date, end_date))
+        else:
+            groups.append([(start_date, end_date)])
+    return groups
+
+
+def _count_timeseries_requests(
+    start_date: date,
+    end_date: date,
+    resources: list[str],
+    get_max_days: Callable[[str], int],
+) -> int:
+    num_days = (end_date - start_date).days + 1
+    return sum(
+        math.ceil(num_days / (get_max_days(resource) + 1)) for resource in resources
+    )
+
+
+def _get_pending_date_pairs(
+    journal: Journal,
+    kind: str,
+    start_date: date,
+    end_date: date,
+    refresh: bool,
+    recheck_start_date: Optional[date] = None,
+) -> list[Tuple[date, date]]:
+    date_pairs = []
+    for start_date_range, end_date_range in _get_month_date_pairs(start_date, end_date):
+        date_range = f"{start_date_range}-{end_date_range}"
+        # Months reaching into the recheck window of syncs are fetched again even
+        # if already done, as their data can still change.
+        rechecked = (
+            recheck_start_date is not None and end_date_range >= recheck_start_date
+        )
+        if not refresh and not rechecked and journal.is_done(kind, date_range):
+            logging.debug(
+                f"{kind.capitalize()} data for {date_range} already processed."
+            )
+            continue
+        date_pairs.append((start_date_range, end_date_range))
+    return date_pairs
+
+
+def _group_date_pairs(
+    date_pairs: list[Tuple[date, date]],
+    resources: list[str],
+    get_max_days: Callable[[str], int],
+) -> Tuple[list[list[Tuple[date, date]]], list[int]]:
+    # Groups the months to fetch using the widest date ranges the API accepts,
+    # and counts the requests needed by each group.
+    max_days = max(map(get_max_days, resources))
+    date_pairs_groups = _merge_date_pairs(date_pairs, max_days)
+    num_requests = [
+        _count_timeseries_requests(
+            date_pairs_group[0][0], date_pairs_group[-1][1], resources, get_max_days
+        )
+        for date_pairs_group in date_pairs_groups
+    ]
+    return date_pairs_groups, num_requests
 
 
 def run_aiohttp_fitbit_api_call(
     name: str,
-    auth_file_path: pathlib.Path,
+    client: "FitbitClient",
     func: Callable[..., Coroutine[Any, Any, Any]],
 ):
+    import aiohttp
+
+    retry_policy = client.retry_policy
+
     @functools.wraps(func)
     async def wrapper(*args, **kwargs):
-        async with aiohttp.ClientSession(raise_for_status=True) as session:
-            while True:
-                try:
+        # The duration of the call includes the retries and the time spent
+        # waiting for the rate limiter.
+        with metrics.get().timer("call_seconds", call=func.__name__):
+            return await _call(*args, **kwargs)
+
+    async def _call(*args, **kwargs):
+        registry = metrics.get()
+        attempt = 0
+        # The token rejected by the previous attempt, to refresh.
+        rejected_bearer_token: Optional[str] = None
+        while True:
+            await retry_policy.wait_for_circuit()
+            bearer_token = ""
+            try:
+                # The requests of the authorization are retried like the call.
+                if rejected_bearer_token is not None:
+                    await client.refresh_bearer_token(rejected_bearer_token)
+                    rejected_bearer_token = None
+                if not client.offline:
                     logging.debug(f"{name}: Authorizing request.")
-                    if auth_file_path.exists():
-                        with auth_file_path.open("r") as fr:
-                            authorization = json.loads(fr.read())
-                    else:
-                        authorization = None
-                    authorization = await aiohttp_fitbit_api.execute_oauth2_flow(
-                        session, authorization
-                    )
-                    with auth_file_path.open("w") as fw:
-                        print(json.dumps(authorization), file=fw)
-                    bearer_token = authorization["access_token"]
-                    logging.debug(f"{name}: Sending request.")
-                    result = await func(session, bearer_token, *args, **kwargs)
-                except aiohttp.ClientResponseError as err:
-                    logging.error(f"{name}: Request failed: {err}")
+                    bearer_token = await client.get_bearer_token()
+                logging.debug(f"{name}: Sending request.")
+                result = await func(
+                    client.session,
+                    bearer_token,
+                    *args,
+                    rate_limiter=client.rate_limiter,
+                    response_cache=client.response_cache,
+                    **kwargs,
+                )
+            except (aiohttp.ClientError, asyncio.TimeoutError, CacheMissError) as err:
+                error_kind = classify_error(err)
+                logging.error(f"{name}: Request failed: {err!r}")
+                if error_kind == "permanent":
+                    registry.increment("failed_calls", kind=error_kind)
+                    raise RetryError(f"{name}: {err!r}") from err
+                registry.increment("retries", kind=error_kind)
+                if error_kind == "rate_limited":
+                    # The rate limiter holds the request until the reset.
                     continue
-                except asyncio.TimeoutError:
-                    logging.error(f"{name}: Request timed out.")
+                attempt += 1
+                if attempt >= retry_policy.max_attempts:
+                    registry.increment("failed_calls", kind=error_kind)
+                    raise RetryError(f"{name}: failed {attempt} times.") from err
+                if error_kind == "unauthorized":
+                    rejected_bearer_token = bearer_token
                     continue
-                logging.debug(f"{name}: Done.")
-                return result
+                retry_policy.record_failure()
+                delay = retry_policy.get_delay(attempt)
+                logging.info(f"{name}: Retrying in {delay:.1f} seconds.")
+                await asyncio.sleep(delay)
+                continue
+            retry_policy.record_success()
+            logging.debug(f"{name}: Done.")
+            return result
 
     return wrapper
 
 
+# Offline, a response missing from the cache (e.g. evicted, or requested over
+# another date range) says nothing about the item, hence items already done are
+# neither started nor failed again.
+def _start_fetch(journal: Journal, kind: str, key: str, offline: bool):
+    if not (offline and journal.is_done(kind, key)):
+        journal.start(kind, key)
+
+
+def _fail_fetch(journal: Journal, kind: str, key: str, offline: bool):
+    if not (offline and journal.is_done(kind, key)):
+        journal.fail(kind, key)
+
+
+def _log_failed(journal: Journal, kind: str, name: str):
+    # The items still failed in the journal, including the ones of previous runs.
+    failed = journal.get_failed(kind)
+    if failed:
+        logging.warning(
+            f"Failed to fetch {len(failed)} {name}, they will be retried by the next "
+            f"run covering them: {', '.join(failed)}."
+        )
+
+
+def _get_first_failed_date(failed: list[str]) -> Optional[date]:
+    # e.g. "2020-01-01-2020-01-31"
+    return min(
+        (date.fromisoformat(date_range[:10]) for date_range in failed), default=None
+    )
+
+
+def _iter_cached_activities(
+    journal: Journal, cache_directory: pathlib.Path, start_date: date, end_date: date
+) -> Iterator[Dict[str, Any]]:
+    # Offline, the activities come from the completed activity log lists of any
+    # date range, as the pages of the list cannot be replayed over another one.
+    log_ids = set()
+    for path in sorted(cache_directory.glob(".exercises.*.jsonl")):
+        date_range = path.name[len(".exercises.") : -len(".jsonl")]
+        if not journal.is_done("exercises", date_range):
+            continue
+        with path.open("r") as fr:
+            for activity in map(json.loads, fr):
+                activity_date = fitbit_api.get_activity_date(activity)
+                if (
+                    start_date <= activity_date <= end_date
+                    and activity["logId"] not in log_ids
+                ):
+                    log_ids.add(activity["logId"])
+                    yield activity
+
+
+def _get_cached_activity_log_list(
+    journal: Journal, cache_directory: pathlib.Path, start_date: date, end_date: date
+) -> Optional[Tuple[pathlib.Path, date, date]]:
+    # The completed activity log list covering the start date, and ending by the
+    # end date, which ends the latest, and its dates.
+    cached_lists = []
+    for path in cache_directory.glob(".exercises.*.jsonl"):
+        date_range = path.name[len(".exercises.") : -len(".jsonl")]
+        list_start_date = date.fromisoformat(date_range[:10])
+        list_end_date = date.fromisoformat(date_range[11:])
+        if list_start_date <= start_date <= list_end_date <= end_date and (
+            journal.is_done("exercises", date_range)
+        ):
+            cached_lists.append((path, list_start_date, list_end_date))
+    return max(cached_lists, key=lambda cached_list: cached_list[2], default=None)
+
+
 async def dump_activity_tcx(
+    client: "FitbitClient",
+    journal: Journal,
     cache_directory: pathlib.Path,
     tcxs_directory: pathlib.Path,
     start_date: date,
     end_date: date,
-):
+    num_workers: int = 4,
+    verify_skips: bool = False,
+    refresh: bool = False,
+    recheck_start_date: Optional[date] = None,
+    bundler: Optional[Bundler] = None,
+    converter: Optional[FitConverter] = None,
+    request_progress: Optional[Progress] = None,
+) -> Optional[date]:
+    # Returns the date of the earliest activity whose tcx (or page of the list)
+    # failed to be fetched, if any, which syncs have to fetch again.
+    from . import aiohttp_fitbit_api
+
     cache_directory.mkdir(parents=True, exist_ok=True)
     tcxs_directory.mkdir(parents=True, exist_ok=True)
+    request_progress = request_progress or Progress("tcx")
 
-    auth_file_name = ".auth"
-    auth_file_path = cache_directory / auth_file_name
-
-    # Fetch activity log.
+    # Fetch activity log, unless already cached. The activities are streamed
+    # to the cache while being fetched, so that the tcx downloads can start
+    # straight away.
     date_range = f"{start_date}-{end_date}"
     activity_log_file_path = cache_directory / f".exercises.{date_range}.jsonl"
-    activity_log_done_file_path = cache_directory / f".exercises.{date_range}"
-    if not activity_log_file_path.exists() or not activity_log_done_file_path.exists():
-        get_activity_log_list = run_aiohttp_fitbit_api_call(
-            "activity-log-list",
-            auth_file_path,
-            aiohttp_fitbit_api.get_activity_log_list,
-        )
+    cached = (
+        not refresh
+        and recheck_start_date is None
+        and activity_log_file_path.exists()
+        and journal.is_done("exercises", date_range)
+    )
+
+    async def iter_activities() -> AsyncIterator[Dict[str, Any]]:
+        if cached:
+            with activity_log_file_path.open("r") as fr:
+                for activity in map(json.loads, fr):
+                    yield activity
+            return
+        if client.offline:
+            for activity in _iter_cached_activities(
+                journal, cache_directory, start_date, end_date
+            ):
+                yield activity
+            return
+        # Syncs only list again the activities from the start of their recheck
+        # window, or from the end of the list cached by an earlier run if it
+        # ends before, and take the older ones from that list. Both are merged
+        # into a list superseding the cached one, so that only one is kept.
+        list_start_date = start_date
+        list_date_range = date_range
+        list_file_path = activity_log_file_path
+        cached_list = None
+        if recheck_start_date is not None and not refresh:
+            cached_list = _get_cached_activity_log_list(
+                journal, cache_directory, start_date, end_date
+            )
+            if cached_list:
+                list_start_date = max(
+                    start_date,
+                    min(cached_list[2] + timedelta(days=1), recheck_start_date),
+                )
+                list_date_range = f"{cached_list[1]}-{end_date}"
+                list_file_path = cache_directory / f".exercises.{list_date_range}.jsonl"
         logging.info("Fetching activity log list.")
-        activities = await get_activity_log_list(start_date, end_date)
-        with activity_log_file_path.open("w") as fw:
-            for activity in activities:
-                print(json.dumps(activity), file=fw)
-        activity_log_done_file_path.touch()
-        logging.info("Activity log list fetched.")
-
-    # Count number of activities.
-    with activity_log_file_path.open("r") as fr:
-        num_activities = sum(1 for _ in fr)
+        _start_fetch(journal, "exercises", list_date_range, client.offline)
+        failed_partitions: list[Tuple[date, date]] = []
+        # The cached list can be the one being written, e.g. for a second sync on
+        # the same day.
+        list_part_file_path = list_file_path.with_name(f"{list_file_path.name}.part")
+        try:
+            with list_part_file_path.open("w") as fw:
+                if cached_list:
+                    with cached_list[0].open("r") as fr:
+                        for activity in map(json.loads, fr):
+                            activity_date = fitbit_api.get_activity_date(activity)
+                            if activity_date < list_start_date:
+                                print(json.dumps(activity), file=fw)
+                                if activity_date >= start_date:
+                                    yield activity
+                async for activity in _iter_activity_log_list(
+                    client,
+                    list_start_date,
+                    end_date,
+                    request_progress,
+                    failed_partitions,
+                ):
+                    print(json.dumps(activity), file=fw)
+                    yield activity
+            if failed_partitions:
+                # The activities of the pages that failed are fetched by the next
+                # run, which starts again from the list cached before.
+                _fail_fetch(journal, "exercises", list_date_range, client.offline)
+                failed_dates.append(min(start for start, _ in failed_partitions))
+            else:
+                list_part_file_path.replace(list_file_path)
+                journal.done("exercises", list_date_range)
+                # The lists that failed over dates covered by this one are done.
+                for failed_date_range in journal.get_failed("exercises"):
+                    if list_date_range[:10] <= failed_date_range[:10] and (
+                        failed_date_range[11:] <= list_date_range[11:]
+                    ):
+                        journal.done("exercises", failed_date_range)
+                if cached_list and cached_list[0] != list_file_path:
+                    cached_list[0].unlink()
+                logging.info("Activity log list fetched.")
+        finally:
+            list_part_file_path.unlink(missing_ok=True)
 
-    # Fetch tcx for each activity.
-    with activity_log_file_path.open("r") as fr:
-        for i, activity in enumerate(map(json.loads, fr)):
-            progress = f"[{i+1}/{num_activities}]"
+    # Count number of activities, if known. Downloads of tcxs predicted to be
+    # empty from the metadata of the activity are skipped, unless we are asked
+    # to verify the predictions.
+    num_activities: Optional[int] = None
+    if cached:
+        num_activities = 0
+        with activity_log_file_path.open("r") as fr:
+            for activity in map(json.loads, fr):
+                num_activities += 1
+                if _should_fetch_activity_tcx(
+                    journal, activity, verify_skips, client.offline
+                ):
+                    request_progress.plan()
+    skipped: list[int] = []
+    failed_dates: list[date] = []
+    missed_skips: list[int] = []
+    wrong_skips: list[int] = []
+    unconverted: list[str] = []
+    conversions: list[asyncio.Future] = []
+
+    # Fetch tcx for each activity, using a pool of workers that stream them
+    # straight to disk.
+    fetch_queue: asyncio.Queue = asyncio.Queue(maxsize=num_workers)
+
+    async def produce():
+        i = 0
+        async for activity in iter_activities():
+            i += 1
+            progress = f"[{i}/{num_activities or '?'}]"
             log_id = activity["logId"]
-            activity_tcx_file_path = tcxs_directory / f"exercise.{log_id}.tcx"
-            activity_tcx_done_file_path = cache_directory / f".exercise.{log_id}"
-            if activity_tcx_done_file_path.exists():
+            if _should_fetch_activity_tcx(
+                journal, activity, verify_skips, client.offline
+            ):
+                if num_activities is None:
+                    request_progress.plan()
+                predicted_empty = fitbit_api.is_activity_tcx_empty(activity)
+                await fetch_queue.put(
+                    (
+                        progress,
+                        log_id,
+                        fitbit_api.get_activity_date(activity),
+                        predicted_empty,
+                    )
+                )
+            elif journal.is_done("exercise", str(log_id)):
                 logging.info(f"{progress} Activity {log_id} already processed.")
-                continue
-            if activity["logType"] == "auto_detected":
+            else:
                 logging.info(
                     f"{progress} Activity {log_id} would have an empty tcx, skipping."
                 )
-                activity_tcx_done_file_path.touch()
-                continue
+                skipped.append(log_id)
+                journal.done("exercise", str(log_id))
+        for _ in range(num_workers):
+            await fetch_queue.put(None)
+
+    async def fetch():
+        while (item := await fetch_queue.get()) is not None:
+            progress, log_id, activity_date, predicted_empty = item
             logging.info(f"{progress} Fetching activity {log_id}.")
-            get_activity_tcx = run_aiohttp_fitbit_api_call(
+            _start_fetch(journal, "exercise", str(log_id), client.offline)
+            download_activity_tcx = run_aiohttp_fitbit_api_call(
                 f"{progress} activity-tcx-{log_id}",
-                auth_file_path,
-                aiohttp_fitbit_api.get_activity_tcx,
+                client,
+                aiohttp_fitbit_api.download_activity_tcx,
             )
-            tcx = await get_activity_tcx(log_id)
-            if tcx.count(b"\n") <= 15:
+            activity_tcx_file_path = tcxs_directory / f"exercise.{log_id}.tcx"
+            try:
+                content_hash = await download_activity_tcx(
+                    log_id, activity_tcx_file_path
+                )
+            except RetryError:
+                _fail_fetch(journal, "exercise", str(log_id), client.offline)
+                failed_dates.append(activity_date)
+                continue
+            finally:
+                request_progress.advance()
+            metrics.get().increment("items", kind="exercise")
+            if content_hash is None:
                 logging.info(f"{progress} Activity {log_id} has an empty tcx.")
-                activity_tcx_done_file_path.touch()
+                if not predicted_empty:
+                    missed_skips.append(log_id)
+                journal.done("exercise", str(log_id))
                 continue
-            # Create tcx file
-            with activity_tcx_file_path.open("wb") as fw:
-                fw.write(tcx)
-            activity_tcx_done_file_path.touch()
-            logging.info(f"{progress} Activity {log_id} fetched.")
+            if predicted_empty:
+                wrong_skips.append(log_id)
+            if converter:
+                # The conversion runs while the worker downloads the next tcx.
+                conversions.append(
+                    asyncio.ensure_future(
+                        finish(progress, log_id, activity_tcx_file_path, content_hash)
+                    )
+                )
+            else:
+                await finish(progress, log_id, activity_tcx_file_path, content_hash)
+
+    async def finish(
+        progress: str, log_id: int, file_path: pathlib.Path, content_hash: str
+    ):
+        if converter:
+            try:
+                file_path = await converter.convert(file_path)
+            except ValueError as err:
+                logging.warning(f"{progress} Activity {log_id}: {err} Kept the tcx.")
+                unconverted.append(str(log_id))
+        journal.done("exercise", str(log_id), content_hash)
+        if bundler:
+            with metrics.get().timer("write_seconds", kind="exercise-bundle"):
+                bundler.add_tcx(file_path)
+        logging.info(f"{progress} Activity {log_id} fetched.")
+
+    await asyncio.gather(produce(), *(fetch() for _ in range(num_workers)))
+    await asyncio.gather(*conversions)
+    _log_failed(journal, "exercises", "activity log lists")
+    _log_failed(journal, "exercise", "tcxs")
+    if unconverted:
+        logging.warning(
+            f"Failed to convert {len(unconverted)} tcxs into fit files, the tcxs "
+            f"were kept instead: {', '.join(unconverted)}."
+        )
+
+    # Report how well the empty tcxs were predicted.
+    logging.info(
+        f"Skipped {len(skipped)} tcx downloads predicted to be empty, "
+        f"saving {len(skipped)} requests."
+    )
+    if missed_skips:
+        logging.info(
+            f"{len(missed_skips)} downloaded tcxs were empty but not predicted so: "
+            f"{', '.join(map(str, missed_skips))}."
+        )
+    if wrong_skips:
+        logging.warning(
+            f"{len(wrong_skips)} tcxs predicted to be empty have trackpoints: "
+            f"{', '.join(map(str, wrong_skips))}."
+        )
+    return min(failed_dates, default=None)
+
+
+def _get_activity_log_list_partitions(
+    start_date: date, end_date: date
+) -> list[Tuple[date, date]]:
+    partitions = []
+    partition_start_date = start_date
+    while partition_start_date <= end_date:
+        partition_end_date = min(
+            partition_start_date
+            + timedelta(days=_ACTIVITY_LOG_LIST_PARTITION_DAYS - 1),
+            end_date,
+        )
+        partitions.append((partition_start_date, partition_end_date))
+        partition_start_date = partition_end_date + timedelta(days=1)
+    return partitions
+
+
+async def _iter_activity_log_list(
+    client: "FitbitClient",
+    start_date: date,
+    end_date: date,
+    request_progress: Progress,
+    failed_partitions: list[Tuple[date, date]],
+) -> AsyncIterator[Dict[str, Any]]:
+    from . import aiohttp_fitbit_api
+
+    # The list can only be paged forward from a given date, hence the date range
+    # is split into partitions that are crawled concurrently, each one stopping
+    # at the first page that goes past its end. The partitions whose pages fail
+    # to be fetched are added to failed_partitions, without the activities after
+    # the page that failed.
+    get_activity_log_list_page = run_aiohttp_fitbit_api_call(
+        "activity-log-list",
+        client,
+        aiohttp_fitbit_api.get_activity_log_list_page,
+    )
+    pages: asyncio.Queue = asyncio.Queue()
+
+    async def crawl(partition_start_date: date, partition_end_date: date):
+        # The after date is exclusive.
+        url = fitbit_api.get_activity_log_list_url(
+            partition_start_date - timedelta(days=1)
+        )
+        while url:
+            request_progress.plan()
+            try:
+                data = await get_activity_log_list_page(url)
+            except RetryError:
+                failed_partitions.append((partition_start_date, partition_end_date))
+                return
+            finally:
+                request_progress.advance()
+            activities = data["activities"]
+            await pages.put(
+                [
+                    activity
+                    for activity in activities
+                    if partition_start_date
+                    <= fitbit_api.get_activity_date(activity)
+                    <= partition_end_date
+                ]
+            )
+            if (
+                not activities
+                or fitbit_api.get_activity_date(activities[-1]) > partition_end_date
+            ):
+                break
+            url = data.get("pagination", {}).get("next", None)
+
+    async def crawl_all():
+        partitions = _get_activity_log_list_partitions(start_date, end_date)
+        try:
+            await asyncio.gather(*(crawl(*partition) for partition in partitions))
+        finally:
+            await pages.put(None)
+
+    crawler = asyncio.ensure_future(crawl_all())
+    try:
+        log_ids = set()
+        while (page := await pages.get()) is not None:
+            for activity in page:
+                if activity["logId"] not in log_ids:
+                    log_ids.add(activity["logId"])
+                    yield activity
+        # Raise the error of the crawler, if any.
+        await crawler
+    finally:
+        crawler.cancel()
+
+
+def _should_fetch_activity_tcx(
+    journal: Journal,
+    activity: Dict[str, Any],
+    verify_skips: bool,
+    offline: bool = False,
+) -> bool:
+    # Offline, the tcxs fetched by previous runs are rendered again from the
+    # response cache.
+    if offline or not journal.is_done("exercise", str(activity["logId"])):
+        return verify_skips or not fitbit_api.is_activity_tcx_empty(activity)
+    # When verifying, activities skipped in previous runs are fetched as well.
+    return verify_skips and fitbit_api.is_activity_tcx_empty(activity)
+
+
+def _get_file_hash(file_path: pathlib.Path) -> str:
+    return hashlib.sha256(file_path.read_bytes()).hexdigest()
+
+
+def _remove_superseded_files(
+    file_path: pathlib.Path, prefix: str, start_date_range: date
+):
+    # Files of a month exported while it was still in progress are superseded
+    # by the ones covering more days of it.
+    for path in file_path.parent.glob(
+        f"{prefix}.{start_date_range}-*{file_path.suffix}"
+    ):
+        if path.name < file_path.name:
+            path.unlink()
+
+
+def _get_raw_file_path(
+    cache_directory: pathlib.Path, kind: garmin_export.Kind, date_range: str
+) -> pathlib.Path:
+    return cache_directory / _RAW_DIRECTORY_NAME / f"{kind}.{date_range}.jsonl"
+
+
+def _store_month(
+    kind: garmin_export.Kind,
+    cache_directory: pathlib.Path,
+    directory: pathlib.Path,
+    start_date_range: date,
+    end_date_range: date,
+    entries: list[Dict[str, Any]],
+    bundler: Optional[Bundler],
+) -> Optional[str]:
+    # Stores the entries of a month, then renders its csv from them like the
+    # render command does. Returns the sha256 of the csv, or None if the month
+    # has no entry.
+    registry = metrics.get()
+    registry.increment("items", kind=kind)
+    date_range = f"{start_date_range}-{end_date_range}"
+    raw_file_path = _get_raw_file_path(cache_directory, kind, date_range)
+    raw_file_path.parent.mkdir(exist_ok=True)
+    temp_raw_file_path = raw_file_path.with_name(f"{raw_file_path.name}.part")
+    with registry.timer("write_seconds", kind=f"{kind}-raw"):
+        with temp_raw_file_path.open("w") as fw:
+            for entry in entries:
+                print(json.dumps(entry), file=fw)
+        temp_raw_file_path.replace(raw_file_path)
+        _remove_superseded_files(raw_file_path, kind, start_date_range)
+    return _render_month(kind, raw_file_path, directory, date_range, bundler)
+
+
+def _render_month(
+    kind: garmin_export.Kind,
+    raw_file_path: pathlib.Path,
+    directory: pathlib.Path,
+    date_range: str,
+    bundler: Optional[Bundler],
+) -> Optional[str]:
+    # Returns the sha256 of the csv, or None if the month has no entry.
+    registry = metrics.get()
+    start_date_range = date.fromisoformat(date_range[:10])
+    file_path = directory / f"{kind}.{date_range}.csv"
+    with registry.timer("write_seconds", kind=f"{kind}-csv"):
+        if not garmin_export.render_csv(kind, raw_file_path, file_path):
+            return None
+        _remove_superseded_files(file_path, kind, start_date_range)
+    if bundler:
+        with registry.timer("write_seconds", kind=f"{kind}-bundle"):
+            bundler.add_csv(kind, start_date_range)
+    return _get_file_hash(file_path)
+
+
+def _render_cached_months(
+    kind: garmin_export.Kind,
+    cache_directory: pathlib.Path,
+    directory: pathlib.Path,
+    start_date: date,
+    end_date: date,
+    bundler: Optional[Bundler],
+):
+    # Offline, the months are written again from the entries stored when they
+    # were fetched, like the render command does. Their requests cannot be
+    # replayed from the response cache, as the date ranges of the long-range
+    # strategies depend on the months that were pending. The journal is left
+    # as it is.
+    rendered = set()
+    for _, date_range, raw_file_path in _get_raw_file_paths(
+        cache_directory, start_date, end_date
+    ):
+        if raw_file_path.name.startswith(f"{kind}."):
+            rendered.add(date.fromisoformat(date_range[:10]))
+            _render_month(kind, raw_file_path, directory, date_range, bundler)
+    missing = [
+        f"{start_date_range}-{end_date_range}"
+        for start_date_range, end_date_range in _get_month_date_pairs(
+            start_date, end_date
+        )
+        if start_date_range not in rendered
+    ]
+    if missing:
+        logging.warning(
+            f"The {kind} data of {len(missing)} months is not cached, they have to "
+            f"be fetched online: {', '.join(missing)}."
+        )
 
 
 async def dump_weight(
+    client: "FitbitClient",
+    journal: Journal,
     cache_directory: pathlib.Path,
     weight_directory: pathlib.Path,
     start_date: date,
     end_date: date,
-):
+    source: Literal["log", "timeseries"] = "log",
+    refresh: bool = False,
+    recheck_start_date: Optional[date] = None,
+    bundler: Optional[Bundler] = None,
+    request_progress: Optional[Progress] = None,
+) -> Optional[date]:
+    # Returns the start date of the earliest month that failed to be fetched, if
+    # any, which syncs have to fetch again.
+    from . import aiohttp_fitbit_api
+
     cache_directory.mkdir(parents=True, exist_ok=True)
     weight_directory.mkdir(parents=True, exist_ok=True)
+    request_progress = request_progress or Progress("weight")
 
-    auth_file_name = ".auth"
-    auth_file_path = cache_directory / auth_file_name
+    if client.offline:
+        _render_cached_months(
+            "weight", cache_directory, weight_directory, start_date, end_date, bundler
+        )
+        return None
+    if source == "timeseries":
+        return await _dump_weight_timeseries(
+            client,
+            journal,
+            cache_directory,
+            weight_directory,
+            start_date,
+            end_date,
+            refresh,
+            recheck_start_date,
+            bundler,
+            request_progress,
+        )
 
     # Fetch weight data month by month
-    date_pairs = [
-        (start, min(start + relativedelta(months=1, days=-1), end_date))
-        for start in map(
-            datetime.date,
-            rrule(MONTHLY, dtstart=start_date, until=end_date, bymonthday=1),
-        )
-    ]
+    date_pairs = _get_pending_date_pairs(
+        journal, "weight", start_date, end_date, refresh, recheck_start_date
+    )
+    request_progress.plan(len(date_pairs))
+    failed: list[str] = []
     for i, (start_date_range, end_date_range) in enumerate(date_pairs):
         progress = f"[{i+1}/{len(date_pairs)}]"
         date_range = f"{start_date_range}-{end_date_range}"
-        weight_file_path = weight_directory / f"weight.{date_range}.csv"
-        weight_done_file_path = cache_directory / f".weight.{date_range}"
-        if weight_done_file_path.exists():
-            logging.info(f"{progress} Weight data for {date_range} already processed.")
-            continue
         logging.info(f"{progress} Fetching weight data for {date_range}.")
         get_weight_timeseries = run_aiohttp_fitbit_api_call(
             f"{progress} weight-{date_range}",
-            auth_file_path,
+            client,
             aiohttp_fitbit_api.get_weight_timeseries,
         )
-        weights = await get_weight_timeseries(start_date_range, end_date_range)
-        entries = list(weights)
-        if not entries:
+        journal.start("weight", date_range)
+        try:
+            weights = await get_weight_timeseries(start_date_range, end_date_range)
+        except RetryError:
+            journal.fail("weight", date_range)
+            failed.append(date_range)
+            continue
+        finally:
+            request_progress.advance()
+        content_hash = _store_month(
+            "weight",
+            cache_directory,
+            weight_directory,
+            start_date_range,
+            end_date_range,
+            list(weights),
+            bundler,
+        )
+        if content_hash is None:
             logging.info(f"{progress} No weight data for {date_range} found.")
-            weight_done_file_path.touch()
+            journal.done("weight", date_range)
             continue
-        # Create weight csv file
-        with weight_file_path.open("w") as fw:
-            print("Body", file=fw)
-            print("Date,Weight,BMI,Fat", file=fw)
-            for entry in entries:
-                print(
-                    f"{entry['date']},{entry['weight']},{entry['bmi']},{entry.get('fat', '0')}",
-                    file=fw,
-                )
-        weight_done_file_path.touch()
+        journal.done("weight", date_range, content_hash)
         logging.info(f"{progress} Fetched weight data for {date_range}.")
+    _log_failed(journal, "weight", "weight months")
+    return _get_first_failed_date(failed)
+
+
+async def _dump_weight_timeseries(
+    client: "FitbitClient",
+    journal: Journal,
+    cache_directory: pathlib.Path,
+    weight_directory: pathlib.Path,
+    start_date: date,
+    end_date: date,
+    refresh: bool,
+    recheck_start_date: Optional[date],
+    bundler: Optional[Bundler],
+    request_progress: Progress,
+) -> Optional[date]:
+    from . import aiohttp_fitbit_api
+
+    # Fetch body data using the widest date ranges the API accepts, then split
+    # it back into monthly files.
+    date_pairs = _get_pending_date_pairs(
+        journal, "weight", start_date, end_date, refresh, recheck_start_date
+    )
+    date_pairs_groups, num_requests = _group_date_pairs(
+        date_pairs,
+        fitbit_api.get_body_timeseries_resources(),
+        fitbit_api.get_body_timeseries_max_days,
+    )
+    request_progress.plan(sum(num_requests))
+    failed: list[str] = []
+    for i, date_pairs_group in enumerate(date_pairs_groups):
+        progress = f"[{i+1}/{len(date_pairs_groups)}]"
+        start_date_group, end_date_group = (
+            date_pairs_group[0][0],
+            date_pairs_group[-1][1],
+        )
+        date_group = f"{start_date_group}-{end_date_group}"
+        logging.info(f"{progress} Fetching weight data for {date_group}.")
+        get_body_timeseries = run_aiohttp_fitbit_api_call(
+            f"{progress} body-{date_group}",
+            client,
+            aiohttp_fitbit_api.get_body_timeseries,
+        )
+        try:
+            bodies = await get_body_timeseries(start_date_group, end_date_group)
+        except RetryError:
+            for start_date_range, end_date_range in date_pairs_group:
+                journal.fail("weight", f"{start_date_range}-{end_date_range}")
+                failed.append(f"{start_date_range}-{end_date_range}")
+            continue
+        finally:
+            request_progress.advance(num_requests[i])
+        for start_date_range, end_date_range in date_pairs_group:
+            date_range = f"{start_date_range}-{end_date_range}"
+            entries = sorted(
+                (
+                    body
+                    for body in bodies
+                    if str(start_date_range) <= body["date"] <= str(end_date_range)
+                    and float(body.get("weight", 0)) > 0
+                ),
+                key=lambda body: body["date"],
+            )
+            content_hash = _store_month(
+                "weight",
+                cache_directory,
+                weight_directory,
+                start_date_range,
+                end_date_range,
+                entries,
+                bundler,
+            )
+            if content_hash is None:
+                logging.info(f"{progress} No weight data for {date_range} found.")
+                journal.done("weight", date_range)
+                continue
+            journal.done("weight", date_range, content_hash)
+            logging.info(f"{progress} Fetched weight data for {date_range}.")
+    _log_failed(journal, "weight", "weight months")
+    return _get_first_failed_date(failed)
 
 
 async def dump_activity(
+    client: "FitbitClient",
+    journal: Journal,
     cache_directory: pathlib.Path,
     activity_directory: pathlib.Path,
     start_date: date,
     end_date: date,
-):
+    refresh: bool = False,
+    recheck_start_date: Optional[date] = None,
+    bundler: Optional[Bundler] = None,
+    request_progress: Optional[Progress] = None,
+) -> Optional[date]:
+    # Returns the start date of the earliest month that failed to be fetched, if
+    # any, which syncs have to fetch again.
+    from . import aiohttp_fitbit_api
+
     cache_directory.mkdir(parents=True, exist_ok=True)
     activity_directory.mkdir(parents=True, exist_ok=True)
+    request_progress = request_progress or Progress("activity")
 
-    auth_file_name = ".auth"
-    auth_file_path = cache_directory / auth_file_name
+    if client.offline:
+        _render_cached_months(
+            "activity",
+            cache_directory,
+            activity_directory,
+            start_date,
+            end_date,
+            bundler,
+        )
+        return None
 
-    # Fetch activity data month by month
-    date_pairs = [
-        (start, min(start + relativedelta(months=1, days=-1), end_date))
-        for start in map(
-            datetime.date,
-            rrule(MONTHLY, dtstart=start_date, until=end_date, bymonthday=1),
+    # Fetch activity data using the widest date ranges the API accepts, then
+    # split it back into monthly files.
+    date_pairs = _get_pending_date_pairs(
+        journal, "activity", start_date, end_date, refresh, recheck_start_date
+    )
+    date_pairs_groups, num_requests = _group_date_pairs(
+        date_pairs,
+        fitbit_api.get_activity_timeseries_resources(),
+        fitbit_api.get_activity_timeseries_max_days,
+    )
+    request_progress.plan(sum(num_requests))
+    failed: list[str] = []
+    for i, date_pairs_group in enumerate(date_pairs_groups):
+        progress = f"[{i+1}/{len(date_pairs_groups)}]"
+        start_date_group, end_date_group = (
+            date_pairs_group[0][0],
+            date_pairs_group[-1][1],
         )
-    ]
-    for i, (start_date_range, end_date_range) in enumerate(date_pairs):
-        progress = f"[{i+1}/{len(date_pairs)}]"
-        date_range = f"{start_date_range}-{end_date_range}"
-        activity_file_path = activity_directory / f"activity.{date_range}.csv"
-        activity_done_file_path = cache_directory / f".activity.{date_range}"
-        if activity_done_file_path.exists():
-            logging.info(
-                f"{progress} Activity data for {date_range} already processed."
-            )
-            continue
-        logging.info(f"{progress} Fetching activity data for {date_range}.")
+        date_group = f"{start_date_group}-{end_date_group}"
+        logging.info(f"{progress} Fetching activity data for {date_group}.")
         get_activity_timeseries = run_aiohttp_fitbit_api_call(
-            f"{progress} activity-{date_range}",
-            auth_file_path,
+            f"{progress} activity-{date_group}",
+            client,
             aiohttp_fitbit_api.get_activity_timeseries,
         )
-        activities = await get_activity_timeseries(start_date_range, end_date_range)
-        entries = [activity for activity in activities if int(activity["steps"]) > 0]
-        if not entries:
-            logging.info(f"{progress} No activity data for {date_range} found.")
-            activity_done_file_path.touch()
+        try:
+            activities = await get_activity_timeseries(start_date_group, end_date_group)
+        except RetryError:
+            for start_date_range, end_date_range in date_pairs_group:
+                journal.fail("activity", f"{start_date_range}-{end_date_range}")
+                failed.append(f"{start_date_range}-{end_date_range}")
             continue
-        # Create activity csv file
-        with activity_file_path.open("w") as fw:
-            print("Activities", file=fw)
-            print(
-                "Date,Calories Burned,Steps,Distance,Floors,Minutes Sedentary,Minutes Lightly Active,Minutes Fairly Active,Minutes Very Active,Activity Calories",
-                file=fw,
+        finally:
+            request_progress.advance(num_requests[i])
+        for start_date_range, end_date_range in date_pairs_group:
+            date_range = f"{start_date_range}-{end_date_range}"
+            entries = sorted(
+                (
+                    activity
+                    for activity in activities
+                    if str(start_date_range) <= activity["date"] <= str(end_date_range)
+                    and int(activity["steps"]) > 0
+                ),
+                key=lambda activity: activity["date"],
             )
-            for entry in entries:
-                print(
-                    f"{entry['date']},{entry['calories']},{entry['steps']},{entry['distance']},{entry['floors']},{entry['minutesSedentary']},{entry['minutesLightlyActive']},{entry['minutesFairlyActive']},{entry['minutesVeryActive']},{entry['activityCalories']}",
-                    file=fw,
+            content_hash = _store_month(
+                "activity",
+                cache_directory,
+                activity_directory,
+                start_date_range,
+                end_date_range,
+                entries,
+                bundler,
+            )
+            if content_hash is None:
+                logging.info(f"{progress} No activity data for {date_range} found.")
+                journal.done("activity", date_range)
+                continue
+            journal.done("activity", date_range, content_hash)
+            logging.info(f"{progress} Fetched activity data for {date_range}.")
+    _log_failed(journal, "activity", "activity months")
+    return _get_first_failed_date(failed)
+
+
+def _get_raw_file_paths(
+    cache_directory: pathlib.Path, start_date: date, end_date: date
+) -> list[Tuple[garmin_export.Kind, str, pathlib.Path]]:
+    raw_file_paths: list[Tuple[garmin_export.Kind, str, pathlib.Path]] = []
+    for kind in ("weight", "activity"):
+        for raw_file_path in sorted(
+            (cache_directory / _RAW_DIRECTORY_NAME).glob(f"{kind}.*.jsonl")
+        ):
+            date_range = raw_file_path.name[len(kind) + 1 : -len(".jsonl")]
+            if start_date <= date.fromisoformat(date_range[:10]) <= end_date:
+                raw_file_paths.append((kind, date_range, raw_file_path))
+    return raw_file_paths
+
+
+def _get_cached_log_ids(
+    cache_directory: pathlib.Path, start_date: date, end_date: date
+) -> set[int]:
+    # Activities of the activity log lists fetched so far, for any date range.
+    log_ids = set()
+    for activity_log_file_path in cache_directory.glob(".exercises.*.jsonl"):
+        with activity_log_file_path.open("r") as fr:
+            for activity in map(json.loads, fr):
+                if start_date <= fitbit_api.get_activity_date(activity) <= end_date:
+                    log_ids.add(activity["logId"])
+    return log_ids
+
+
+def _render_csv(
+    kind: garmin_export.Kind, raw_file_path: pathlib.Path, file_path: pathlib.Path
+) -> Optional[pathlib.Path]:
+    return (
+        file_path if garmin_export.render_csv(kind, raw_file_path, file_path) else None
+    )
+
+
+def _render_tcx(
+    blob_path: pathlib.Path, file_path: pathlib.Path, fit: bool, verify_fit: bool
+) -> Optional[pathlib.Path]:
+    # Returns the path of the file written, if any: the tcx, or the fit it is
+    # converted into (unless the conversion fails).
+    content = read_blob(blob_path)
+    if garmin_export.TCX_TRACKPOINT_TAG not in content:
+        return None
+    if fit:
+        fit_file_path = file_path.with_suffix(".fit")
+        try:
+            fit_export.convert_tcx(io.BytesIO(content), fit_file_path, verify_fit)
+        except ValueError as err:
+            logging.warning(f"{file_path.name}: {err} Kept the tcx.")
+        else:
+            file_path.unlink(missing_ok=True)
+            return fit_file_path
+    garmin_export.write_tcx(content, file_path)
+    return file_path
+
+
+def render(
+    cache_directory: pathlib.Path,
+    directory: pathlib.Path,
+    start_date: date,
+    end_date: date,
+    num_processes: Optional[int] = None,
+    bundler: Optional[Bundler] = None,
+    converter: Optional[FitConverter] = None,
+):
+    # Writes again all the files fetched by the dump commands, from the entries
+    # stored for each month and the tcxs in the response cache, without any
+    # request. The tcxs are converted in the same pool of processes as the
+    # other files, only the options of the converter are used.
+    directory.mkdir(parents=True, exist_ok=True)
+    raw_file_paths = _get_raw_file_paths(cache_directory, start_date, end_date)
+    response_cache = ResponseCache(cache_directory)
+    try:
+        tcx_blob_paths = {
+            log_id: response_cache.get_blob_path(
+                fitbit_api.get_activity_tcx_url(log_id)
+            )
+            for log_id in sorted(
+                _get_cached_log_ids(cache_directory, start_date, end_date)
+            )
+        }
+    finally:
+        response_cache.close()
+    # Activities whose tcx was skipped as predicted empty, or downloaded empty,
+    # are done without a content hash and have nothing to render.
+    empty: set[str] = set()
+    if journal_exists(cache_directory):
+        with Journal(cache_directory) as journal:
+            empty = journal.get_done_without_hash("exercise")
+    missing = [
+        str(log_id)
+        for log_id, path in tcx_blob_paths.items()
+        if not path and str(log_id) not in empty
+    ]
+    if missing:
+        logging.warning(
+            f"The tcx of {len(missing)} activities is not cached, they have to be "
+            f"fetched again: {', '.join(missing)}."
+        )
+
+    with concurrent.futures.ProcessPoolExecutor(num_processes) as executor:
+        futures: list[concurrent.futures.Future] = []
+        for kind, date_range, raw_file_path in raw_file_paths:
+            file_path = directory / f"{kind}.{date_range}.csv"
+            futures.append(executor.submit(_render_csv, kind, raw_file_path, file_path))
+        for log_id, blob_path in tcx_blob_paths.items():
+            if blob_path:
+                file_path = directory / f"exercise.{log_id}.tcx"
+                futures.append(
+                    executor.submit(
+                        _render_tcx,
+                        blob_path,
+                        file_path,
+                        converter is not None,
+                        converter is not None and converter.verify,
+                    )
                 )
-        activity_done_file_path.touch()
-        logging.info(f"{progress} Fetched activity data for {date_range}.")
+        logging.info(f"Rendering {len(futures)} files.")
+        file_paths = [
+            file_path
+            for future in concurrent.futures.as_completed(futures)
+            if (file_path := future.result())
+        ]
+    for kind, date_range, _ in raw_file_paths:
+        file_path = directory / f"{kind}.{date_range}.csv"
+        if file_path.exists():
+            _remove_superseded_files(
+                file_path, kind, date.fromisoformat(date_range[:10])
+            )
+            if bundler:
+                bundler.add_csv(kind, date.fromisoformat(date_range[:10]))
+    if bundler:
+        for file_path in sorted(file_paths):
+            if file_path.suffix in (".tcx", ".fit"):
+                bundler.add_tcx(file_path)
+    logging.info(f"Rendered {len(file_paths)} files.")
+
+
+class PlanEntry(NamedTuple):
+    kind: str
+    strategy: str
+    num_requests: int
+    # Whether num_requests is only a lower bound, e.g. when the activities are
+    # not known yet.
+    lower_bound: bool
+    # Whether the strategy is the one used with the given options.
+    selected: bool
+
+
+def plan(
+    journal: Optional[Journal],
+    cache_directory: pathlib.Path,
+    start_date: date,
+    end_date: date,
+    weight_source: Literal["log", "timeseries"] = "log",
+) -> list[PlanEntry]:
+    # Counts the requests still needed to dump all the data with the different
+    # strategies, based on what is already in the cache. Without a journal,
+    # nothing has been fetched yet.
+    def get_pending_date_pairs(kind: str) -> list[Tuple[date, date]]:
+        if journal is None:
+            return _get_month_date_pairs(start_date, end_date)
+        return _get_pending_date_pairs(journal, kind, start_date, end_date, False)
+
+    weight_date_pairs = get_pending_date_pairs("weight")
+    _, body_num_requests = _group_date_pairs(
+        weight_date_pairs,
+        fitbit_api.get_body_timeseries_resources(),
+        fitbit_api.get_body_timeseries_max_days,
+    )
+    activity_date_pairs = get_pending_date_pairs("activity")
+    _, activity_num_requests = _group_date_pairs(
+        activity_date_pairs,
+        fitbit_api.get_activity_timeseries_resources(),
+        fitbit_api.get_activity_timeseries_max_days,
+    )
+    entries = [
+        PlanEntry(
+            "weight",
+            "weight log, monthly",
+            len(weight_date_pairs),
+            False,
+            weight_source == "log",
+        ),
+        PlanEntry(
+            "weight",
+            "body timeseries, long-range",
+            sum(body_num_requests),
+            False,
+            weight_source == "timeseries",
+        ),
+        PlanEntry(
+            "activity",
+            "activity timeseries, monthly",
+            sum(
+                _count_timeseries_requests(
+                    start_date_range,
+                    end_date_range,
+                    fitbit_api.get_activity_timeseries_resources(),
+                    fitbit_api.get_activity_timeseries_max_days,
+                )
+                for start_date_range, end_date_range in activity_date_pairs
+            ),
+            False,
+            False,
+        ),
+        PlanEntry(
+            "activity",
+            "activity timeseries, long-range",
+            sum(activity_num_requests),
+            False,
+            True,
+        ),
+    ]
+
+    date_range = f"{start_date}-{end_date}"
+    activity_log_file_path = cache_directory / f".exercises.{date_range}.jsonl"
+    if (
+        journal is None
+        or not activity_log_file_path.exists()
+        or not journal.is_done("exercises", date_range)
+    ):
+        # Each partition of the activity log list takes at least one page.
+        num_partitions = len(_get_activity_log_list_partitions(start_date, end_date))
+        entries.append(
+            PlanEntry("tcx", "activity log list", num_partitions, True, True)
+        )
+        entries.append(PlanEntry("tcx", "tcx, skipping empty", 0, True, True))
+        return entries
+    num_pending, num_predicted = 0, 0
+    with activity_log_file_path.open("r") as fr:
+        for activity in map(json.loads, fr):
+            if journal.is_done("exercise", str(activity["logId"])):
+                continue
+            num_pending += 1
+            num_predicted += _should_fetch_activity_tcx(journal, activity, False)
+    entries.append(PlanEntry("tcx", "activity log list (cached)", 0, False, True))
+    entries.append(PlanEntry("tcx", "tcx, all", num_pending, False, False))
+    entries.append(PlanEntry("tcx", "tcx, skipping empty", num_predicted, False, True))
+    return entries
+
+
+def get_sync_start_date(
+    journal: Journal,
+    kind: str,
+    start_date: Optional[date],
+    recheck_days: int,
+    align_to_month: bool = False,
+) -> Optional[date]:
+    # Syncs continue from the watermark of the last one, fetching again the
+    # last days before it as their data can still change (e.g. trackers
+    # syncing late or activities being edited). The start date is only used
+    # by the first sync.
+    watermark = journal.get_watermark(kind)
+    if watermark is None:
+        return start_date
+    sync_start_date = date.fromisoformat(watermark) - timedelta(days=recheck_days)
+    if align_to_month:
+        # Monthly files are always rewritten as a whole.
+        sync_start_date = sync_start_date.replace(day=1)
+    return sync_start_date
+
+
+def get_recheck_start_date(
+    journal: Journal, kind: str, end_date: date, recheck_days: int
+) -> date:
+    # Syncs fetch again the data from this date on even if already done. The
+    # older data is only fetched if missing, e.g. for a first sync after a
+    # dump-all, which has no watermark to recheck the last days before.
+    watermark = journal.get_watermark(kind)
+    recheck_end_date = date.fromisoformat(watermark) if watermark else end_date
+    return recheck_end_date - timedelta(days=recheck_days)
+
+
+async def sync(
+    journal: Journal,
+    kind: str,
+    end_date: date,
+    func: Callable[..., Coroutine[Any, Any, Optional[date]]],
+    request_progress: Optional[Progress] = None,
+):
+    failed_date = await func(request_progress=request_progress)
+    if failed_date is not None:
+        # The watermark stops before the items that failed, so that the next
+        # sync fetches them again.
+        end_date = min(end_date, failed_date - timedelta(days=1))
+    journal.set_watermark(kind, str(end_date))
+    logging.info(f"Synced {kind} data up to {end_date}.")
+
+
+# Account of a batch export.
+class Account(NamedTuple):
+    name: str
+    cache_directory: pathlib.Path
+    directory: pathlib.Path
+    start_date: Optional[date]
+    end_date: Optional[date]
+
+
+def load_manifest(manifest_path: pathlib.Path) -> list[Account]:
+    # The manifest is a json list of accounts, e.g.
+    # [{"name": "alice", "start_date": "2020-01-01"}, {"name": "bob"}].
+    # The cache and output directories of an account default to <name>/.cache
+    # and <name>/f2g, relative paths being relative to the manifest.
+    with manifest_path.open("r") as fr:
+        entries = json.load(fr)
+    accounts = []
+    for entry in entries:
+        name = entry["name"]
+        accounts.append(
+            Account(
+                name,
+                manifest_path.parent / entry.get("cache_directory", f"{name}/.cache"),
+                manifest_path.parent / entry.get("directory", f"{name}/f2g"),
+                (
+                    date.fromisoformat(entry["start_date"])
+                    if "start_date" in entry
+                    else None
+                ),
+                date.fromisoformat(entry["end_date"]) if "end_date" in entry else None,
+            )
+        )
+    names = [account.name for account in accounts]
+    cache_directories = [account.cache_directory.resolve() for account in accounts]
+    if len(set(names)) < len(names) or len(set(cache_directories)) < len(names):
+        raise ValueError("Accounts must have distinct names and cache directories.")
+    return accounts
+
+
+def import_archive(
+    archive_path: pathlib.Path,
+    directory: pathlib.Path,
+    start_date: date,
+    end_date: date,
+    num_processes: Optional[int] = None,
+):
+    directory.mkdir(parents=True, exist_ok=True)
+
+    with zipfile.ZipFile(archive_path) as archive:
+        members = fitbit_archive.get_members(archive)
+
+    # Parse the archive files in a pool of processes, each one reading its own
+    # file directly from the archive.
+    weights: list[Dict[str, Any]] = []
+    fats: Dict[str, str] = {}
+    activity_by_date: Dict[str, Dict[str, float]] = collections.defaultdict(
+        lambda: collections.defaultdict(float)
+    )
+    exercises: Dict[int, str] = {}
+    with concurrent.futures.ProcessPoolExecutor(num_processes) as executor:
+        futures: Dict[concurrent.futures.Future, str] = {
+            executor.submit(
+                fitbit_archive.parse_activity_member, str(archive_path), name, kind
+            ): kind
+            for kind, kind_members in members.items()
+            if kind not in ("weight", "fat", "exercise")
+            for name, member_date in kind_members
+            if member_date <= end_date
+        }
+        futures.update(
+            (
+                executor.submit(
+                    fitbit_archive.parse_weight_member, str(archive_path), name
+                ),
+                kind,
+            )
+            for kind in ("weight", "fat")
+            for name, member_date in members[kind]
+            if member_date <= end_date
+        )
+        futures.update(
+            (
+                executor.submit(
+                    fitbit_archive.parse_exercise_member, str(archive_path), name
+                ),
+                "exercise",
+            )
+            for name, _ in members["exercise"]
+        )
+        logging.info(f"Parsing {len(futures)} archive files.")
+        for future in concurrent.futures.as_completed(futures):
+            kind = futures[future]
+            if kind == "weight":
+                weights.extend(future.result())
+            elif kind == "fat":
+                fats.update((entry["date"], entry["fat"]) for entry in future.result())
+            elif kind == "exercise":
+                exercises.update(future.result())
+            else:
+                resource = fitbit_archive.get_activity_resource(kind)
+                for activity_date, value in future.result().items():
+                    activity_by_date[activity_date][resource] += value
+
+    # Split the data into monthly files.
+    for start_date_range, end_date_range in _get_month_date_pairs(start_date, end_date):
+        date_range = f"{start_date_range}-{end_date_range}"
+        weight_entries = sorted(
+            (
+                {"fat": fats.get(weight["date"], "0"), **weight}
+                for weight in weights
+                if str(start_date_range) <= weight["date"] <= str(end_date_range)
+            ),
+            key=lambda weight: (weight["date"], weight.get("time", "")),
+        )
+        if weight_entries:
+            garmin_export.write_csv(
+                "weight", directory / f"weight.{date_range}.csv", weight_entries
+            )
+        activity_entries = [
+            {
+                "date": activity_date,
+                "calories": round(activity["calories"]),
+                "steps": round(activity["steps"]),
+                "distance": round(activity["distance"], 2),
+                "floors": round(activity["floors"]),
+                "minutesSedentary": round(activity["minutesSedentary"]),
+                "minutesLightlyActive": round(activity["minutesLightlyActive"]),
+                "minutesFairlyActive": round(activity["minutesFairlyActive"]),
+                "minutesVeryActive": round(activity["minutesVeryActive"]),
+                # Not part of the archive.
+                "activityCalories": 0,
+            }
+            for activity_date, activity in sorted(activity_by_date.items())
+            if str(start_date_range) <= activity_date <= str(end_date_range)
+            and activity["steps"] > 0
+        ]
+        if activity_entries:
+            garmin_export.write_csv(
+                "activity", directory / f"activity.{date_range}.csv", activity_entries
+            )
+        logging.info(f"Imported weight and activity data for {date_range}.")
+
+    # Copy the tcx of each exercise in the date range, streaming it out of the
+    # archive.
+    with zipfile.ZipFile(archive_path) as archive:
+        tcx_members = fitbit_archive.get_tcx_members(archive)
+        for i, (log_id, name) in enumerate(sorted(tcx_members.items())):
+            progress = f"[{i+1}/{len(tcx_members)}]"
+            exercise_date = exercises.get(log_id)
+            if exercise_date and not str(start_date) <= exercise_date <= str(end_date):
+                continue
+            activity_tcx_file_path = directory / f"exercise.{log_id}.tcx"
+            if not garmin_export.write_tcx_chunks(
+                fitbit_archive.iter_tcx_member(archive, name), activity_tcx_file_path
+            ):
+                logging.info(f"{progress} Activity {log_id} has an empty tcx.")
+                continue
+            logging.info(f"{progress} Activity {log_id} imported.")
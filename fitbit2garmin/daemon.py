@@ -0,0 +1,193 @@
+import asyncio
+import contextlib
+import logging
+import pathlib
+import signal
+import time
+
+from collections.abc import Callable
+from datetime import date, datetime
+from typing import Any, Dict, Final, Literal, Optional
+
+import aiohttp.web
+
+from . import metrics, rate_limiter
+from .journal import Journal
+from .rate_limiter import RateLimiter
+from .scheduler import Scheduler
+
+_SOCKET_FILE_NAME: Final[str] = ".serve.sock"
+_SYNC_INTERVAL: Final[float] = 60 * 60
+# Requests of each rate limit window left to the syncs by the backfill.
+_SYNC_RESERVE: Final[int] = 30
+_KINDS: Final[tuple[str, ...]] = ("weight", "activity", "tcx")
+
+BackfillState = Literal["disabled", "running", "done", "failed"]
+
+
+def _format_ts(ts: Optional[float]) -> Optional[str]:
+    if ts is None:
+        return None
+    return datetime.fromtimestamp(ts).isoformat(timespec="seconds")
+
+
+def _get_progress(scheduler: Optional[Scheduler]) -> list[Dict[str, Any]]:
+    if scheduler is None:
+        return []
+    return [
+        {"name": progress.name, "done": progress.done, "total": progress.total}
+        for progress in scheduler.progresses
+    ]
+
+
+# Long-running process syncing the data of an account on a schedule. The client
+# (session, authorization and rate limit budget) and the journal (and its index
+# of the completed items) are kept open between the syncs, and the requests left
+# by the syncs in each rate limit window are spent backfilling the older data.
+# Syncs are triggered and the status is queried over HTTP on a Unix socket, e.g.
+# curl --unix-socket .cache/.serve.sock http://localhost/status
+class Daemon:
+    def __init__(
+        self,
+        cache_directory: pathlib.Path,
+        journal: Journal,
+        limiter: RateLimiter,
+        get_sync_scheduler: Callable[[date], Scheduler],
+        backfill_scheduler: Optional[Scheduler] = None,
+        sync_interval: float = _SYNC_INTERVAL,
+        sync_reserve: int = _SYNC_RESERVE,
+    ):
+        self._cache_directory = cache_directory
+        self._journal = journal
+        self._limiter = limiter
+        self._get_sync_scheduler = get_sync_scheduler
+        self._backfill_scheduler = backfill_scheduler
+        self._sync_interval = sync_interval
+        self._sync_reserve = sync_reserve
+        self._sync_scheduler: Optional[Scheduler] = None
+        self._syncing = False
+        self._num_syncs = 0
+        self._num_failed_syncs = 0
+        self._last_sync: Dict[str, Any] = {}
+        self._next_sync_ts: Optional[float] = None
+        self._backfill_state: BackfillState = (
+            "running" if backfill_scheduler else "disabled"
+        )
+        self._trigger: Optional[asyncio.Event] = None
+
+    async def run(self, socket_path: Optional[pathlib.Path] = None) -> None:
+        socket_path = socket_path or self._cache_directory / _SOCKET_FILE_NAME
+        self._trigger = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        task = asyncio.current_task()
+        assert task
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, task.cancel)
+        runner = aiohttp.web.AppRunner(self._get_app())
+        await runner.setup()
+        # A socket left by a daemon that did not exit cleanly is replaced.
+        socket_path.unlink(missing_ok=True)
+        await aiohttp.web.UnixSite(runner, str(socket_path)).start()
+        logging.info(f"Listening on {socket_path}.")
+        backfill = (
+            asyncio.ensure_future(self._backfill())
+            if self._backfill_scheduler
+            else None
+        )
+        try:
+            while True:
+                await self._sync()
+                self._next_sync_ts = time.time() + self._sync_interval
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self._trigger.wait(), self._sync_interval)
+                self._trigger.clear()
+                self._next_sync_ts = None
+        except asyncio.CancelledError:
+            logging.info("Stopping.")
+        finally:
+            if backfill:
+                backfill.cancel()
+                await asyncio.gather(backfill, return_exceptions=True)
+            await runner.cleanup()
+            socket_path.unlink(missing_ok=True)
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                loop.remove_signal_handler(signum)
+
+    def trigger(self) -> None:
+        # Syncs triggered while one is running start as soon as it finishes.
+        assert self._trigger
+        self._trigger.set()
+
+    def get_status(self) -> Dict[str, Any]:
+        state = self._limiter.state
+        return {
+            "state": "syncing" if self._syncing else "idle",
+            "syncs": self._num_syncs,
+            "failed_syncs": self._num_failed_syncs,
+            "last_sync": self._last_sync,
+            "next_sync_at": _format_ts(self._next_sync_ts),
+            "sync_progress": _get_progress(self._sync_scheduler),
+            "watermarks": {kind: self._journal.get_watermark(kind) for kind in _KINDS},
+            "backfill": {
+                "state": self._backfill_state,
+                "progress": _get_progress(self._backfill_scheduler),
+            },
+            "rate_limit": {
+                "limit": state.limit,
+                "remaining": state.remaining,
+                "reset_at": _format_ts(state.reset_ts),
+            },
+        }
+
+    async def _sync(self) -> None:
+        self._syncing = True
+        start_ts = time.time()
+        self._last_sync = {"started_at": _format_ts(start_ts)}
+        try:
+            self._sync_scheduler = self._get_sync_scheduler(date.today())
+            await self._sync_scheduler.run()
+        except Exception as err:  # pylint: disable=broad-exception-caught
+            # The data of a failed sync is fetched again by the next one.
+            logging.exception("The sync failed.")
+            self._num_failed_syncs += 1
+            self._last_sync["error"] = repr(err)
+        else:
+            self._num_syncs += 1
+        finally:
+            self._syncing = False
+        self._last_sync["finished_at"] = _format_ts(time.time())
+        metrics.get().write(self._cache_directory)
+
+    async def _backfill(self) -> None:
+        assert self._backfill_scheduler
+        try:
+            with rate_limiter.reserve(self._sync_reserve):
+                await self._backfill_scheduler.run()
+        except Exception:  # pylint: disable=broad-exception-caught
+            # The data left out is fetched again when the daemon is restarted.
+            logging.exception("The backfill failed.")
+            self._backfill_state = "failed"
+        else:
+            logging.info("The backfill is done.")
+            self._backfill_state = "done"
+
+    def _get_app(self) -> aiohttp.web.Application:
+        async def get_status(_: aiohttp.web.Request) -> aiohttp.web.Response:
+            return aiohttp.web.json_response(self.get_status())
+
+        async def post_sync(_: aiohttp.web.Request) -> aiohttp.web.Response:
+            self.trigger()
+            return aiohttp.web.json_response(self.get_status(), status=202)
+
+        async def get_metrics(_: aiohttp.web.Request) -> aiohttp.web.Response:
+            return aiohttp.web.Response(text=metrics.get().to_prometheus())
+
+        app = aiohttp.web.Application()
+        app.add_routes(
+            [
+                aiohttp.web.get("/status", get_status),
+                aiohttp.web.post("/sync", post_sync),
+                aiohttp.web.get("/metrics", get_metrics),
+            ]
+        )
+        return app
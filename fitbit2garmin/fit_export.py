@@ -0,0 +1,609 @@
+import asyncio
+import concurrent.futures
+import functools
+import hashlib
+import math
+import pathlib
+import struct
+
+from datetime import datetime, timedelta, timezone
+from typing import BinaryIO, Dict, Final, Iterator, NamedTuple, Optional, Tuple, Union
+from xml.etree import ElementTree
+
+from . import metrics
+
+_FIT_EPOCH: Final[datetime] = datetime(1989, 12, 31, tzinfo=timezone.utc)
+_FIT_PROTOCOL_VERSION: Final[int] = 0x20
+_FIT_PROFILE_VERSION: Final[int] = 2132
+_FIT_HEADER_SIZE: Final[int] = 14
+# Developer manufacturer, as the files are not written by a Garmin device.
+_FIT_MANUFACTURER: Final[int] = 255
+_FIT_SPORTS: Final[Dict[str, int]] = {"Running": 1, "Biking": 2}
+# Base types as (number, struct format, invalid value).
+_ENUM: Final[Tuple[int, str, int]] = (0x00, "B", 0xFF)
+_UINT8: Final[Tuple[int, str, int]] = (0x02, "B", 0xFF)
+_UINT16: Final[Tuple[int, str, int]] = (0x84, "H", 0xFFFF)
+_SINT32: Final[Tuple[int, str, int]] = (0x85, "i", 0x7FFFFFFF)
+_UINT32: Final[Tuple[int, str, int]] = (0x86, "I", 0xFFFFFFFF)
+_UINT32Z: Final[Tuple[int, str, int]] = (0x8C, "I", 0)
+# Messages written, as (global message number, fields as (name, field number,
+# base type)), in the order of their local message types.
+_MESSAGES: Final[Dict[str, Tuple[int, list[Tuple[str, int, Tuple[int, str, int]]]]]] = {
+    "file_id": (
+        0,
+        [
+            ("type", 0, _ENUM),
+            ("manufacturer", 1, _UINT16),
+            ("product", 2, _UINT16),
+            ("serial_number", 3, _UINT32Z),
+            ("time_created", 4, _UINT32),
+        ],
+    ),
+    "event": (
+        21,
+        [
+            ("timestamp", 253, _UINT32),
+            ("event", 0, _ENUM),
+            ("event_type", 1, _ENUM),
+        ],
+    ),
+    "record": (
+        20,
+        [
+            ("timestamp", 253, _UINT32),
+            ("position_lat", 0, _SINT32),
+            ("position_long", 1, _SINT32),
+            ("altitude", 2, _UINT16),
+            ("heart_rate", 3, _UINT8),
+            ("cadence", 4, _UINT8),
+            ("distance", 5, _UINT32),
+        ],
+    ),
+    "lap": (
+        19,
+        [
+            ("timestamp", 253, _UINT32),
+            ("event", 0, _ENUM),
+            ("event_type", 1, _ENUM),
+            ("start_time", 2, _UINT32),
+            ("total_elapsed_time", 7, _UINT32),
+            ("total_timer_time", 8, _UINT32),
+            ("total_distance", 9, _UINT32),
+            ("total_calories", 11, _UINT16),
+            ("avg_heart_rate", 15, _UINT8),
+            ("max_heart_rate", 16, _UINT8),
+            ("sport", 25, _ENUM),
+        ],
+    ),
+    "session": (
+        18,
+        [
+            ("timestamp", 253, _UINT32),
+            ("event", 0, _ENUM),
+            ("event_type", 1, _ENUM),
+            ("start_time", 2, _UINT32),
+            ("sport", 5, _ENUM),
+            ("total_elapsed_time", 7, _UINT32),
+            ("total_timer_time", 8, _UINT32),
+            ("total_distance", 9, _UINT32),
+            ("total_calories", 11, _UINT16),
+            ("avg_heart_rate", 16, _UINT8),
+            ("max_heart_rate", 17, _UINT8),
+            ("first_lap_index", 25, _UINT16),
+            ("num_laps", 26, _UINT16),
+        ],
+    ),
+    "activity": (
+        34,
+        [
+            ("timestamp", 253, _UINT32),
+            ("total_timer_time", 0, _UINT32),
+            ("num_sessions", 1, _UINT16),
+            ("type", 2, _ENUM),
+            ("event", 3, _ENUM),
+            ("event_type", 4, _ENUM),
+        ],
+    ),
+}
+_LAP_MESSAGE: Final[int] = 19
+_RECORD_MESSAGE: Final[int] = 20
+# Formats of the base types read back, by (base type, size).
+_FIT_FORMATS: Final[Dict[Tuple[int, int], Tuple[str, int]]] = {
+    (base_type[0], struct.calcsize(base_type[1])): base_type[1:]
+    for base_type in (_ENUM, _UINT8, _UINT16, _SINT32, _UINT32, _UINT32Z)
+}
+
+
+def _get_crc_table() -> list[int]:
+    # CRC-16/ARC, the checksum of the fit files.
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+_CRC_TABLE: Final[list[int]] = _get_crc_table()
+
+
+def _get_crc(data: bytes, crc: int = 0) -> int:
+    for byte in data:
+        crc = (crc >> 8) ^ _CRC_TABLE[(crc ^ byte) & 0xFF]
+    return crc
+
+
+class _Trackpoint(NamedTuple):
+    time: Optional[datetime]
+    latitude: Optional[float]
+    longitude: Optional[float]
+    altitude: Optional[float]
+    distance: Optional[float]
+    heart_rate: Optional[int]
+    cadence: Optional[int]
+
+
+class _Lap(NamedTuple):
+    start_time: Optional[datetime]
+    end_time: Optional[datetime]
+    total_time: float
+    distance: float
+    calories: int
+    average_heart_rate: Optional[int]
+    maximum_heart_rate: Optional[int]
+
+
+# Counts and totals of an exercise compared between a tcx and its fit.
+class ExerciseSummary(NamedTuple):
+    num_laps: int
+    num_trackpoints: int
+    num_positions: int
+    num_heart_rates: int
+    distance: float
+    total_time: float
+    calories: int
+
+
+def _parse_time(text: Optional[str]) -> Optional[datetime]:
+    # e.g. "2020-01-01T07:00:00.000+01:00" or "2020-01-01T07:00:00Z"
+    if not text:
+        return None
+    time_ = datetime.fromisoformat(text.strip().replace("Z", "+00:00"))
+    return time_ if time_.tzinfo else time_.replace(tzinfo=timezone.utc)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_tag(name: str) -> str:
+    # e.g. "Trackpoint" for "{http://www.garmin.com/...}Trackpoint"
+    return name.rpartition("}")[2]
+
+
+def _get_texts(element: ElementTree.Element) -> Dict[str, Optional[str]]:
+    # Texts of the children of the element, and of theirs, by path, e.g.
+    # "Time" and "Position/LatitudeDegrees" for a trackpoint.
+    texts = {}
+    for child in element:
+        tag = _get_tag(child.tag)
+        if len(child):
+            for grandchild in child:
+                texts[f"{tag}/{_get_tag(grandchild.tag)}"] = grandchild.text
+        else:
+            texts[tag] = child.text
+    return texts
+
+
+def _get_number(texts: Dict[str, Optional[str]], path: str) -> Optional[float]:
+    text = texts.get(path)
+    return float(text) if text and text.strip() else None
+
+
+def _iter_tcx(
+    source: Union[pathlib.Path, BinaryIO],
+) -> Iterator[Union[str, _Lap, _Trackpoint]]:
+    # Yields the sport of each activity, then its trackpoints, with each lap
+    # following its own trackpoints. Elements are dropped once read, hence the
+    # tcx is never fully loaded in memory. The totals missing from a lap are
+    # computed from its trackpoints.
+    lap_start_time: Optional[datetime] = None
+    lap_end_time: Optional[datetime] = None
+    start_distance = end_distance = 0.0
+    for event, element in ElementTree.iterparse(source, events=("start", "end")):
+        tag = _get_tag(element.tag)
+        if event == "start":
+            if tag == "Activity":
+                yield element.get("Sport", "Other")
+            elif tag == "Lap":
+                lap_start_time = _parse_time(element.get("StartTime"))
+                lap_end_time = None
+                start_distance = end_distance
+            continue
+        if tag == "Trackpoint":
+            texts = _get_texts(element)
+            trackpoint = _Trackpoint(
+                _parse_time(texts.get("Time")),
+                _get_number(texts, "Position/LatitudeDegrees"),
+                _get_number(texts, "Position/LongitudeDegrees"),
+                _get_number(texts, "AltitudeMeters"),
+                _get_number(texts, "DistanceMeters"),
+                _to_int(_get_number(texts, "HeartRateBpm/Value")),
+                _to_int(_get_number(texts, "Cadence")),
+            )
+            lap_end_time = trackpoint.time or lap_end_time
+            if trackpoint.distance is not None:
+                end_distance = max(end_distance, trackpoint.distance)
+            element.clear()
+            yield trackpoint
+        elif tag == "Track":
+            element.clear()
+        elif tag == "Lap":
+            texts = _get_texts(element)
+            total_time = _get_number(texts, "TotalTimeSeconds")
+            if total_time is None:
+                total_time = (
+                    (lap_end_time - lap_start_time).total_seconds()
+                    if lap_start_time and lap_end_time
+                    else 0.0
+                )
+            distance = _get_number(texts, "DistanceMeters")
+            yield _Lap(
+                lap_start_time,
+                lap_end_time,
+                total_time,
+                distance if distance is not None else end_distance - start_distance,
+                _to_int(_get_number(texts, "Calories")) or 0,
+                _to_int(_get_number(texts, "AverageHeartRateBpm/Value")),
+                _to_int(_get_number(texts, "MaximumHeartRateBpm/Value")),
+            )
+            element.clear()
+
+
+def _to_int(value: Optional[float]) -> Optional[int]:
+    return round(value) if value is not None else None
+
+
+def _get_fit_time(time_: datetime) -> int:
+    return round((time_ - _FIT_EPOCH).total_seconds())
+
+
+def _get_semicircles(degrees: Optional[float]) -> Optional[int]:
+    return round(degrees * 2**31 / 180) if degrees is not None else None
+
+
+def _get_scaled(
+    value: Optional[float], scale: float, offset: float = 0.0
+) -> Optional[int]:
+    return round((value + offset) * scale) if value is not None else None
+
+
+# Fit file written one message at a time, each message type being defined
+# before its first message.
+class _FitWriter:
+    def __init__(self):
+        self._data = bytearray()
+        self._structs: Dict[str, Tuple[int, struct.Struct]] = {}
+
+    def write(self, name: str, **values: Optional[int]) -> None:
+        global_number, fields = _MESSAGES[name]
+        if name not in self._structs:
+            local_type = len(self._structs)
+            self._data += struct.pack(
+                "<BBBHB", 0x40 | local_type, 0, 0, global_number, len(fields)
+            )
+            for _, number, (base_type, fmt, _) in fields:
+                self._data += struct.pack(
+                    "<BBB", number, struct.calcsize(fmt), base_type
+                )
+            self._structs[name] = (
+                local_type,
+                struct.Struct("<B" + "".join(fmt for _, _, (_, fmt, _) in fields)),
+            )
+        local_type, message_struct = self._structs[name]
+        self._data += message_struct.pack(
+            local_type,
+            *(
+                _get_valid(values.get(field_name), base_type)
+                for field_name, _, base_type in fields
+            ),
+        )
+
+    def getvalue(self) -> bytes:
+        header = struct.pack(
+            "<BBHI4s",
+            _FIT_HEADER_SIZE,
+            _FIT_PROTOCOL_VERSION,
+            _FIT_PROFILE_VERSION,
+            len(self._data),
+            b".FIT",
+        )
+        header += struct.pack("<H", _get_crc(header))
+        crc = _get_crc(self._data, _get_crc(header))
+        return header + bytes(self._data) + struct.pack("<H", crc)
+
+
+def _get_valid(value: Optional[int], base_type: Tuple[int, str, int]) -> int:
+    # Values missing or out of the range of the field are written as invalid.
+    _, fmt, invalid = base_type
+    if value is None:
+        return invalid
+    if fmt.islower():
+        bound = 2 ** (8 * struct.calcsize(fmt) - 1)
+        return value if -bound <= value < bound - 1 else invalid
+    return value if 0 <= value < 2 ** (8 * struct.calcsize(fmt)) - 1 else invalid
+
+
+def _encode_fit(
+    source: Union[pathlib.Path, BinaryIO],
+) -> Tuple[bytes, ExerciseSummary]:
+    # Returns the fit file, and the summary of the tcx read along the way.
+    writer = _FitWriter()
+    sport = 0
+    start_time: Optional[datetime] = None
+    last_time: Optional[datetime] = None
+    laps: list[_Lap] = []
+    num_trackpoints = num_positions = num_heart_rates = 0
+
+    def start(time_: Optional[datetime]) -> None:
+        nonlocal start_time
+        if start_time is None and time_ is not None:
+            start_time = time_
+            writer.write(
+                "file_id",
+                type=4,
+                manufacturer=_FIT_MANUFACTURER,
+                time_created=_get_fit_time(time_),
+            )
+            writer.write("event", timestamp=_get_fit_time(time_), event=0, event_type=0)
+
+    for item in _iter_tcx(source):
+        if isinstance(item, str):
+            sport = _FIT_SPORTS.get(item, 0)
+        elif isinstance(item, _Trackpoint):
+            # Trackpoints without time are given the one of the previous one.
+            last_time = item.time or last_time
+            start(last_time)
+            if last_time is None:
+                raise ValueError("The first trackpoint of the tcx has no time.")
+            has_position = item.latitude is not None and item.longitude is not None
+            num_trackpoints += 1
+            num_positions += has_position
+            num_heart_rates += item.heart_rate is not None
+            writer.write(
+                "record",
+                timestamp=_get_fit_time(last_time),
+                position_lat=_get_semicircles(item.latitude if has_position else None),
+                position_long=_get_semicircles(
+                    item.longitude if has_position else None
+                ),
+                altitude=_get_scaled(item.altitude, 5, 500),
+                heart_rate=item.heart_rate,
+                cadence=item.cadence,
+                distance=_get_scaled(item.distance, 100),
+            )
+        else:
+            start(item.start_time)
+            lap_start_time = item.start_time or last_time or start_time
+            if lap_start_time is None:
+                raise ValueError("The laps of the tcx have no time.")
+            lap_end_time = item.end_time or lap_start_time + timedelta(
+                seconds=item.total_time
+            )
+            last_time = max(last_time or lap_end_time, lap_end_time)
+            laps.append(item)
+            writer.write(
+                "lap",
+                timestamp=_get_fit_time(lap_end_time),
+                event=9,
+                event_type=1,
+                start_time=_get_fit_time(lap_start_time),
+                total_elapsed_time=_get_scaled(item.total_time, 1000),
+                total_timer_time=_get_scaled(item.total_time, 1000),
+                total_distance=_get_scaled(item.distance, 100),
+                total_calories=item.calories,
+                avg_heart_rate=item.average_heart_rate,
+                max_heart_rate=item.maximum_heart_rate,
+                sport=sport,
+            )
+    if start_time is None or last_time is None:
+        raise ValueError("The tcx has no trackpoints nor laps.")
+
+    total_time = sum(lap.total_time for lap in laps)
+    distance = sum(lap.distance for lap in laps)
+    calories = sum(lap.calories for lap in laps)
+    timed_heart_rates = [
+        (lap.average_heart_rate, lap.total_time)
+        for lap in laps
+        if lap.average_heart_rate is not None
+    ]
+    heart_rate_time = sum(lap_time for _, lap_time in timed_heart_rates)
+    maximum_heart_rates = [
+        lap.maximum_heart_rate for lap in laps if lap.maximum_heart_rate is not None
+    ]
+    timestamp = _get_fit_time(last_time)
+    writer.write("event", timestamp=timestamp, event=0, event_type=4)
+    writer.write(
+        "session",
+        timestamp=timestamp,
+        event=8,
+        event_type=1,
+        start_time=_get_fit_time(start_time),
+        sport=sport,
+        total_elapsed_time=_get_scaled(total_time, 1000),
+        total_timer_time=_get_scaled(total_time, 1000),
+        total_distance=_get_scaled(distance, 100),
+        total_calories=calories,
+        avg_heart_rate=(
+            round(
+                sum(rate * time_ for rate, time_ in timed_heart_rates) / heart_rate_time
+            )
+            if heart_rate_time
+            else None
+        ),
+        max_heart_rate=max(maximum_heart_rates, default=None),
+        first_lap_index=0,
+        num_laps=len(laps),
+    )
+    writer.write(
+        "activity",
+        timestamp=timestamp,
+        total_timer_time=_get_scaled(total_time, 1000),
+        num_sessions=1,
+        type=0,
+        event=26,
+        event_type=1,
+    )
+    return writer.getvalue(), ExerciseSummary(
+        len(laps),
+        num_trackpoints,
+        num_positions,
+        num_heart_rates,
+        distance,
+        total_time,
+        calories,
+    )
+
+
+def _iter_fit_messages(content: bytes) -> Iterator[Tuple[int, Dict[int, int]]]:
+    # Yields the global number and the valid values of the fields of each
+    # message, by field number. Developer fields are skipped.
+    header_size = content[0]
+    (data_size,) = struct.unpack_from("<I", content, 4)
+    end = header_size + data_size
+    if content[8:12] != b".FIT" or _get_crc(content[: end + 2]) != 0:
+        raise ValueError("The fit file is corrupted.")
+    definitions: Dict[int, Tuple[int, str, list[Tuple[int, int, int]], int]] = {}
+    position = header_size
+    while position < end:
+        record_header = content[position]
+        position += 1
+        if record_header & 0x80:
+            raise ValueError("Compressed timestamp headers are not supported.")
+        local_type = record_header & 0x0F
+        if record_header & 0x40:
+            endianness = ">" if content[position + 1] else "<"
+            (global_number,) = struct.unpack_from(
+                f"{endianness}H", content, position + 2
+            )
+            num_fields = content[position + 4]
+            position += 5
+            fields = [
+                (content[i], content[i + 1], content[i + 2])
+                for i in range(position, position + 3 * num_fields, 3)
+            ]
+            position += 3 * num_fields
+            developer_size = 0
+            if record_header & 0x20:
+                num_developer_fields = content[position]
+                developer_size = sum(
+                    content[position + 2 + 3 * i] for i in range(num_developer_fields)
+                )
+                position += 1 + 3 * num_developer_fields
+            definitions[local_type] = (
+                global_number,
+                endianness,
+                fields,
+                developer_size,
+            )
+            continue
+        global_number, endianness, fields, developer_size = definitions[local_type]
+        values = {}
+        for number, size, base_type in fields:
+            if (base_type, size) in _FIT_FORMATS:
+                fmt, invalid = _FIT_FORMATS[base_type, size]
+                (value,) = struct.unpack_from(endianness + fmt, content, position)
+                if value != invalid:
+                    values[number] = value
+            position += size
+        position += developer_size
+        yield global_number, values
+
+
+def summarize_fit(content: bytes) -> ExerciseSummary:
+    num_laps = num_trackpoints = num_positions = num_heart_rates = calories = 0
+    distance = total_time = 0.0
+    for global_number, values in _iter_fit_messages(content):
+        if global_number == _RECORD_MESSAGE:
+            num_trackpoints += 1
+            num_positions += 0 in values and 1 in values
+            num_heart_rates += 3 in values
+        elif global_number == _LAP_MESSAGE:
+            num_laps += 1
+            distance += values.get(9, 0) / 100
+            total_time += values.get(8, 0) / 1000
+            calories += values.get(11, 0)
+    return ExerciseSummary(
+        num_laps,
+        num_trackpoints,
+        num_positions,
+        num_heart_rates,
+        distance,
+        total_time,
+        calories,
+    )
+
+
+def _get_mismatches(expected: ExerciseSummary, actual: ExerciseSummary) -> list[str]:
+    # Totals are rounded to centimeters and milliseconds by lap in the fit.
+    tolerances = {"distance": 0.01, "total_time": 0.001}
+    return [
+        f"{name} {expected_value} != {actual_value}"
+        for name, expected_value, actual_value in zip(
+            ExerciseSummary._fields, expected, actual
+        )
+        if not math.isclose(
+            expected_value,
+            actual_value,
+            rel_tol=0,
+            abs_tol=tolerances.get(name, 0) * max(expected.num_laps, 1) + 1e-9,
+        )
+    ]
+
+
+def convert_tcx(
+    source: Union[pathlib.Path, BinaryIO],
+    file_path: pathlib.Path,
+    verify: bool = False,
+) -> str:
+    # Writes the tcx as a fit file, returning its sha256. When verifying, the
+    # fit is read back and compared with the tcx, raising a ValueError (and
+    # writing no file) if they differ. A malformed tcx, e.g. a truncated one,
+    # raises a ValueError as well.
+    try:
+        content, tcx_summary = _encode_fit(source)
+    except ElementTree.ParseError as err:
+        raise ValueError(f"The tcx is malformed: {err}.") from err
+    if verify:
+        mismatches = _get_mismatches(tcx_summary, summarize_fit(content))
+        if mismatches:
+            raise ValueError(f"The fit differs from the tcx: {', '.join(mismatches)}.")
+    temp_file_path = file_path.with_name(f"{file_path.name}.part")
+    temp_file_path.write_bytes(content)
+    temp_file_path.replace(file_path)
+    return hashlib.sha256(content).hexdigest()
+
+
+# Converts the tcxs written by the dump commands into fit files, which are
+# several times smaller, in a pool of processes not to hold the downloads. The
+# tcxs are removed once converted.
+class FitConverter:
+    def __init__(self, verify: bool = False, num_processes: Optional[int] = None):
+        self.verify = verify
+        self._executor = concurrent.futures.ProcessPoolExecutor(num_processes)
+
+    def __enter__(self) -> "FitConverter":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._executor.shutdown()
+
+    async def convert(self, tcx_path: pathlib.Path) -> pathlib.Path:
+        file_path = tcx_path.with_suffix(".fit")
+        with metrics.get().timer("convert_seconds", kind="fit"):
+            await asyncio.get_running_loop().run_in_executor(
+                self._executor, convert_tcx, tcx_path, file_path, self.verify
+            )
+        tcx_path.unlink()
+        return file_path
@@ -5,7 +5,7 @@ import os
 import urllib
 import urllib.parse
 from datetime import date
-from typing import Annotated, Dict, Final, Literal, Mapping
+from typing import Annotated, Any, Dict, Final, Literal, Mapping
 
 from annotated_types import Ge, Gt
 
@@ -27,7 +27,10 @@ _API_OAUTH2_BASE_URL = "https://www.fitbit.com/oauth2"
 
 # https://dev.fitbit.com/build/reference/web-api/developer-guide/getting-started/
 
-_API_BASE_URL: Final[str] = "https://api.fitbit.com"
+# Can be pointed to a local stand-in server, e.g. the one in benchmarks/.
+_API_BASE_URL: Final[str] = os.environ.get(
+    "FITBIT2GARMIN_API_BASE_URL", "https://api.fitbit.com"
+)
 _API_VERSION: Final[int] = 1
 _API_DATE_FORMAT: Final[str] = "%Y-%m-%d"
 
@@ -107,6 +110,28 @@ def get_activity_tcx_url(log_id: int, user: str = "-"):
     return f"{_API_BASE_URL}/{_API_VERSION}/user/{user}/activities/{log_id}.tcx"
 
 
+def get_activity_date(activity: Mapping[str, Any]) -> date:
+    # The start time is in the local time of the user, e.g.
+    # "2020-01-01T08:00:00.000+01:00", hence its date is the first 10 chars.
+    return date.fromisoformat(activity["originalStartTime"][:10])
+
+
+def is_activity_tcx_empty(activity: Mapping[str, Any]) -> bool:
+    # Whether the tcx of an entry of the activity log list certainly has no
+    # trackpoints. Trackpoints only come from GPS and heart rate samples, which
+    # auto detected activities and activities logged by hand without a device
+    # do not have.
+    if activity["logType"] == "auto_detected" or activity.get("duration", 1) <= 0:
+        return True
+    return (
+        activity["logType"] == "manual"
+        and not activity.get("hasGps", False)
+        and "source" not in activity
+        and "heartRateLink" not in activity
+        and "averageHeartRate" not in activity
+    )
+
+
 # https://dev.fitbit.com/build/reference/web-api/body-timeseries/get-weight-timeseries-by-date-range/
 
 
@@ -120,15 +145,68 @@ def get_weight_timeseries_url(start_date: date, end_date: date, user: str = "-")
     return f"{_API_BASE_URL}/{_API_VERSION}/user/{user}/body/log/weight/date/{start_date.strftime(_API_DATE_FORMAT)}/{end_date.strftime(_API_DATE_FORMAT)}.json"
 
 
+# https://dev.fitbit.com/build/reference/web-api/body-timeseries/get-body-timeseries-by-date-range/
+
+
+_BODY_TIMESERIES_MAX_DAYS: Final[Dict[str, int]] = {
+    "bmi": 1095,
+    "fat": 1095,
+    "weight": 1095,
+}
+
+
+def get_body_timeseries_url(
+    resource: str, start_date: date, end_date: date, user: str = "-"
+):
+    if start_date > end_date:
+        raise ValueError(f"start date {start_date} is after end date {end_date}.")
+    max_days = get_body_timeseries_max_days(resource)
+    if end_date - relativedelta(days=max_days) > start_date:
+        raise ValueError(
+            f"end date {end_date} is more than {max_days} days apart from start date {start_date}."
+        )
+    return f"{_API_BASE_URL}/{_API_VERSION}/user/{user}/body/{resource}/date/{start_date.strftime(_API_DATE_FORMAT)}/{end_date.strftime(_API_DATE_FORMAT)}.json"
+
+
+def get_body_timeseries_resources():
+    return [
+        "weight",
+        "bmi",
+        "fat",
+    ]
+
+
+def get_body_timeseries_max_days(resource: str) -> int:
+    return _BODY_TIMESERIES_MAX_DAYS[resource]
+
+
 # https://dev.fitbit.com/build/reference/web-api/activity-timeseries/get-activity-timeseries-by-date-range/
 
 
+_ACTIVITY_TIMESERIES_MAX_DAYS: Final[Dict[str, int]] = {
+    "activityCalories": 30,
+    "calories": 1095,
+    "distance": 1095,
+    "floors": 1095,
+    "minutesSedentary": 1095,
+    "minutesLightlyActive": 1095,
+    "minutesFairlyActive": 1095,
+    "minutesVeryActive": 1095,
+    "steps": 1095,
+}
+
+
 def get_activity_timeseries_url(
     resource: str, start_date: date, end_date: date, user: str = "-"
 ):
     if start_date > end_date:
         raise ValueError(f"start date {start_date} is after end date {end_date}.")
-    return f"https://api.fitbit.com/1/user/{user}/activities/{resource}/date/{start_date.strftime(_API_DATE_FORMAT)}/{end_date.strftime(_API_DATE_FORMAT)}.json"
+    max_days = get_activity_timeseries_max_days(resource)
+    if end_date - relativedelta(days=max_days) > start_date:
+        raise ValueError(
+            f"end date {end_date} is more than {max_days} days apart from start date {start_date}."
+        )
+    return f"{_API_BASE_URL}/{_API_VERSION}/user/{user}/activities/{resource}/date/{start_date.strftime(_API_DATE_FORMAT)}/{end_date.strftime(_API_DATE_FORMAT)}.json"
 
 
 def get_activity_timeseries_resources():
@@ -143,3 +221,7 @@ def get_activity_timeseries_resources():
         "minutesVeryActive",
         "steps",
     ]
+
+
+def get_activity_timeseries_max_days(resource: str) -> int:
+    return _ACTIVITY_TIMESERIES_MAX_DAYS[resource]
@@ -0,0 +1,109 @@
+import collections
+import json
+import re
+import zipfile
+
+from datetime import date, datetime
+from typing import Any, Dict, Final, Iterator, Tuple
+
+# Layout of the "Export your account archive" ZIP (and of the Fitbit folder of
+# Google Takeout). Files are split by date, e.g. "Physical Activity/steps-2020-01-01.json".
+
+
+_MEMBER_PATTERN: Final[re.Pattern] = re.compile(
+    r"(?:^|/)(?P<kind>[a-z_]+)-(?P<date>\d{4}-\d{2}-\d{2}|\d+)\.json$"
+)
+_TCX_MEMBER_PATTERN: Final[re.Pattern] = re.compile(r"(?P<log_id>\d+)\.tcx$")
+_CHUNK_SIZE: Final[int] = 64 * 1024
+_DATE_FORMAT: Final[str] = "%m/%d/%y"
+_DATE_TIME_FORMAT: Final[str] = "%m/%d/%y %H:%M:%S"
+
+# Maps the archive files to the activity timeseries resources of the Web API.
+_ACTIVITY_RESOURCES: Final[Dict[str, str]] = {
+    "calories": "calories",
+    "steps": "steps",
+    "distance": "distance",
+    "altitude": "floors",
+    "sedentary_minutes": "minutesSedentary",
+    "lightly_active_minutes": "minutesLightlyActive",
+    "moderately_active_minutes": "minutesFairlyActive",
+    "very_active_minutes": "minutesVeryActive",
+}
+# Distance is stored in centimeters, while the Web API returns kilometers.
+_CENTIMETERS_PER_KILOMETER: Final[int] = 100000
+# Altitude is stored in feet, and every floor accounts for 10 feet.
+_FEET_PER_FLOOR: Final[int] = 10
+
+
+def get_members(archive: zipfile.ZipFile) -> Dict[str, list[Tuple[str, date]]]:
+    members: Dict[str, list[Tuple[str, date]]] = collections.defaultdict(list)
+    for name in archive.namelist():
+        match = _MEMBER_PATTERN.search(name)
+        if not match:
+            continue
+        kind, member_date = match.group("kind"), match.group("date")
+        if kind == "exercise":
+            members[kind].append((name, date.min))
+        elif kind in ("weight", "fat") or kind in _ACTIVITY_RESOURCES:
+            members[kind].append((name, date.fromisoformat(member_date)))
+    return members
+
+
+def get_activity_resource(kind: str) -> str:
+    return _ACTIVITY_RESOURCES[kind]
+
+
+def get_tcx_members(archive: zipfile.ZipFile) -> Dict[int, str]:
+    tcx_members = {}
+    for name in archive.namelist():
+        match = _TCX_MEMBER_PATTERN.search(name)
+        if match:
+            tcx_members[int(match.group("log_id"))] = name
+    return tcx_members
+
+
+def _load_member(archive_path: str, name: str) -> list[Dict[str, Any]]:
+    with zipfile.ZipFile(archive_path) as archive, archive.open(name) as fr:
+        return json.load(fr)
+
+
+def _parse_date(value: str) -> date:
+    return datetime.strptime(value, _DATE_FORMAT).date()
+
+
+def _parse_date_time(value: str) -> date:
+    return datetime.strptime(value, _DATE_TIME_FORMAT).date()
+
+
+def parse_activity_member(archive_path: str, name: str, kind: str) -> Dict[str, float]:
+    # Sums the (possibly per-minute) values of a resource by day.
+    totals: Dict[str, float] = collections.defaultdict(float)
+    for entry in _load_member(archive_path, name):
+        totals[str(_parse_date_time(entry["dateTime"]))] += float(entry["value"])
+    if kind == "distance":
+        return {
+            day: value / _CENTIMETERS_PER_KILOMETER for day, value in totals.items()
+        }
+    if kind == "altitude":
+        return {day: value / _FEET_PER_FLOOR for day, value in totals.items()}
+    return dict(totals)
+
+
+def parse_weight_member(archive_path: str, name: str) -> list[Dict[str, Any]]:
+    return [
+        {**entry, "date": str(_parse_date(entry["date"]))}
+        for entry in _load_member(archive_path, name)
+    ]
+
+
+def parse_exercise_member(archive_path: str, name: str) -> Dict[int, str]:
+    return {
+        entry["logId"]: str(_parse_date_time(entry["startTime"]))
+        for entry in _load_member(archive_path, name)
+    }
+
+
+def iter_tcx_member(archive: zipfile.ZipFile, name: str) -> Iterator[bytes]:
+    with archive.open(name) as fr:
+        while chunk := fr.read(_CHUNK_SIZE):
+            yield chunk
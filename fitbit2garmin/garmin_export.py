@@ -0,0 +1,143 @@
+import csv
+import hashlib
+import json
+import pathlib
+
+from typing import Any, BinaryIO, Dict, Final, Iterable, Literal, Optional, Tuple
+
+# TCX files without any GPS sample are not accepted by Garmin Connect.
+TCX_TRACKPOINT_TAG: Final[bytes] = b"<Trackpoint"
+
+Kind = Literal["weight", "activity"]
+
+# Title and columns of the csv files accepted by the Garmin Connect importer,
+# as (header, key of the entries).
+_CSV_TITLES: Final[Dict[Kind, str]] = {"weight": "Body", "activity": "Activities"}
+_CSV_COLUMNS: Final[Dict[Kind, list[Tuple[str, str]]]] = {
+    "weight": [
+        ("Date", "date"),
+        ("Weight", "weight"),
+        ("BMI", "bmi"),
+        ("Fat", "fat"),
+    ],
+    "activity": [
+        ("Date", "date"),
+        ("Calories Burned", "calories"),
+        ("Steps", "steps"),
+        ("Distance", "distance"),
+        ("Floors", "floors"),
+        ("Minutes Sedentary", "minutesSedentary"),
+        ("Minutes Lightly Active", "minutesLightlyActive"),
+        ("Minutes Fairly Active", "minutesFairlyActive"),
+        ("Minutes Very Active", "minutesVeryActive"),
+        ("Activity Calories", "activityCalories"),
+    ],
+}
+
+
+def write_csv(
+    kind: Kind, file_path: pathlib.Path, entries: Iterable[Dict[str, Any]]
+) -> None:
+    columns = _CSV_COLUMNS[kind]
+    with file_path.open("w", newline="") as fw:
+        writer = csv.writer(fw, lineterminator="\n")
+        writer.writerow([_CSV_TITLES[kind]])
+        writer.writerow([header for header, _ in columns])
+        # Missing values (e.g. the fat of weights logged without it) are 0.
+        writer.writerows(
+            [entry.get(key, "0") for _, key in columns] for entry in entries
+        )
+
+
+def render_csv(
+    kind: Kind, raw_file_path: pathlib.Path, file_path: pathlib.Path
+) -> bool:
+    # Renders the entries of a month stored by the dump commands, one json per
+    # line. Returns whether the month has any entry, otherwise no file is
+    # created.
+    with raw_file_path.open("r") as fr:
+        entries = [json.loads(line) for line in fr]
+    if not entries:
+        file_path.unlink(missing_ok=True)
+        return False
+    write_csv(kind, file_path, entries)
+    return True
+
+
+def write_tcx(content: bytes, file_path: pathlib.Path) -> Optional[str]:
+    # Returns the sha256 of the tcx, or None if it has no trackpoints, in which
+    # case no file is created.
+    if TCX_TRACKPOINT_TAG not in content:
+        return None
+    temp_file_path = file_path.with_name(f"{file_path.name}.part")
+    temp_file_path.write_bytes(content)
+    temp_file_path.replace(file_path)
+    return hashlib.sha256(content).hexdigest()
+
+
+# Looks for trackpoints in a tcx read in chunks, keeping the end of the previous
+# chunk in case the tag is split across two chunks.
+class TrackpointScanner:
+    def __init__(self):
+        self.has_trackpoints = False
+        self._tail = b""
+
+    def update(self, chunk: bytes) -> None:
+        if self.has_trackpoints:
+            return
+        window = self._tail + chunk
+        self.has_trackpoints = TCX_TRACKPOINT_TAG in window
+        self._tail = window[1 - len(TCX_TRACKPOINT_TAG) :]
+
+
+# Streams a tcx to a temporary file next to file_path, which commit() moves to
+# file_path if the tcx has trackpoints. The temporary file is removed on exit.
+class TcxWriter:
+    def __init__(self, file_path: pathlib.Path):
+        self.file_path = file_path
+        self.temp_file_path = file_path.with_name(f"{file_path.name}.part")
+        self._content_hash = hashlib.sha256()
+        self._scanner = TrackpointScanner()
+        self._file: Optional[BinaryIO] = None
+
+    def __enter__(self) -> "TcxWriter":
+        self._file = self.temp_file_path.open("wb")
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        try:
+            self.close()
+        finally:
+            self.temp_file_path.unlink(missing_ok=True)
+
+    @property
+    def content_hash(self) -> str:
+        return self._content_hash.hexdigest()
+
+    def write(self, chunk: bytes) -> None:
+        assert self._file is not None
+        self._scanner.update(chunk)
+        self._content_hash.update(chunk)
+        self._file.write(chunk)
+
+    def close(self) -> None:
+        # Flushes the temporary file, so that it can be read before commit().
+        if self._file is not None:
+            self._file.close()
+
+    def commit(self) -> Optional[str]:
+        # Returns the sha256 of the tcx, or None if it has no trackpoints.
+        self.close()
+        if not self._scanner.has_trackpoints:
+            return None
+        self.temp_file_path.replace(self.file_path)
+        return self.content_hash
+
+
+def write_tcx_chunks(chunks: Iterable[bytes], file_path: pathlib.Path) -> Optional[str]:
+    # Same as write_tcx(), streaming the tcx to a temporary file which is moved
+    # to file_path once complete.
+    with TcxWriter(file_path) as writer:
+        for chunk in chunks:
+            writer.write(chunk)
+        return writer.commit()
@@ -0,0 +1,190 @@
+import logging
+import pathlib
+import re
+import sqlite3
+import time
+
+from typing import Dict, Final, Literal, Optional
+
+_JOURNAL_FILE_NAME: Final[str] = ".journal.sqlite"
+_BUSY_TIMEOUT: Final[int] = 30
+# Marker files used to track the progress before the journal was introduced,
+# e.g. ".weight.2020-01-01-2020-01-31" or ".exercise.123456789".
+_MARKER_PATTERN: Final[re.Pattern] = re.compile(
+    r"^\.(?P<kind>exercise|exercises|weight|activity)\.(?P<key>[0-9-]+)$"
+)
+
+State = Literal["pending", "done", "failed"]
+
+
+def journal_exists(cache_directory: pathlib.Path) -> bool:
+    return (cache_directory / _JOURNAL_FILE_NAME).exists()
+
+
+# Progress of the export stored in a SQLite database in the cache directory.
+# Each change is committed in its own short transaction, so that the write lock
+# is never held while waiting (e.g. for a request) and other processes sharing
+# the cache directory are not blocked.
+class Journal:
+    def __init__(self, cache_directory: pathlib.Path):
+        cache_directory.mkdir(parents=True, exist_ok=True)
+        self._cache_directory = cache_directory
+        self._done: Dict[str, set[str]] = {}
+        self._connection = sqlite3.connect(
+            cache_directory / _JOURNAL_FILE_NAME, timeout=_BUSY_TIMEOUT
+        )
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        with self._connection:
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS items (
+                    kind TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    state TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    content_hash TEXT,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (kind, key)
+                ) WITHOUT ROWID
+                """)
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS items_state ON items (kind, state)"
+            )
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS watermarks (
+                    kind TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+                """)
+        self._migrate_markers()
+
+    def __enter__(self) -> "Journal":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._connection.close()
+
+    def is_done(self, kind: str, key: str) -> bool:
+        if kind not in self._done:
+            self._done[kind] = {
+                key
+                for key, in self._connection.execute(
+                    "SELECT key FROM items WHERE kind = ? AND state = 'done'", (kind,)
+                )
+            }
+        return key in self._done[kind]
+
+    def get_state(self, kind: str, key: str) -> Optional[State]:
+        row = self._connection.execute(
+            "SELECT state FROM items WHERE kind = ? AND key = ?", (kind, key)
+        ).fetchone()
+        return row[0] if row else None
+
+    def start(self, kind: str, key: str) -> None:
+        self._execute(
+            """
+            INSERT INTO items (kind, key, state, attempts, updated_at)
+            VALUES (?, ?, 'pending', 1, ?)
+            ON CONFLICT (kind, key) DO UPDATE SET
+                state = 'pending', attempts = attempts + 1, updated_at = excluded.updated_at
+            """,
+            (kind, key, time.time()),
+        )
+        self._done.get(kind, set()).discard(key)
+
+    def done(self, kind: str, key: str, content_hash: Optional[str] = None) -> None:
+        self._execute(
+            """
+            INSERT INTO items (kind, key, state, content_hash, updated_at)
+            VALUES (?, ?, 'done', ?, ?)
+            ON CONFLICT (kind, key) DO UPDATE SET
+                state = 'done', content_hash = excluded.content_hash, updated_at = excluded.updated_at
+            """,
+            (kind, key, content_hash, time.time()),
+        )
+        if kind in self._done:
+            self._done[kind].add(key)
+
+    # Items that failed permanently are left out of the export, and retried by
+    # the next run.
+    def fail(self, kind: str, key: str) -> None:
+        self._execute(
+            """
+            INSERT INTO items (kind, key, state, updated_at)
+            VALUES (?, ?, 'failed', ?)
+            ON CONFLICT (kind, key) DO UPDATE SET
+                state = 'failed', updated_at = excluded.updated_at
+            """,
+            (kind, key, time.time()),
+        )
+        self._done.get(kind, set()).discard(key)
+
+    def get_failed(self, kind: str) -> list[str]:
+        return [
+            key
+            for key, in self._connection.execute(
+                "SELECT key FROM items WHERE kind = ? AND state = 'failed'", (kind,)
+            )
+        ]
+
+    # Items done without content, e.g. activities whose tcx is empty.
+    def get_done_without_hash(self, kind: str) -> set[str]:
+        return {
+            key
+            for key, in self._connection.execute(
+                """
+                SELECT key FROM items
+                WHERE kind = ? AND state = 'done' AND content_hash IS NULL
+                """,
+                (kind,),
+            )
+        }
+
+    # The watermark of a kind of data is the value up to which it has been
+    # fully fetched by the last successful sync.
+    def get_watermark(self, kind: str) -> Optional[str]:
+        row = self._connection.execute(
+            "SELECT value FROM watermarks WHERE kind = ?", (kind,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def set_watermark(self, kind: str, value: str) -> None:
+        self._execute(
+            """
+            INSERT INTO watermarks (kind, value, updated_at) VALUES (?, ?, ?)
+            ON CONFLICT (kind) DO UPDATE SET
+                value = excluded.value, updated_at = excluded.updated_at
+            """,
+            (kind, value, time.time()),
+        )
+
+    def _execute(self, sql: str, parameters: tuple) -> None:
+        with self._connection:
+            self._connection.execute(sql, parameters)
+
+    def _migrate_markers(self) -> None:
+        markers = [
+            (path, match)
+            for path in self._cache_directory.iterdir()
+            if (match := _MARKER_PATTERN.match(path.name))
+        ]
+        if not markers:
+            return
+        logging.info(f"Migrating {len(markers)} marker files to the journal.")
+        with self._connection:
+            self._connection.executemany(
+                """
+                INSERT OR IGNORE INTO items (kind, key, state, updated_at)
+                VALUES (?, ?, 'done', ?)
+                """,
+                [
+                    (match.group("kind"), match.group("key"), path.stat().st_mtime)
+                    for path, match in markers
+                ],
+            )
+        for path, _ in markers:
+            path.unlink()
@@ -0,0 +1,205 @@
+import asyncio
+import collections
+import contextlib
+import json
+import pathlib
+import re
+import threading
+import time
+import urllib.parse
+
+from typing import Any, Dict, Final, Iterator, Optional, Tuple
+
+_METRICS_FILE_NAME: Final[str] = ".metrics.json"
+_PROMETHEUS_FILE_NAME: Final[str] = ".metrics.prom"
+_PREFIX: Final[str] = "fitbit2garmin_"
+# Upper bounds in seconds of the buckets of the histograms.
+_BUCKETS: Final[Tuple[float, ...]] = (
+    0.001,
+    0.005,
+    0.01,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+    300,
+    3600,
+)
+# Parts of the urls replaced to group the requests by endpoint, e.g. dates and
+# log ids (but not the API version).
+_ENDPOINT_PATTERNS: Final[list[Tuple[re.Pattern, str]]] = [
+    (re.compile(r"\d{4}-\d{2}-\d{2}"), "{date}"),
+    (re.compile(r"/\d{3,}"), "/{id}"),
+]
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def get_endpoint(url: str) -> str:
+    # e.g. "/1/user/-/activities/steps/date/{date}/{date}.json"
+    path = urllib.parse.urlparse(url).path
+    for pattern, replacement in _ENDPOINT_PATTERNS:
+        path = pattern.sub(replacement, path)
+    return path
+
+
+class _Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        i = next((i for i, bound in enumerate(_BUCKETS) if value <= bound), -1)
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def get_cumulative_counts(self) -> list[Tuple[str, int]]:
+        bounds = [f"{bound:g}" for bound in _BUCKETS] + ["+Inf"]
+        cumulative_counts, total = [], 0
+        for bound, count in zip(bounds, self.counts):
+            total += count
+            cumulative_counts.append((bound, total))
+        return cumulative_counts
+
+
+# Counters and histograms of the time spent in the hot paths of an export (e.g.
+# waiting for the rate limiter, sending requests, parsing and writing data),
+# exported as json and in the Prometheus text format. Durations can also be
+# recorded as trace events, which can be opened with chrome://tracing.
+class Metrics:
+    def __init__(self):
+        self._start_ts = time.time()
+        self._counters: Dict[Tuple[str, Labels], float] = collections.defaultdict(float)
+        self._histograms: Dict[Tuple[str, Labels], _Histogram] = (
+            collections.defaultdict(_Histogram)
+        )
+        self._trace_events: Optional[list[Dict[str, Any]]] = None
+        self._trace_tids: Dict[Any, int] = {}
+
+    def increment(self, name: str, value: float = 1, **labels: str) -> None:
+        self._counters[name, tuple(sorted(labels.items()))] += value
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        self._histograms[name, tuple(sorted(labels.items()))].observe(value)
+
+    # Observes the seconds elapsed since start, a time.perf_counter() value.
+    def record(self, name: str, start: float, **labels: str) -> None:
+        end = time.perf_counter()
+        self.observe(name, end - start, **labels)
+        if self._trace_events is not None:
+            self._trace_events.append(
+                {
+                    "name": name,
+                    "ph": "X",
+                    "ts": start * 1e6,
+                    "dur": (end - start) * 1e6,
+                    "pid": 1,
+                    "tid": self._get_trace_tid(),
+                    "args": labels,
+                }
+            )
+
+    @contextlib.contextmanager
+    def timer(self, name: str, **labels: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, start, **labels)
+
+    def start_trace(self) -> None:
+        self._trace_events = []
+
+    def write_trace(self, file_path: pathlib.Path) -> None:
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+        with file_path.open("w") as fw:
+            json.dump({"traceEvents": self._trace_events or []}, fw)
+
+    def to_json(self) -> Dict[str, Any]:
+        hours = max(time.time() - self._start_ts, 1e-9) / 3600
+        return {
+            "elapsed_seconds": round(hours * 3600, 3),
+            "counters": [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in sorted(self._counters.items())
+            ],
+            # Items (months, tcxs, ...) processed per hour, by kind.
+            "items_per_hour": {
+                dict(labels).get("kind", ""): round(value / hours, 1)
+                for (name, labels), value in sorted(self._counters.items())
+                if name == "items"
+            },
+            "histograms": [
+                {
+                    "name": name,
+                    "labels": dict(labels),
+                    "count": histogram.count,
+                    "sum": round(histogram.sum, 6),
+                    "buckets": dict(histogram.get_cumulative_counts()),
+                }
+                for (name, labels), histogram in sorted(self._histograms.items())
+            ],
+        }
+
+    def to_prometheus(self) -> str:
+        lines = []
+        for (name, labels), value in sorted(self._counters.items()):
+            lines.append(
+                f"{_PREFIX}{name}_total{_format_labels(labels)} {float(value)!r}"
+            )
+        for (name, labels), histogram in sorted(self._histograms.items()):
+            for bound, count in histogram.get_cumulative_counts():
+                bucket_labels = _format_labels(labels + (("le", bound),))
+                lines.append(f"{_PREFIX}{name}_bucket{bucket_labels} {count}")
+            lines.append(
+                f"{_PREFIX}{name}_sum{_format_labels(labels)} {histogram.sum!r}"
+            )
+            lines.append(
+                f"{_PREFIX}{name}_count{_format_labels(labels)} {histogram.count}"
+            )
+        return "\n".join(lines) + "\n"
+
+    def write(self, directory: pathlib.Path) -> None:
+        directory.mkdir(parents=True, exist_ok=True)
+        with (directory / _METRICS_FILE_NAME).open("w") as fw:
+            json.dump(self.to_json(), fw, indent=2)
+        with (directory / _PROMETHEUS_FILE_NAME).open("w") as fw:
+            fw.write(self.to_prometheus())
+
+    def _get_trace_tid(self) -> int:
+        # Trace events are grouped by asyncio task, or by thread outside of the
+        # event loop.
+        try:
+            key: Any = asyncio.current_task()
+        except RuntimeError:
+            key = None
+        if key is None:
+            key = threading.get_ident()
+        return self._trace_tids.setdefault(key, len(self._trace_tids) + 1)
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    # Backslashes, double quotes and line feeds are escaped in the values.
+    values = ",".join(
+        f'{key}="{json.dumps(value, ensure_ascii=False)[1:-1]}"'
+        for key, value in labels
+    )
+    return f"{{{values}}}"
+
+
+_METRICS: Final[Metrics] = Metrics()
+
+
+# Metrics of the current process.
+def get() -> Metrics:
+    return _METRICS
@@ -0,0 +1,279 @@
+import asyncio
+import collections
+import contextlib
+import contextvars
+import json
+import logging
+import pathlib
+import sys
+import time
+
+from typing import Any, Deque, Dict, Iterator, Mapping, NamedTuple, Optional
+
+from . import fitbit_api
+
+if sys.platform != "win32":
+    import fcntl
+
+
+# https://dev.fitbit.com/build/reference/web-api/developer-guide/application-design/#Rate-Limits
+
+
+_HEADER_LIMIT = "Fitbit-Rate-Limit-Limit"
+_HEADER_REMAINING = "Fitbit-Rate-Limit-Remaining"
+_HEADER_RESET = "Fitbit-Rate-Limit-Reset"
+_HEADER_RETRY_AFTER = "Retry-After"
+_PROBE_INTERVAL = 0.05
+
+# Priority of the requests sent from the current context, lower values are served
+# first when there is contention for the budget.
+_PRIORITY: contextvars.ContextVar[int] = contextvars.ContextVar("priority", default=0)
+# Budget of each window left to the other contexts by the requests sent from the
+# current one, e.g. by a backfill running alongside the syncs.
+_RESERVE: contextvars.ContextVar[int] = contextvars.ContextVar("reserve", default=0)
+
+
+# Concurrent requests shared by several rate limiters, e.g. the ones of several
+# accounts using the same connection pool. When all the slots are taken, they
+# are handed out in round robin to the rate limiters waiting for one, so that
+# the ones sending more concurrent requests do not starve the others.
+class FairShare:
+    def __init__(self, num_slots: int):
+        self._free = num_slots
+        self._waiters: Dict["RateLimiter", Deque[asyncio.Future]] = {}
+
+    async def acquire(self, limiter: "RateLimiter") -> None:
+        if self._free > 0 and not self._waiters:
+            self._free -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(limiter, collections.deque()).append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The slot was handed over right before the cancellation.
+                self.release()
+            raise
+
+    def release(self) -> None:
+        while self._waiters:
+            # Dicts keep the insertion order, hence the rate limiter served is
+            # moved to the end of the queue.
+            limiter = next(iter(self._waiters))
+            waiters = self._waiters.pop(limiter)
+            future = waiters.popleft()
+            if waiters:
+                self._waiters[limiter] = waiters
+            if not future.done():
+                future.set_result(None)
+                return
+        self._free += 1
+
+
+class RateLimitState(NamedTuple):
+    limit: int
+    remaining: int
+    reset_ts: float
+    in_flight: int
+    synced: bool
+
+
+# Lets requests through as long as the current window has budget left, and holds
+# them back until the window resets once the budget is exhausted. The budget is
+# unknown until the first response is received, hence only one request at a time
+# is allowed until then.
+# When a ledger file is given, the budget is persisted there and shared with all
+# the other processes using the same ledger.
+# When a fair share is given, requests also wait for one of its slots once they
+# got the budget.
+class RateLimiter:
+    def __init__(
+        self,
+        limit: int = fitbit_api.API_RATE_LIMIT,
+        interval: int = fitbit_api.API_RATE_INTERVAL,
+        ledger_path: Optional[pathlib.Path] = None,
+        share: Optional[FairShare] = None,
+    ):
+        self._limit = limit
+        self._interval = interval
+        self._remaining = limit
+        self._reset_ts = time.time() + interval
+        self._in_flight = 0
+        self._synced = False
+        self._ledger_path = ledger_path
+        self._share = share
+        self._waiting: collections.Counter[int] = collections.Counter()
+
+    @property
+    def state(self) -> RateLimitState:
+        return RateLimitState(
+            limit=self._limit,
+            remaining=self._remaining,
+            reset_ts=self._reset_ts,
+            in_flight=self._in_flight,
+            synced=self._synced,
+        )
+
+    def load(self) -> RateLimitState:
+        # Reads the budget left from the ledger, if any, without writing it.
+        if self._ledger_path is None or not self._ledger_path.exists():
+            return self.state
+        with self._ledger_path.open("r") as fp:
+            if sys.platform != "win32":
+                fcntl.flock(fp, fcntl.LOCK_SH)
+            self._read_ledger(fp.read())
+        return self.state
+
+    async def __aenter__(self) -> "RateLimiter":
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        self.release()
+
+    async def acquire(self) -> None:
+        priority = _PRIORITY.get()
+        self._waiting[priority] += 1
+        try:
+            while True:
+                wait = self._try_acquire(priority)
+                if wait is None:
+                    break
+                if wait <= _PROBE_INTERVAL:
+                    await asyncio.sleep(_PROBE_INTERVAL)
+                    continue
+                logging.info(
+                    f"Rate limit budget exhausted, waiting {wait:.0f}s for the reset."
+                )
+                await asyncio.sleep(wait)
+        finally:
+            self._waiting[priority] -= 1
+        if self._share:
+            try:
+                await self._share.acquire(self)
+            except BaseException:
+                self._in_flight -= 1
+                raise
+
+    def _try_acquire(self, priority: int) -> Optional[float]:
+        # The requests held back only read the ledger, under a shared lock, so
+        # that the waiting ones probing it do not rewrite it.
+        with self._ledger(exclusive=False):
+            wait = self._get_wait(priority)
+        if wait is not None:
+            return wait
+        with self._ledger():
+            wait = self._get_wait(priority)
+            if wait is None:
+                self._remaining -= 1
+                self._in_flight += 1
+            return wait
+
+    def _get_wait(self, priority: int) -> Optional[float]:
+        now = time.time()
+        if now >= self._reset_ts:
+            self._remaining = self._limit
+            self._reset_ts = now + self._interval
+        if self._remaining <= _RESERVE.get():
+            return self._reset_ts - now
+        if not self._synced and self._in_flight > 0:
+            return _PROBE_INTERVAL
+        if any(n > 0 for p, n in self._waiting.items() if p < priority):
+            return _PROBE_INTERVAL
+        return None
+
+    def release(self) -> None:
+        self._in_flight -= 1
+        if self._share:
+            self._share.release()
+
+    def update(self, status: int, headers: Mapping[str, str]) -> None:
+        with self._ledger():
+            self._update(status, headers)
+        logging.debug(f"Rate limit state: {self.state}")
+
+    def _update(self, status: int, headers: Mapping[str, str]) -> None:
+        now = time.time()
+        if _HEADER_LIMIT in headers:
+            self._limit = int(headers[_HEADER_LIMIT])
+        if _HEADER_REMAINING in headers and _HEADER_RESET in headers:
+            # Budget already reserved by the other requests in flight is not
+            # yet accounted for in the remaining budget returned by the API.
+            self._remaining = max(
+                int(headers[_HEADER_REMAINING]) - (self._in_flight - 1), 0
+            )
+            self._reset_ts = now + int(headers[_HEADER_RESET])
+            self._synced = True
+        if status == 429:
+            self._remaining = 0
+            retry_after = _parse_retry_after(headers)
+            if retry_after is not None:
+                self._reset_ts = now + retry_after
+            elif self._reset_ts <= now:
+                # Without a reset time, the whole window is waited for, rather
+                # than refilling the budget straight away.
+                self._reset_ts = now + self._interval
+
+    def _read_ledger(self, content: str) -> None:
+        if content:
+            ledger = json.loads(content)
+            self._limit = ledger["limit"]
+            self._remaining = ledger["remaining"]
+            self._reset_ts = ledger["reset_ts"]
+            self._synced = self._synced or ledger["synced"]
+
+    def _get_ledger(self) -> Dict[str, Any]:
+        return {
+            "limit": self._limit,
+            "remaining": self._remaining,
+            "reset_ts": self._reset_ts,
+            "synced": self._synced,
+        }
+
+    # Reads the ledger and, when exclusive, writes back the changes made while
+    # it is held, if any.
+    @contextlib.contextmanager
+    def _ledger(self, exclusive: bool = True) -> Iterator[None]:
+        if self._ledger_path is None:
+            yield
+            return
+        self._ledger_path.parent.mkdir(parents=True, exist_ok=True)
+        with self._ledger_path.open("a+") as fp:
+            # Concurrent processes are not synchronized on Windows.
+            if sys.platform != "win32":
+                fcntl.flock(fp, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            fp.seek(0)
+            content = fp.read()
+            self._read_ledger(content)
+            ledger = self._get_ledger()
+            yield
+            if exclusive and (not content or self._get_ledger() != ledger):
+                fp.seek(0)
+                fp.truncate()
+                json.dump(self._get_ledger(), fp)
+
+
+def _parse_retry_after(headers: Mapping[str, str]) -> Optional[int]:
+    value = headers.get(_HEADER_RETRY_AFTER, headers.get(_HEADER_RESET))
+    if value is None or not value.isdigit():
+        return None
+    return int(value)
+
+
+@contextlib.contextmanager
+def priority(value: int) -> Iterator[None]:
+    token = _PRIORITY.set(value)
+    try:
+        yield
+    finally:
+        _PRIORITY.reset(token)
+
+
+@contextlib.contextmanager
+def reserve(num_requests: int) -> Iterator[None]:
+    token = _RESERVE.set(num_requests)
+    try:
+        yield
+    finally:
+        _RESERVE.reset(token)
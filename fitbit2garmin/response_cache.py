@@ -0,0 +1,190 @@
+import hashlib
+import logging
+import pathlib
+import sqlite3
+import time
+import zlib
+
+from typing import Dict, Final, Iterator, Mapping, Optional
+
+_CACHE_DIRECTORY_NAME: Final[str] = ".responses"
+_INDEX_FILE_NAME: Final[str] = "index.sqlite"
+_MAX_SIZE: Final[int] = 1024 * 1024 * 1024
+_BUSY_TIMEOUT: Final[int] = 30
+_CHUNK_SIZE: Final[int] = 64 * 1024
+
+
+def read_blob(blob_path: pathlib.Path) -> bytes:
+    return zlib.decompress(blob_path.read_bytes())
+
+
+def iter_blob(blob_path: pathlib.Path) -> Iterator[bytes]:
+    # Same as read_blob(), decompressing the response in chunks.
+    decompressor = zlib.decompressobj()
+    with blob_path.open("rb") as fr:
+        while chunk := fr.read(_CHUNK_SIZE):
+            yield decompressor.decompress(chunk)
+    yield decompressor.flush()
+
+
+# Raised in offline mode when a response is not in the cache.
+class CacheMissError(Exception):
+    pass
+
+
+# Raw API responses stored in the cache directory, so that the exported files
+# can be rendered again without fetching the data again. The responses are
+# compressed and stored by the sha256 of their content, hence identical
+# responses are only stored once. The least recently used ones are evicted when
+# the responses take more than max_size bytes on disk.
+# In offline mode, responses are only served from the cache.
+class ResponseCache:
+    def __init__(
+        self,
+        cache_directory: pathlib.Path,
+        max_size: int = _MAX_SIZE,
+        offline: bool = False,
+    ):
+        self.offline = offline
+        self._directory = cache_directory / _CACHE_DIRECTORY_NAME
+        self._directory.mkdir(parents=True, exist_ok=True)
+        self._max_size = max_size
+        self._connection = sqlite3.connect(
+            self._directory / _INDEX_FILE_NAME, timeout=_BUSY_TIMEOUT
+        )
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        with self._connection:
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    url TEXT PRIMARY KEY,
+                    content_hash TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    etag TEXT,
+                    last_modified TEXT,
+                    accessed_at REAL NOT NULL
+                )
+                """)
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS responses_accessed_at "
+                "ON responses (accessed_at)"
+            )
+
+    def close(self) -> None:
+        self._connection.close()
+
+    def get_conditional_headers(self, url: str) -> Dict[str, str]:
+        row = self._connection.execute(
+            "SELECT etag, last_modified FROM responses WHERE url = ?", (url,)
+        ).fetchone()
+        headers = {}
+        if row and row[0]:
+            headers["If-None-Match"] = row[0]
+        if row and row[1]:
+            headers["If-Modified-Since"] = row[1]
+        return headers
+
+    def load(self, url: str) -> bytes:
+        return read_blob(self.load_blob_path(url))
+
+    # Same as load(), returning the path of the compressed response instead,
+    # e.g. to stream it with iter_blob().
+    def load_blob_path(self, url: str) -> pathlib.Path:
+        blob_path = self.get_blob_path(url)
+        if blob_path is None:
+            raise CacheMissError(f"No cached response for {url}.")
+        with self._connection:
+            self._connection.execute(
+                "UPDATE responses SET accessed_at = ? WHERE url = ?",
+                (time.time(), url),
+            )
+        return blob_path
+
+    # Path of the compressed response, which can be read with read_blob() e.g.
+    # by another process.
+    def get_blob_path(self, url: str) -> Optional[pathlib.Path]:
+        row = self._connection.execute(
+            "SELECT content_hash FROM responses WHERE url = ?", (url,)
+        ).fetchone()
+        if row is None or not self._get_blob_path(row[0]).exists():
+            return None
+        return self._get_blob_path(row[0])
+
+    def store(self, url: str, content: bytes, headers: Mapping[str, str]) -> None:
+        content_hash = hashlib.sha256(content).hexdigest()
+        blob_path = self._get_blob_path(content_hash)
+        if not blob_path.exists():
+            blob_path.parent.mkdir(exist_ok=True)
+            self._write_atomically(blob_path, zlib.compress(content))
+        self.add(url, content_hash, headers)
+
+    def write_blob(self, content_hash: str, file_path: pathlib.Path) -> None:
+        # Compresses a response already written to a file. It does not touch the
+        # index, hence it can be run in a separate thread and followed by add().
+        blob_path = self._get_blob_path(content_hash)
+        if blob_path.exists():
+            return
+        blob_path.parent.mkdir(exist_ok=True)
+        compressor = zlib.compressobj()
+        temp_blob_path = blob_path.with_name(f"{blob_path.name}.part")
+        with file_path.open("rb") as fr, temp_blob_path.open("wb") as fw:
+            while chunk := fr.read(_CHUNK_SIZE):
+                fw.write(compressor.compress(chunk))
+            fw.write(compressor.flush())
+        temp_blob_path.replace(blob_path)
+
+    def add(self, url: str, content_hash: str, headers: Mapping[str, str]) -> None:
+        size = self._get_blob_path(content_hash).stat().st_size
+        with self._connection:
+            self._connection.execute(
+                """
+                INSERT OR REPLACE INTO responses
+                    (url, content_hash, size, etag, last_modified, accessed_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    url,
+                    content_hash,
+                    size,
+                    headers.get("ETag"),
+                    headers.get("Last-Modified"),
+                    time.time(),
+                ),
+            )
+        self._evict()
+
+    def _evict(self) -> None:
+        (size,) = self._connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM "
+            "(SELECT DISTINCT content_hash, size FROM responses)"
+        ).fetchone()
+        if size <= self._max_size:
+            return
+        rows = self._connection.execute(
+            "SELECT url, content_hash, size FROM responses ORDER BY accessed_at"
+        ).fetchall()
+        evicted = []
+        for url, content_hash, blob_size in rows:
+            if size <= self._max_size:
+                break
+            evicted.append(url)
+            size -= blob_size
+        with self._connection:
+            self._connection.executemany(
+                "DELETE FROM responses WHERE url = ?", [(url,) for url in evicted]
+            )
+        # Blobs might still be referenced by other responses with same content.
+        for _, content_hash, _ in rows[: len(evicted)]:
+            if not self._connection.execute(
+                "SELECT 1 FROM responses WHERE content_hash = ?", (content_hash,)
+            ).fetchone():
+                self._get_blob_path(content_hash).unlink(missing_ok=True)
+        logging.debug(f"Evicted {len(evicted)} responses from the cache.")
+
+    def _get_blob_path(self, content_hash: str) -> pathlib.Path:
+        return self._directory / content_hash[:2] / f"{content_hash}.z"
+
+    @staticmethod
+    def _write_atomically(file_path: pathlib.Path, content: bytes) -> None:
+        temp_file_path = file_path.with_name(f"{file_path.name}.part")
+        temp_file_path.write_bytes(content)
+        temp_file_path.replace(file_path)
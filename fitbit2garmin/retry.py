@@ -0,0 +1,94 @@
+import asyncio
+import logging
+import random
+import time
+
+from typing import Final, Literal
+
+_MAX_ATTEMPTS: Final[int] = 8
+_BASE_DELAY: Final[float] = 1.0
+_MAX_DELAY: Final[float] = 5 * 60
+_BREAKER_THRESHOLD: Final[int] = 5
+_BREAKER_COOLDOWN: Final[float] = 5 * 60
+
+ErrorKind = Literal["unauthorized", "rate_limited", "transient", "permanent"]
+
+
+# Raised when a request cannot succeed, either because the error is permanent
+# or because it kept failing for all the attempts allowed.
+class RetryError(Exception):
+    pass
+
+
+def classify_error(err: BaseException) -> ErrorKind:
+    # Imported here to keep aiohttp out of the commands not sending requests.
+    import aiohttp
+
+    if isinstance(err, aiohttp.ClientResponseError):
+        if err.status == 401:
+            return "unauthorized"
+        if err.status == 429:
+            return "rate_limited"
+        if err.status == 408 or err.status >= 500:
+            return "transient"
+        return "permanent"
+    if isinstance(
+        err,
+        (
+            aiohttp.ClientConnectionError,
+            aiohttp.ClientPayloadError,
+            asyncio.TimeoutError,
+        ),
+    ):
+        return "transient"
+    return "permanent"
+
+
+# Decides how failed requests are retried:
+#  - unauthorized requests are retried right away with a refreshed token;
+#  - rate limited requests are retried once the rate limiter lets them through,
+#    without counting as a failed attempt;
+#  - transient errors (server errors, timeouts, connection errors) are retried
+#    after a capped exponential backoff with full jitter;
+#  - any other error is permanent and not retried.
+# After breaker_threshold consecutive transient errors across all requests, the
+# circuit opens and no request is sent until breaker_cooldown seconds passed.
+class RetryPolicy:
+    def __init__(
+        self,
+        max_attempts: int = _MAX_ATTEMPTS,
+        base_delay: float = _BASE_DELAY,
+        max_delay: float = _MAX_DELAY,
+        breaker_threshold: int = _BREAKER_THRESHOLD,
+        breaker_cooldown: float = _BREAKER_COOLDOWN,
+    ):
+        self.max_attempts = max_attempts
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+        self._breaker_threshold = breaker_threshold
+        self._breaker_cooldown = breaker_cooldown
+        self._num_failures = 0
+        self._closes_at = 0.0
+
+    def get_delay(self, attempt: int) -> float:
+        return random.uniform(
+            0, min(self._max_delay, self._base_delay * 2 ** (attempt - 1))
+        )
+
+    async def wait_for_circuit(self) -> None:
+        while (wait_time := self._closes_at - time.time()) > 0:
+            await asyncio.sleep(wait_time)
+
+    def record_success(self) -> None:
+        self._num_failures = 0
+
+    def record_failure(self) -> None:
+        self._num_failures += 1
+        if self._num_failures == self._breaker_threshold:
+            logging.warning(
+                f"{self._num_failures} consecutive requests failed, pausing for "
+                f"{self._breaker_cooldown:g} seconds."
+            )
+            self._closes_at = time.time() + self._breaker_cooldown
+            # The first request after the pause decides whether to pause again.
+            self._num_failures = self._breaker_threshold - 1
@@ -0,0 +1,139 @@
+import asyncio
+import logging
+import math
+import time
+
+from collections.abc import Awaitable, Callable
+from datetime import timedelta
+from typing import Any, Dict, Final, NamedTuple
+
+from . import fitbit_api, rate_limiter
+from .rate_limiter import RateLimiter, RateLimitState
+
+_REPORT_INTERVAL: Final[int] = 60
+
+
+# Number of requests planned and done so far by a workload.
+class Progress:
+    def __init__(self, name: str):
+        self.name = name
+        self.total = 0
+        self.done = 0
+
+    def plan(self, num_requests: int = 1) -> None:
+        self.total += num_requests
+
+    def advance(self, num_requests: int = 1) -> None:
+        self.done += num_requests
+
+    def __str__(self) -> str:
+        return f"{self.name} {self.done}/{self.total}"
+
+
+# Seconds needed to send num_requests requests, given the budget left.
+def estimate_duration(num_requests: int, state: RateLimitState) -> float:
+    remaining, reset_ts = state.remaining, state.reset_ts
+    if time.time() >= reset_ts:
+        remaining, reset_ts = state.limit, time.time() + fitbit_api.API_RATE_INTERVAL
+    if num_requests <= remaining:
+        return 0.0
+    num_windows = math.ceil((num_requests - remaining) / state.limit)
+    return (
+        max(reset_ts - time.time(), 0.0)
+        + (num_windows - 1) * fitbit_api.API_RATE_INTERVAL
+    )
+
+
+class _Workload(NamedTuple):
+    priority: int
+    progress: Progress
+    func: Callable[..., Awaitable[Any]]
+
+
+# Runs several workloads concurrently over the budget of a single rate limiter.
+# When the budget is contended, requests from workloads with a lower priority
+# value are sent first.
+class Scheduler:
+    def __init__(self, limiter: RateLimiter, report_interval: int = _REPORT_INTERVAL):
+        self._limiter = limiter
+        self._report_interval = report_interval
+        self._workloads: list[_Workload] = []
+
+    def add(
+        self, name: str, priority: int, func: Callable[..., Awaitable[Any]]
+    ) -> Progress:
+        progress = Progress(name)
+        self._workloads.append(_Workload(priority, progress, func))
+        return progress
+
+    def eta(self) -> float:
+        num_requests = sum(
+            workload.progress.total - workload.progress.done
+            for workload in self._workloads
+        )
+        return estimate_duration(num_requests, self._limiter.state)
+
+    @property
+    def progresses(self) -> list[Progress]:
+        return [workload.progress for workload in self._workloads]
+
+    async def run(self, report: bool = True) -> None:
+        if not report:
+            await asyncio.gather(*map(self._run, self._workloads))
+            return
+        reporter = asyncio.ensure_future(self._report())
+        try:
+            await asyncio.gather(*map(self._run, self._workloads))
+        finally:
+            reporter.cancel()
+        self._log()
+
+    async def _run(self, workload: _Workload) -> None:
+        with rate_limiter.priority(workload.priority):
+            await workload.func(request_progress=workload.progress)
+
+    async def _report(self) -> None:
+        while True:
+            await asyncio.sleep(self._report_interval)
+            self._log()
+
+    def _log(self) -> None:
+        progresses = ", ".join(str(workload.progress) for workload in self._workloads)
+        eta = timedelta(seconds=round(self.eta()))
+        logging.info(f"Requests: {progresses}. ETA: {eta}.")
+
+
+# Runs the schedulers of several accounts concurrently, each one over the budget
+# of its own rate limiter, reporting their aggregated progress. Accounts run in
+# parallel, hence the ETA is the one of the slowest account.
+async def run_all(
+    schedulers: Dict[str, Scheduler], report_interval: int = _REPORT_INTERVAL
+) -> None:
+    def log() -> None:
+        progresses = [p for s in schedulers.values() for p in s.progresses]
+        num_finished = sum(
+            all(p.done >= p.total for p in scheduler.progresses)
+            for scheduler in schedulers.values()
+        )
+        etas = {name: scheduler.eta() for name, scheduler in schedulers.items()}
+        slowest = max(etas, key=etas.__getitem__, default="")
+        eta = timedelta(seconds=round(etas.get(slowest, 0.0)))
+        logging.info(
+            f"Accounts: {num_finished}/{len(schedulers)} done. Requests: "
+            f"{sum(p.done for p in progresses)}/{sum(p.total for p in progresses)}. "
+            f"ETA: {eta} ({slowest})."
+        )
+
+    async def report() -> None:
+        while True:
+            await asyncio.sleep(report_interval)
+            log()
+
+    reporter = asyncio.ensure_future(report())
+    try:
+        await asyncio.gather(
+            *(scheduler.run(report=False) for scheduler in schedulers.values())
+        )
+    finally:
+        reporter.cancel()
+    log()